@@ -0,0 +1,147 @@
+"""
+Declarative row-level access rules.
+
+RULES maps each role to the rows it may see in each table, as a tuple of
+Conditions that are OR'ed together (or ALLOW_ALL). Every consumer compiles
+from this one table:
+
+- `CompiledRule.where` gives a parameterized SQL WHERE fragment, so queries
+  filter in SQLite;
+- `CompiledRule.matches` checks one record dict;
+- `CompiledRule.mask` evaluates a columnar batch ({column: [values]}) at once.
+
+Both Python forms follow SQL semantics, so a NULL column never matches.
+Compiled rules are memoized per (role, table, region); a user's id is bound
+at call time. A role or table without a rule is denied.
+
+A 'downline' condition matches rows whose column is a user the rule's user
+invited, directly or not; SQL reads it from the invite_closure table and
+Python from the cached set in models.invite_tree.
+"""
+
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, Optional, Sequence, Tuple, Union
+
+from core.models import User
+from models.invite_tree import descendant_set
+
+
+@dataclass(frozen=True)
+class Condition:
+    """
+    `column` must equal the user's attribute `source` ('region' or 'id'), or
+    with source 'downline', be the id of a user in their invitation subtree.
+    """
+    column: str
+    source: str
+
+
+ALLOW_ALL = "all"
+
+Rule = Union[str, Tuple[Condition, ...]]
+
+_ALL_TABLES = "*"
+
+RULES: Dict[str, Dict[str, Rule]] = {
+    'dev': {_ALL_TABLES: ALLOW_ALL},
+    'national': {_ALL_TABLES: ALLOW_ALL},
+    'statal': {
+        'meetings': (Condition('state', 'region'),),
+        'signups': (Condition('state', 'region'),),
+        'users': (Condition('region', 'region'),),
+    },
+    'municipal': {
+        'meetings': (Condition('city', 'region'),),
+        'signups': (Condition('city', 'region'),),
+        'users': (Condition('region', 'region'),),
+    },
+    'facilitator': {
+        'meetings': (Condition('host_id', 'id'),),
+        'invitations': (Condition('invited_by', 'id'), Condition('invited_by', 'downline')),
+        'signups': (Condition('invited_by', 'id'), Condition('invited_by', 'downline')),
+        'users': (Condition('id', 'id'), Condition('id', 'downline')),
+    },
+    'shadower': {
+        'invitations': (Condition('invited_by', 'id'),),
+        'signups': (Condition('invited_by', 'id'),),
+    },
+}
+
+
+class CompiledRule:
+    """One (role, table, region) rule in SQL and Python form."""
+
+    def __init__(self, rule: Rule, region: Optional[str]):
+        self.allow_all = rule == ALLOW_ALL
+        conditions = () if self.allow_all else rule
+        self.deny_all = not self.allow_all and not conditions
+        self.columns = tuple(condition.column for condition in conditions)
+        self._sources = tuple(condition.source for condition in conditions)
+        self._region = region
+
+    def _params(self, user: User) -> tuple:
+        return tuple(self._region if source == 'region' else user.id for source in self._sources)
+
+    def _tests(self, user: User) -> list:
+        """(column, predicate on the column's value) per condition, for Python evaluation."""
+        tests = []
+        for column, source, value in zip(self.columns, self._sources, self._params(user)):
+            if value is None:
+                continue
+            if source == 'downline':
+                tests.append((column, descendant_set(value).__contains__))
+            else:
+                tests.append((column, value.__eq__))
+        return tests
+
+    def where(self, user: User, alias: Optional[str] = None) -> Tuple[str, tuple]:
+        """SQL WHERE fragment and parameters; columns are qualified with `alias` if given."""
+        if self.allow_all:
+            return "1 = 1", ()
+        if self.deny_all:
+            return "1 = 0", ()
+        prefix = f"{alias}." if alias else ""
+        clause = " OR ".join(
+            f"{prefix}{column} IN (SELECT descendant FROM invite_closure WHERE ancestor = ?)"
+            if source == 'downline' else f"{prefix}{column} = ?"
+            for column, source in zip(self.columns, self._sources)
+        )
+        return (f"({clause})" if len(self.columns) > 1 else clause), self._params(user)
+
+    def matches(self, user: User, record: dict) -> bool:
+        """Whether `user` may see `record`."""
+        if self.allow_all:
+            return True
+        return any(
+            record.get(column) is not None and test(record[column]) is True
+            for column, test in self._tests(user)
+        )
+
+    def mask(self, user: User, batch: Dict[str, Sequence], size: Optional[int] = None) -> list:
+        """
+        Evaluates the rule over a columnar batch and returns one bool per row.
+        `size` is only needed when the batch lacks every rule column.
+        """
+        if size is None:
+            size = len(next(iter(batch.values()))) if batch else 0
+        if self.allow_all:
+            return [True] * size
+        visible = [False] * size
+        for column, test in self._tests(user):
+            values = batch.get(column)
+            if values is None:
+                continue
+            visible = [seen or (v is not None and test(v) is True) for seen, v in zip(visible, values)]
+        return visible
+
+
+@lru_cache(maxsize=1024)
+def _compile(role: str, table_name: str, region: Optional[str]) -> CompiledRule:
+    rules = RULES.get(role, {})
+    return CompiledRule(rules.get(table_name, rules.get(_ALL_TABLES, ())), region)
+
+
+def compile_rule(user: User, table_name: str) -> CompiledRule:
+    """Returns the (memoized) rule governing what `user` may see in `table_name`."""
+    return _compile(user.role, table_name, user.region)
@@ -0,0 +1,294 @@
+"""
+Scale benchmarks for the hot paths, with machine-readable results.
+
+Builds a scratch node (its own data, keys and config directories, selected
+with the SPANNING_TREE_* environment variables read by config.py), fills it
+with seeded synthetic data (utils.synthetic) and times:
+
+    find_records            ACL-filtered reads per role and table
+    send_cta                a whole campaign through the dispatch pipeline
+    track_click             cold (database) and warm (cached) clicks, and the buffer flush
+    merge_records           inserting and updating a batch of incoming rows
+    gather_changed_records  full and incremental change sets
+    initiate_sync           a sync to a peer over HTTP (this node, served by core.async_server)
+    sync_endpoint           /sync receiving a pre-built stream: decrypt, verify, merge
+
+Each benchmark runs `--repeat` times; the JSON written to `--out` holds
+every run plus the median, and items per second where a run processes a
+known number of rows. `--compare` prints the change against an earlier
+results file and exits non-zero if a median got slower than `--threshold`.
+
+    python benchmark.py --rows 100000 --out bench.json
+    python benchmark.py --rows 100000 --out new.json --compare bench.json
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+RESULTS_FORMAT = 1
+
+
+def _isolate(workdir: Path):
+    """Points config.py at scratch directories; must run before any project module is imported."""
+    for name in ('data', 'keys', 'config'):
+        (workdir / name).mkdir(parents=True, exist_ok=True)
+        os.environ[f"SPANNING_TREE_{name.upper()}_DIR"] = str(workdir / name)
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).parent, timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+class Recorder:
+    """Times benchmark runs and collects their results."""
+
+    def __init__(self, repeat: int, log):
+        self.repeat = repeat
+        self.results = {}
+        self.log = log
+
+    def measure(self, name: str, run, items: int = None, repeat: int = None):
+        """
+        Calls `run(i)` for each repetition i. `run` may return how many items it
+        processed; otherwise `items` is used for the throughput.
+        """
+        runs, counts = [], []
+        for i in range(repeat or self.repeat):
+            started = time.perf_counter()
+            count = run(i)
+            runs.append((time.perf_counter() - started) * 1000)
+            counts.append(count if count is not None else items)
+        median = statistics.median(runs)
+        result = {"runs_ms": [round(ms, 3) for ms in runs], "median_ms": round(median, 3),
+                  "min_ms": round(min(runs), 3)}
+        if counts[0] is not None:
+            result["items"] = counts[0]
+            result["items_per_s"] = round(counts[0] / (median / 1000), 1) if median else None
+        self.results[name] = result
+        rate = f", {result['items_per_s']:.0f} items/s" if result.get("items_per_s") else ""
+        self.log(f"  {name:<42} median {median:10.2f} ms{rate}")
+
+
+def _start_server():
+    """Runs the asyncio server on an ephemeral port in a background thread; returns its base URL."""
+    from core.async_server import AsyncServer
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    server = AsyncServer(port=0)
+    host, port = asyncio.run_coroutine_threadsafe(server.start(), loop).result()
+    return f"http://{host}:{port}"
+
+
+def run_benchmarks(rows: int, seed: int, repeat: int, log) -> dict:
+    from config import DATA_DIR
+    from core.clicks import get_click_buffer
+    from core.cta import CtaManager
+    from core.dispatch import CtaDispatcher, DomainRateLimiter, FileSinkTransport
+    from core.models import Peer, User
+    from core.p2p import gather_changed_records, initiate_sync, peer_profile
+    from core.peers import PeerManager
+    from core.sync_protocol import encode_sync_stream
+    from models.connection import connection
+    from models.database import find_records, initialize_database, merge_records
+    from utils.crypto import generate_and_store_keys, get_keyring
+    from utils.synthetic import populate
+
+    generate_and_store_keys()
+    initialize_database()
+    started = time.perf_counter()
+    counts = populate(rows, seed)
+    log(f"Populated {sum(counts.values())} rows in {time.perf_counter() - started:.1f}s")
+    recorder = Recorder(repeat, log)
+
+    def sample_user(role: str) -> User:
+        with connection() as conn:
+            row = conn.execute(
+                "SELECT id, role, region FROM users WHERE role = ? ORDER BY id LIMIT 1", (role,)
+            ).fetchone()
+        return User(id=row['id'], role=row['role'], region=row['region']) if row else None
+
+    # find_records
+    for role in ('national', 'statal', 'municipal', 'facilitator', 'shadower'):
+        user = sample_user(role)
+        if user is None:
+            continue
+        for table in ('meetings', 'users', 'signups', 'invitations'):
+            recorder.measure(f"find_records.{table}.{role}", lambda i: len(find_records(table, user)))
+
+    # gather_changed_records
+    peer = peer_profile(None)
+    recorder.measure("gather_changed_records.full", lambda i: sum(1 for _ in gather_changed_records(0, profile=peer)))
+    week_ago = int(time.time()) - 7 * 24 * 60 * 60
+    recorder.measure("gather_changed_records.week",
+                     lambda i: sum(1 for _ in gather_changed_records(week_ago, profile=peer)))
+
+    # send_cta
+    sender = sample_user('municipal') or sample_user('facilitator')
+    manager = CtaManager(CtaDispatcher(transport=FileSinkTransport(DATA_DIR / "benchmark_outbox.jsonl"),
+                                       rate_limiter=DomainRateLimiter(default_rate=0)))
+
+    def send(i):
+        campaign_id = manager.send_cta(sender, f"Benchmark {i}", "Benchmark body", "https://example.com/bench")
+        with connection() as conn:
+            return conn.execute("SELECT sent FROM cta_campaigns WHERE id = ?", (campaign_id,)).fetchone()['sent']
+    recorder.measure("send_cta", send)
+    manager.dispatcher.close()
+
+    # track_click: every repetition clicks fresh tokens, then the same ones again from the cache
+    clicks = 1000
+    with connection() as conn:
+        tokens = [row['token'] for row in conn.execute(
+            "SELECT token FROM email_log WHERE responded_at IS NULL ORDER BY id LIMIT ?", (clicks * recorder.repeat,)
+        )]
+    # Synthetic email_log rows were never dispatched, so their links start out uncached
+    batches = [tokens[start:start + clicks] for start in range(0, len(tokens), clicks)]
+    recorder.measure("track_click.cold", lambda i: sum(manager.track_click(t) is not None for t in batches[i]),
+                     repeat=len(batches))
+    recorder.measure("track_click.warm", lambda i: sum(manager.track_click(t) is not None for t in batches[i]),
+                     repeat=len(batches))
+    buffer = get_click_buffer()
+    recorder.measure("track_click.flush", lambda i: buffer.flush(), repeat=1)
+
+    # merge_records: batches of new meetings, then newer copies of existing ones
+    batch = 5000
+    with connection() as conn:
+        top = conn.execute("SELECT coalesce(max(id), 0) FROM meetings").fetchone()[0]
+        existing = [dict(row) for row in conn.execute(
+            "SELECT id, host_id, city, state, scheduled_at, title, notes FROM meetings ORDER BY id LIMIT ?", (batch,)
+        )]
+
+    def inserts(i):
+        records = [{'id': top + i * batch + n + 1, 'host_id': 1, 'city': 'nyc', 'state': 'ny',
+                    'title': f"Merged {n}", 'last_modified': '2030-01-01 00:00:00'} for n in range(batch)]
+        return merge_records(records, 'meetings')['inserted']
+
+    def updates(i):
+        stamp = f"2031-01-01 00:00:{i:02d}"
+        records = [{**row, 'title': f"{row['title']} v{i}", 'last_modified': stamp} for row in existing]
+        return merge_records(records, 'meetings')['updated']
+    def deltas(i):
+        # Field-level deltas as sync now sends them (models.field_versions)
+        stamp = f"2031-06-01 00:00:{i:02d}"
+        records = [{'id': row['id'], 'last_modified': stamp, 'title': f"{row['title']} d{i}",
+                    '_v': {'title': stamp}, '_full': 0} for row in existing]
+        return merge_records(records, 'meetings')['updated']
+    recorder.measure("merge_records.insert", inserts)
+    recorder.measure("merge_records.update", updates)
+    recorder.measure("merge_records.delta", deltas)
+
+    # initiate_sync and /sync, against this node's own server
+    base_url = _start_server()
+    keyring = get_keyring()
+    PeerManager().add_peer(Peer(email="self@benchmark", public_key=keyring.public_key_hex, address=base_url))
+    me = User(id=1, role='national', region=None)
+
+    def sync(i):
+        if not initiate_sync(me, Peer(email="self@benchmark", public_key=keyring.public_key_hex,
+                                      address=base_url, last_synced=week_ago)):
+            raise RuntimeError("initiate_sync failed")
+    recorder.measure("initiate_sync.week", sync,
+                     items=sum(1 for _ in gather_changed_records(week_ago, profile=peer)))
+
+    import requests
+    streams = [
+        b"".join(encode_sync_stream(keyring, keyring.public_key_hex, 1, [
+            ('meetings', {**row, 'title': f"{row['title']} sync", 'last_modified': f"2032-01-01 00:00:{i:02d}"})
+            for row in existing
+        ]))
+        for i in range(recorder.repeat)
+    ]
+    session = requests.Session()
+
+    def receive(i):
+        response = session.post(f"{base_url}/sync", data=streams[i], headers={"Content-Type": "application/octet-stream"})
+        response.raise_for_status()
+        return sum(response.json()['summary'].values())
+    recorder.measure("sync_endpoint", receive)
+
+    return {"populated": counts, "results": recorder.results}
+
+
+def compare(new: dict, old: dict, threshold: float, log) -> bool:
+    """Prints the change of each median against `old`; returns False if any regressed beyond `threshold` percent."""
+    ok = True
+    log(f"\n{'benchmark':<42} {'before ms':>12} {'after ms':>12} {'change':>9}")
+    for name, result in new["results"].items():
+        previous = old.get("results", {}).get(name)
+        if previous is None:
+            log(f"{name:<42} {'-':>12} {result['median_ms']:12.2f} {'new':>9}")
+            continue
+        change = (result['median_ms'] - previous['median_ms']) / previous['median_ms'] * 100 if previous['median_ms'] else 0.0
+        flag = ""
+        if change > threshold:
+            flag, ok = "  SLOWER", False
+        elif change < -threshold:
+            flag = "  faster"
+        log(f"{name:<42} {previous['median_ms']:12.2f} {result['median_ms']:12.2f} {change:+8.1f}%{flag}")
+    return ok
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths against seeded synthetic data.")
+    parser.add_argument("--rows", type=int, default=100000, help="approximate synthetic rows (default 100000)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--out", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="an earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=10.0, help="percent slowdown reported as a regression")
+    parser.add_argument("--workdir", help="scratch directory for the benchmark node (default: a temporary one)")
+    parser.add_argument("--verbose", action="store_true", help="keep the application's own output")
+    args = parser.parse_args(argv)
+
+    stdout = sys.stdout
+
+    def log(line: str):
+        print(line, file=stdout, flush=True)
+
+    with contextlib.ExitStack() as stack:
+        workdir = Path(args.workdir) if args.workdir else Path(stack.enter_context(tempfile.TemporaryDirectory()))
+        _isolate(workdir)
+        if not args.verbose:
+            stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, "w"))))
+        log(f"Benchmarking {args.rows} rows (seed {args.seed}, {args.repeat} runs each) in {workdir}")
+        outcome = run_benchmarks(args.rows, args.seed, args.repeat, log)
+
+    report = {
+        "format": RESULTS_FORMAT,
+        "meta": {
+            "rows": args.rows, "seed": args.seed, "repeat": args.repeat, "commit": _git_commit(),
+            "timestamp": int(time.time()), "python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(), "cpus": os.cpu_count(),
+        },
+        **outcome,
+    }
+    if args.out:
+        Path(args.out).write_text(json.dumps(report, indent=2, sort_keys=True) + "\n")
+        log(f"Results written to {args.out}")
+    if args.compare:
+        previous = json.loads(Path(args.compare).read_text())
+        if previous.get("meta", {}).get("rows") != args.rows:
+            log(f"Note: {args.compare} was measured with {previous.get('meta', {}).get('rows')} rows")
+        if not compare(report, previous, args.threshold, log):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
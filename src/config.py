@@ -1,13 +1,16 @@
+import os
 from pathlib import Path
 
 # The root directory of the entire project
 PROJECT_ROOT = Path(__file__).parent
 
-# Define paths for all our specialized directories relative to the project root
+# Define paths for all our specialized directories relative to the project root.
+# The config, data and keys directories can be moved with environment variables,
+# e.g. to run benchmarks (benchmark.py) or a second local node against scratch copies.
 ACL_DIR = PROJECT_ROOT / "acl"
-CONFIG_DIR = PROJECT_ROOT / "config"
-DATA_DIR = PROJECT_ROOT / "data"
-KEYS_DIR = PROJECT_ROOT / "keys"
+CONFIG_DIR = Path(os.environ.get("SPANNING_TREE_CONFIG_DIR", PROJECT_ROOT / "config"))
+DATA_DIR = Path(os.environ.get("SPANNING_TREE_DATA_DIR", PROJECT_ROOT / "data"))
+KEYS_DIR = Path(os.environ.get("SPANNING_TREE_KEYS_DIR", PROJECT_ROOT / "keys"))
 MODELS_DIR = PROJECT_ROOT / "models"
 CORE_DIR = PROJECT_ROOT / "core"
 UTILS_DIR = PROJECT_ROOT / "utils"
@@ -16,3 +19,89 @@ UTILS_DIR = PROJECT_ROOT / "utils"
 DB_PATH = DATA_DIR / "spanning_tree.db"
 PRIVATE_KEY_PATH = KEYS_DIR / "id_ed25519"
 PUBLIC_KEY_PATH = KEYS_DIR / "id_ed25519.pub"
+TOKEN_KEY_PATH = KEYS_DIR / "token_hmac.key"  # Secret for signed CTA/invite tokens (utils.tokens)
+
+# CTA and invitation tokens
+# "signed": compact HMAC tokens carrying the row id and an expiry, checked in
+#           memory before any database access (see utils.tokens).
+# "random": opaque random strings looked up by value.
+# Tokens of either format are accepted whatever this is set to. Invitations
+# are synced, but TOKEN_KEY_PATH is created per node, so only use "signed"
+# once every peer holds the same key file; an invite signed on one node
+# can't be redeemed on a node with another key.
+TOKEN_FORMAT = "random"
+CTA_TOKEN_TTL = 60 * 60 * 24 * 30  # Seconds a CTA link stays valid
+INVITE_TOKEN_TTL = 60 * 60 * 24 * 14  # Seconds an invitation stays valid
+
+# Audit logging
+# "async": entries are queued and written in batches by a background thread
+#          (flushed on shutdown); a crash can lose the last few entries.
+# "sync":  every entry is signed and committed before log_action returns.
+AUDIT_DURABILITY = "async"
+AUDIT_QUEUE_SIZE = 10000  # Producers block when this many entries are pending
+AUDIT_BATCH_SIZE = 500  # Max entries per write transaction
+AUDIT_FLUSH_INTERVAL = 0.05  # Seconds the writer waits to fill a batch
+
+# How audit entries are signed
+# "entry": one Ed25519 signature per audit_log row.
+# "epoch": entries are grouped into epochs of up to AUDIT_EPOCH_SIZE rows; each
+#          epoch gets a Merkle tree and one signed root in audit_epochs, and
+#          any entry can be checked with an inclusion proof.
+AUDIT_SIGNING = "entry"
+AUDIT_EPOCH_SIZE = 1024
+AUDIT_EPOCH_INTERVAL = 5.0  # Seconds before a partially filled epoch is sealed
+
+# Sync fan-out (core.sync_coordinator)
+SYNC_MAX_WORKERS = 8  # Peers synced concurrently
+SYNC_CONNECT_TIMEOUT = 5  # Seconds to establish a connection to a peer
+SYNC_READ_TIMEOUT = 60  # Seconds to wait for a peer's response once the stream is sent
+SYNC_SPOOL_MAX_BYTES = 8 * 1024 * 1024  # A shared signed change set beyond this is kept on disk
+# Chunk encoding sent to peers: "binary" (utils.codec, protocol version 2) or
+# "json" (version 1, for peers that predate the binary codec). Receivers accept both.
+SYNC_ENCODING = "binary"
+# Compression methods in order of preference (see utils.compression); each peer
+# gets the first one it advertises. "zlib+dict" needs the same dictionary file on both sides.
+SYNC_COMPRESSION = ("zlib+dict", "zlib", "lzma", "none")
+SYNC_COMPRESSION_LEVEL = 6  # zlib level, 1 (fast) to 9 (small)
+SYNC_DICTIONARY_PATH = CONFIG_DIR / "sync_dictionary.bin"  # Written by `python -m utils.compression`
+ANTI_ENTROPY_FANOUT = 32  # Range hashes compared per group at each level of a reconciliation
+
+# Local P2P server (core.server)
+SERVER_MODE = "async"  # "async" (core.async_server) or "flask" (Flask's development server)
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 5000
+SERVER_WORKERS = 4  # Threads that decrypt, verify and merge sync frames
+SERVER_MAX_SYNCS = 8  # Sync streams handled at once; further ones are refused with 503
+SERVER_READ_TIMEOUT = 30  # Seconds a request body may go without sending a byte before it is answered with 408
+SERVER_CTA_WORKERS = 2  # Threads for CTA clicks that miss the redirect cache
+
+# CTA dispatch (core.dispatch)
+CTA_LINK_BASE = "http://127.0.0.1:5000"  # Personalized links point at our /cta endpoint
+CTA_TRANSPORT = "print"  # "print" (simulate), "file" (JSON lines sink) or "smtp"
+CTA_FILE_SINK_PATH = DATA_DIR / "outbox.jsonl"
+CTA_SMTP_HOST = "127.0.0.1"
+CTA_SMTP_PORT = 1025
+CTA_FROM_ADDRESS = "organizers@spanningtree.local"
+CTA_DISPATCH_WORKERS = 16  # Concurrent delivery workers
+CTA_BATCH_SIZE = 1000  # Recipients read, logged and delivered per batch
+# Messages per second to any one recipient domain, by transport (0 = unthrottled).
+# A campaign can't finish faster than its largest domain allows: n recipients
+# in one domain take at least n / rate seconds, e.g. 200,000 at 500/s is
+# under 7 minutes. The print and file transports never reach a mail provider.
+CTA_TRANSPORT_DOMAIN_RATES = {"print": 0.0, "file": 0.0, "smtp": 500.0}
+CTA_DEFAULT_DOMAIN_RATE = 500.0  # For transports not listed above
+CTA_DOMAIN_RATES = {}  # Per-domain overrides for every transport, e.g. {"gmail.com": 100.0}
+
+# CTA click tracking (core.clicks)
+CLICK_FLUSH_INTERVAL = 0.5  # Seconds between batched writes of buffered clicks
+CLICK_BUFFER_MAX = 5000  # Buffered clicks that trigger an early flush
+REDIRECT_CACHE_SIZE = 200000  # Tokens whose redirect target is kept in memory
+
+# Engagement scoring (core.engagement)
+ENGAGEMENT_WEIGHTS = {
+    "cta_response": 1,  # First click on a CTA link
+    "attendance": 3,  # Attending a meeting
+    "invite_redeemed": 5,  # Someone signing up with your invitation
+}
+LEADERBOARD_SIZE = 100  # Users kept per region board
+LEADERBOARD_RECONCILE_INTERVAL = 300  # Seconds between full board rebuilds
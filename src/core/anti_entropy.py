@@ -0,0 +1,204 @@
+"""
+Anti-entropy reconciliation with a peer, independent of sync watermarks.
+
+For each synced table the two sides compare range hashes (models.buckets)
+top-down: the whole id space in at most ANTI_ENTROPY_FANOUT groups, then
+the groups that differ split into ANTI_ENTROPY_FANOUT smaller ones, down to
+single buckets. One /sync/buckets round trip serves a whole level. The rows
+of the buckets that still differ are then pushed over the normal /sync
+stream as whole rows with their field versions, and each column keeps the
+newer of the two copies. Two nearly identical replicas exchange a few
+kilobytes of hashes plus the rows that actually differ.
+
+Reconciliation pushes only; rows that only the peer has arrive when the peer
+reconciles with us. Bucket queries are signed by the asking node and only
+answered for known peers.
+"""
+
+import base64
+import json
+import sqlite3
+import time
+from typing import Dict, List, Optional, Tuple
+
+import requests
+from nacl.exceptions import BadSignatureError, CryptoError
+
+from config import ANTI_ENTROPY_FANOUT, SYNC_CONNECT_TIMEOUT, SYNC_READ_TIMEOUT
+from core.models import Peer, User
+from core.p2p import peer_profile
+from core.sync_protocol import SyncAuthError, SyncProtocolError, seal_stream, sign_chunks
+from models.buckets import BUCKET_SIZE, bucket_bounds, group_hashes, top_bucket
+from models.database import iter_records
+from models.field_versions import versioned_records
+from models.sync import SYNC_TABLES
+from utils.compression import negotiate, parse_accepted
+from utils.crypto import KeyRing, get_keyring
+
+# A signed bucket query older than this (seconds) is refused, so it can't be replayed later
+MAX_QUERY_AGE = 300
+
+# Ranges accepted in one bucket query
+MAX_QUERY_RANGES = 4096
+
+Range = Tuple[int, Optional[int], int]  # first bucket, last bucket (None: no limit), span
+
+
+def encode_bucket_query(keyring: KeyRing, table_name: str, ranges: List[Range]) -> bytes:
+    """A signed /sync/buckets request body asking for the group hashes of `ranges`."""
+    query = json.dumps({
+        "table": table_name,
+        "ranges": ranges,
+        "bucket_size": BUCKET_SIZE,
+        "timestamp": int(time.time()),
+    }, separators=(',', ':')).encode('utf-8')
+    return json.dumps({
+        "public_key": keyring.public_key_hex,
+        "query": base64.b64encode(keyring.signing_key.sign(query)).decode('ascii'),
+    }).encode('utf-8')
+
+
+def answer_bucket_query(body: bytes, keyring: KeyRing, is_known_peer) -> dict:
+    """
+    Server side of /sync/buckets: verifies a signed query from a peer for
+    which `is_known_peer(public_key_hex)` holds and returns, per range, the
+    non-empty groups as [group, digest, rows].
+    """
+    try:
+        request = json.loads(body)
+        public_key = request['public_key']
+        signed = base64.b64decode(request['query'], validate=True)
+    except (ValueError, KeyError, TypeError) as e:
+        raise SyncProtocolError(f"Invalid bucket query: {e}")
+    if not isinstance(public_key, str) or not is_known_peer(public_key):
+        raise SyncAuthError("Unknown peer")
+    try:
+        query = json.loads(keyring.verify_key_for(public_key).verify(signed))
+    except (BadSignatureError, CryptoError, ValueError):
+        raise SyncAuthError("Invalid signature")
+
+    try:
+        table_name, ranges = query['table'], query['ranges']
+        if abs(time.time() - query['timestamp']) > MAX_QUERY_AGE:
+            raise SyncAuthError("Bucket query has expired")
+        if query['bucket_size'] != BUCKET_SIZE:
+            raise SyncProtocolError(f"Bucket size {query['bucket_size']} does not match ours ({BUCKET_SIZE})")
+        if table_name not in SYNC_TABLES:
+            raise SyncProtocolError(f"Not a synced table: {table_name}")
+        if not isinstance(ranges, list) or len(ranges) > MAX_QUERY_RANGES:
+            raise SyncProtocolError("Too many ranges in bucket query")
+        ranges = [(int(first), None if last is None else int(last), max(int(span), 1)) for first, last, span in ranges]
+    except (KeyError, TypeError, ValueError) as e:
+        raise SyncProtocolError(f"Invalid bucket query: {e}")
+
+    groups = group_hashes(table_name, ranges)
+    return {
+        "bucket_size": BUCKET_SIZE,
+        "groups": [[[group, digest, rows] for group, (digest, rows) in sorted(level.items())] for level in groups],
+    }
+
+
+def _differing_buckets(table_name: str, ask, fanout: int) -> List[int]:
+    """Descends the range hashes level by level; returns the local buckets that differ from the peer's."""
+    span = 1
+    while max(top_bucket(table_name), 0) // span >= fanout:
+        span *= fanout
+    level: List[Range] = [(0, None, span)]
+    differing = []
+    while level:
+        local = group_hashes(table_name, level)
+        remote = ask(table_name, level)
+        next_level = []
+        for (_, _, span), ours, theirs in zip(level, local, remote):
+            theirs = {group: (digest, rows) for group, digest, rows in theirs}
+            for group in sorted(ours.keys() | theirs.keys()):
+                if ours.get(group) == theirs.get(group):
+                    continue
+                if span == 1:
+                    # A bucket only the peer has rows in has nothing for us to send
+                    if group in ours:
+                        differing.append(group)
+                else:
+                    next_level.append((group * span, group * span + span - 1, max(span // fanout, 1)))
+        level = next_level
+    return differing
+
+
+def _bucket_records(table_name: str, buckets: List[int], profile: User):
+    """Yields (table_name, record) for the rows of `buckets`, reading runs of adjacent buckets together."""
+    table = SYNC_TABLES[table_name]
+    runs = []
+    for bucket in buckets:
+        if runs and runs[-1][1] == bucket - 1:
+            runs[-1][1] = bucket
+        else:
+            runs.append([bucket, bucket])
+    for first, last in runs:
+        rows = iter_records(
+            table.name, profile, table.columns, where="id BETWEEN ? AND ?",
+            params=(bucket_bounds(first)[0], bucket_bounds(last)[1])
+        )
+        for record in versioned_records(table.name, rows):
+            yield table.name, record
+
+
+def reconcile_peer(current_user: User, peer: Peer, session: requests.Session = None,
+                   fanout: int = ANTI_ENTROPY_FANOUT,
+                   timeout: tuple = (SYNC_CONNECT_TIMEOUT, SYNC_READ_TIMEOUT)) -> dict:
+    """
+    Brings `peer` up to date with every row of ours that it lacks or holds an
+    older copy of. Returns {status, buckets, records, hash_bytes, bytes, summary}:
+    the buckets that differed, the rows pushed, and the bytes spent on hashes
+    and on the row stream.
+    """
+    session = session or requests.Session()
+    keyring = get_keyring()
+    result = {'status': 'ok', 'buckets': 0, 'records': 0, 'hash_bytes': 0, 'bytes': 0, 'summary': None}
+    accepted = {}
+
+    def ask(table_name: str, ranges: List[Range]) -> list:
+        body = encode_bucket_query(keyring, table_name, ranges)
+        response = session.post(f"{peer.address}/sync/buckets", data=body,
+                                headers={"Content-Type": "application/json"}, timeout=timeout)
+        result['hash_bytes'] += len(body) + len(response.content)
+        accepted['methods'] = parse_accepted(response.headers.get('X-Sync-Compression'))
+        if response.status_code != 200:
+            raise SyncProtocolError(f"http {response.status_code}: {response.text[:200]}")
+        groups = response.json()['groups']
+        if len(groups) != len(ranges):
+            raise SyncProtocolError("Peer answered a different number of ranges")
+        return groups
+
+    try:
+        differing: Dict[str, List[int]] = {}
+        for table_name in SYNC_TABLES:
+            differing[table_name] = _differing_buckets(table_name, ask, fanout)
+        result['buckets'] = sum(len(buckets) for buckets in differing.values())
+        if not result['buckets']:
+            return result
+
+        profile = peer_profile(peer)
+        records = (
+            pair for table_name, buckets in differing.items() for pair in _bucket_records(table_name, buckets, profile)
+        )
+        compression = negotiate(accepted.get('methods'))
+        stats = {}
+        signed_chunks = sign_chunks(keyring.signing_key, records, compression=compression)
+        body = seal_stream(keyring, peer.public_key, current_user.id, signed_chunks, stats=stats,
+                           compression=compression)
+        response = session.post(f"{peer.address}/sync", data=body,
+                                headers={"Content-Type": "application/octet-stream"}, timeout=timeout)
+        result['records'], result['bytes'] = stats.get('records', 0), stats.get('bytes', 0)
+        if response.status_code == 200:
+            result['summary'] = response.json().get('summary')
+        else:
+            result['status'] = f"http {response.status_code}"
+    except SyncProtocolError as e:
+        result['status'] = f"error: {e}"
+    except requests.exceptions.RequestException as e:
+        result['status'] = f"unreachable: {e.__class__.__name__}"
+    except (IOError, ValueError, CryptoError) as e:
+        result['status'] = f"key error: {e}"
+    except sqlite3.Error as e:
+        result['status'] = f"database error: {e}"
+    return result
@@ -0,0 +1,407 @@
+"""
+Production server mode: the P2P endpoints on an asyncio HTTP/1.1 server.
+
+One event loop owns every connection and does only cheap work itself:
+parsing requests, reading bodies, and answering CTA clicks whose link is
+already cached (core.clicks). Everything that decrypts, verifies, decodes or
+touches SQLite runs on a bounded thread pool:
+
+- /sync frames go, one at a time per stream and in order, to the sync pool
+  (SERVER_WORKERS threads), while the loop reads the next frame off the
+  socket. At most SERVER_MAX_SYNCS streams are handled at once; further
+  ones get 503 with Retry-After instead of queueing without bound. A body
+  that stalls for SERVER_READ_TIMEOUT seconds is answered with 408 and its
+  connection closed, so a stalled peer cannot hold a slot.
+- /sync/buckets queries also run on the sync pool.
+- CTA clicks that miss the redirect cache read the database on a separate,
+  small pool (SERVER_CTA_WORKERS), so a click never waits behind a merge.
+
+Responses match the Flask routes in core.server, which remain available as
+SERVER_MODE = "flask".
+"""
+
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+from urllib.parse import unquote
+
+from nacl.exceptions import CryptoError
+
+from config import (
+    SERVER_CTA_WORKERS, SERVER_HOST, SERVER_MAX_SYNCS, SERVER_PORT, SERVER_READ_TIMEOUT, SERVER_WORKERS
+)
+from core.anti_entropy import answer_bucket_query
+from core.cta import CtaManager
+from core.peers import PeerManager
+from core.sync_protocol import FRAME_HEADER_BYTES, MAX_FRAME_BYTES, SyncProtocolError, SyncReceiver, frame_size
+from models.database import merge_records
+from utils.compression import accepted_header
+from utils.crypto import get_keyring
+
+# Longest request line or header line accepted
+MAX_LINE_BYTES = 16 * 1024
+MAX_HEADERS = 100
+
+# Largest non-streamed request body (/sync/buckets)
+MAX_BODY_BYTES = 1024 * 1024
+
+# Seconds an idle keep-alive connection is kept open
+KEEP_ALIVE_TIMEOUT = 30
+
+_REASONS = {
+    200: "OK", 302: "Found", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+    405: "Method Not Allowed", 408: "Request Timeout", 413: "Payload Too Large", 500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+
+class HttpError(Exception):
+    """A request that cannot be parsed; answered with `status` and the connection closed."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class Request:
+    def __init__(self, method: str, path: str, headers: dict, body: 'RequestBody'):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+
+
+class Response:
+    def __init__(self, status: int, body: bytes = b"", content_type: str = "text/html; charset=utf-8",
+                 headers: Optional[dict] = None, close: bool = False):
+        self.status = status
+        self.body = body
+        self.headers = {"Content-Type": content_type, **(headers or {})}
+        self.close = close
+
+
+def json_response(payload: dict, status: int = 200, close: bool = False) -> Response:
+    return Response(status, json.dumps(payload).encode('utf-8'), "application/json", close=close)
+
+
+class RequestBody:
+    """
+    A request body read from the socket on demand, sized by Content-Length
+    or sent with chunked transfer encoding. Every socket read must make
+    progress within `timeout` seconds, or HttpError 408 is raised.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, length: Optional[int], chunked: bool,
+                 timeout: float = SERVER_READ_TIMEOUT):
+        self._reader = reader
+        self._timeout = timeout
+        self._remaining = length or 0  # Bytes left in the body, or in the current chunk
+        self._chunked = chunked
+        self._done = not chunked and not length
+
+    async def _wait(self, read):
+        try:
+            return await asyncio.wait_for(read, self._timeout)
+        except asyncio.TimeoutError:
+            raise HttpError(408, f"No request body data for {self._timeout} seconds")
+
+    async def _next_chunk(self):
+        line = await self._wait(self._reader.readline())
+        try:
+            size = int(line.split(b";")[0].strip(), 16)
+        except ValueError:
+            raise HttpError(400, "Bad chunk size")
+        if size == 0:
+            # Trailers, if any, end with an empty line
+            while (await self._wait(self._reader.readline())).strip():
+                pass
+            self._done = True
+        self._remaining = size
+
+    async def read(self, size: int) -> bytes:
+        """Up to `size` bytes of the body; b"" once it is exhausted."""
+        if self._done:
+            return b""
+        if self._remaining == 0:
+            await self._next_chunk()
+            if self._done:
+                return b""
+        data = await self._wait(self._reader.read(min(size, self._remaining)))
+        if not data:
+            raise HttpError(400, "Request body is truncated")
+        self._remaining -= len(data)
+        if self._remaining == 0:
+            if self._chunked:
+                await self._wait(self._reader.readexactly(2))  # CRLF after the chunk data
+            else:
+                self._done = True
+        return data
+
+    async def read_exactly(self, size: int) -> bytes:
+        """`size` bytes, or fewer if the body ends first."""
+        parts, needed = [], size
+        while needed:
+            data = await self.read(needed)
+            if not data:
+                break
+            parts.append(data)
+            needed -= len(data)
+        return b"".join(parts)
+
+    async def read_all(self, limit: int) -> bytes:
+        data = await self.read_exactly(limit + 1)
+        if len(data) > limit:
+            raise HttpError(413, f"Request body exceeds {limit} bytes")
+        return data
+
+    async def discard(self):
+        while await self.read(64 * 1024):
+            pass
+
+
+async def read_frames(body: RequestBody, max_frame_bytes: int = MAX_FRAME_BYTES):
+    """Async counterpart of core.sync_protocol.read_frames over a request body."""
+    while True:
+        header = await body.read_exactly(FRAME_HEADER_BYTES)
+        if not header:
+            return
+        size = frame_size(header, max_frame_bytes)
+        frame = await body.read_exactly(size)
+        if len(frame) < size:
+            raise SyncProtocolError("Truncated frame body")
+        yield frame
+
+
+async def _read_request(reader: asyncio.StreamReader,
+                        read_timeout: float = SERVER_READ_TIMEOUT) -> Optional[Request]:
+    try:
+        line = await reader.readline()
+    except ValueError:
+        raise HttpError(400, "Request line too long")
+    if not line:
+        return None  # The client closed the connection
+    try:
+        method, target, version = line.decode('latin-1').split()
+    except ValueError:
+        raise HttpError(400, "Malformed request line")
+    if not version.startswith("HTTP/1."):
+        raise HttpError(400, f"Unsupported protocol {version}")
+
+    headers = {}
+    while True:
+        try:
+            line = await reader.readline()
+        except ValueError:
+            raise HttpError(400, "Header line too long")
+        if line in (b"\r\n", b"\n", b""):
+            break
+        if len(headers) >= MAX_HEADERS:
+            raise HttpError(400, "Too many headers")
+        name, _, value = line.decode('latin-1').partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    chunked = 'chunked' in headers.get('transfer-encoding', '').lower()
+    length = None
+    if not chunked and 'content-length' in headers:
+        try:
+            length = int(headers['content-length'])
+        except ValueError:
+            raise HttpError(400, "Bad Content-Length")
+        if length < 0:
+            raise HttpError(400, "Bad Content-Length")
+    if version == "HTTP/1.0" and headers.get('connection', '').lower() != 'keep-alive':
+        headers['connection'] = 'close'
+    path = unquote(target.split("?", 1)[0])
+    return Request(method.upper(), path, headers, RequestBody(reader, length, chunked, read_timeout))
+
+
+def _encode_response(response: Response, path: str) -> bytes:
+    headers = dict(response.headers)
+    if path.startswith('/sync'):
+        # Tells syncing peers which compression methods this node accepts (see utils.compression)
+        headers['X-Sync-Compression'] = accepted_header()
+    headers['Content-Length'] = str(len(response.body))
+    headers['Connection'] = 'close' if response.close else 'keep-alive'
+    head = f"HTTP/1.1 {response.status} {_REASONS.get(response.status, 'Unknown')}\r\n"
+    head += "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+    return (head + "\r\n").encode('latin-1') + response.body
+
+
+class AsyncServer:
+    """Serves /sync, /sync/buckets and /cta/<token> from one asyncio event loop."""
+
+    def __init__(self, host: str = SERVER_HOST, port: int = SERVER_PORT, workers: int = SERVER_WORKERS,
+                 max_syncs: int = SERVER_MAX_SYNCS, cta_workers: int = SERVER_CTA_WORKERS,
+                 peer_manager: Optional[PeerManager] = None, read_timeout: float = SERVER_READ_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.max_syncs = max_syncs
+        self.read_timeout = read_timeout
+        self.sync_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sync-worker")
+        self.cta_pool = ThreadPoolExecutor(max_workers=cta_workers, thread_name_prefix="cta-worker")
+        self.cta_manager = CtaManager()
+        # One registry for every request; it decides which senders may sync to us
+        self.peer_manager = peer_manager or PeerManager()
+        self.active_syncs = 0
+        self._server = None
+
+    async def _run(self, pool: ThreadPoolExecutor, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(pool, function, *args)
+
+    async def handle_sync(self, request: Request) -> Response:
+        """
+        Receives a framed sync stream (see core.sync_protocol). Each frame is
+        decrypted, verified and merged on the sync pool while the next one is
+        read; frames of one stream are still handled strictly in order. A
+        stream that stalls mid-body is answered with 408 (see RequestBody),
+        keeping the frames merged before it.
+        """
+        if self.active_syncs >= self.max_syncs:
+            print(f"--- [/sync] {self.active_syncs} streams in progress. Refusing another. ---")
+            return Response(503, b"Too many sync streams in progress", headers={"Retry-After": "5"}, close=True)
+        self.active_syncs += 1
+        try:
+            print("\n--- [/sync] Receiving sync stream... ---")
+            keyring = get_keyring()
+            try:
+                # Make sure our own key is loadable before reading the stream
+                await self._run(self.sync_pool, lambda: keyring.signing_key)
+            except (IOError, CryptoError):
+                print("--- [/sync] Could not load server key. Rejecting request. ---")
+                return json_response({"status": "error", "message": "Server key unavailable"}, 500, close=True)
+
+            # Only registered peers may sync to us; the hello is checked before any chunk is merged
+            receiver = SyncReceiver(keyring, merge_records, self.peer_manager.is_known_peer)
+            loop = asyncio.get_running_loop()
+            pending = None  # The frame being handled on the pool
+            try:
+                try:
+                    async for frame in read_frames(request.body):
+                        if pending is not None:
+                            await pending
+                        pending = loop.run_in_executor(self.sync_pool, receiver.handle_frame, frame)
+                    if pending is not None:
+                        await pending
+                finally:
+                    if pending is not None:
+                        # Even when reading fails, the frame in hand is merged before anything is answered
+                        await asyncio.gather(pending, return_exceptions=True)
+                merge_summary = receiver.finish()
+            except SyncProtocolError as e:
+                print(f"--- [/sync] {e}. Rejecting rest of stream. ---")
+                return json_response({
+                    "status": "error",
+                    "message": str(e),
+                    "summary": receiver.summary  # Chunks verified before the failure stay merged
+                }, e.status_code, close=True)
+
+            print(f"--- [/sync] Stream VERIFIED. Merged {receiver.records} records from sender {receiver.sender_id}. ---")
+            print("----------------------------------------------------\n")
+            return json_response({
+                "status": "success",
+                "message": "Data decrypted, verified, and merged",
+                "summary": merge_summary
+            })
+        finally:
+            self.active_syncs -= 1
+
+    async def handle_buckets(self, request: Request) -> Response:
+        """Answers a peer's signed anti-entropy query (see core.anti_entropy)."""
+        body = await request.body.read_all(MAX_BODY_BYTES)
+        try:
+            answer = await self._run(
+                self.sync_pool, answer_bucket_query, body, get_keyring(), self.peer_manager.is_known_peer
+            )
+        except SyncProtocolError as e:
+            print(f"--- [/sync/buckets] {e}. Rejecting query. ---")
+            return json_response({"status": "error", "message": str(e)}, e.status_code)
+        return json_response(answer)
+
+    async def handle_cta(self, token: str) -> Response:
+        """
+        Logs a CTA click and redirects to the CTA's destination. A cached link
+        is answered on the event loop; a miss is looked up on the CTA pool.
+        """
+        cta_link = self.cta_manager.track_click(token, load=False)
+        if cta_link is None:
+            cta_link = await self._run(self.cta_pool, self.cta_manager.track_click, token)
+        if cta_link is None:
+            return Response(404, b"This link is invalid or has expired.")
+        if not cta_link:
+            return Response(200, b"Thank you for your response! Your click has been recorded.")
+        return Response(302, b"", headers={"Location": cta_link})
+
+    async def dispatch(self, request: Request) -> Response:
+        path, method = request.path, request.method
+        if path.startswith('/cta/') and len(path) > len('/cta/'):
+            if method != 'GET':
+                return Response(405, b"Method Not Allowed")
+            return await self.handle_cta(path[len('/cta/'):])
+        if path in ('/sync', '/sync/buckets'):
+            if method != 'POST':
+                return Response(405, b"Method Not Allowed")
+            return await (self.handle_sync(request) if path == '/sync' else self.handle_buckets(request))
+        return Response(404, b"Not Found")
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(_read_request(reader, self.read_timeout), KEEP_ALIVE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if request is None:
+                    break
+                try:
+                    response = await self.dispatch(request)
+                    if not response.close:
+                        # Unread body bytes would be taken for the next request
+                        await request.body.discard()
+                except HttpError as e:
+                    response = Response(e.status, str(e).encode('utf-8'), close=True)
+                except Exception as e:
+                    print(f"--- [{request.path}] Internal error: {e!r} ---")
+                    response = Response(500, b"Internal Server Error", close=True)
+                if request.headers.get('connection', '').lower() == 'close':
+                    response.close = True
+                writer.write(_encode_response(response, request.path))
+                await writer.drain()
+                if response.close:
+                    break
+        except HttpError as e:
+            writer.write(_encode_response(Response(e.status, str(e).encode('utf-8'), close=True), ''))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def start(self) -> Tuple[str, int]:
+        """Starts listening; returns the bound (host, port), which tells an ephemeral port 0 apart."""
+        self._server = await asyncio.start_server(
+            self.handle_connection, self.host, self.port, limit=MAX_LINE_BYTES
+        )
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def serve_forever(self):
+        host, port = await self.start()
+        print(f"Starting local P2P server on http://{host}:{port} (asyncio, {self.workers} sync workers)...")
+        try:
+            async with self._server:
+                await self._server.serve_forever()
+        finally:
+            self.close()
+
+    def close(self):
+        self.sync_pool.shutdown(wait=True)
+        self.cta_pool.shutdown(wait=True)
+
+
+def run_async_server(host: str = SERVER_HOST, port: int = SERVER_PORT):
+    """Runs the asyncio server until the process exits; safe to call from a background thread."""
+    asyncio.run(AsyncServer(host, port).serve_forever())
@@ -1,22 +1,314 @@
+import atexit
 import json
+import queue
+import threading
 import time
 import sqlite3
-from nacl.signing import SigningKey
 from nacl.exceptions import CryptoError
-from config import PRIVATE_KEY_PATH
-from models.database import get_db_connection
+from typing import Optional
+from nacl.signing import VerifyKey
+from config import (AUDIT_DURABILITY, AUDIT_QUEUE_SIZE, AUDIT_BATCH_SIZE, AUDIT_FLUSH_INTERVAL,
+                    AUDIT_SIGNING, AUDIT_EPOCH_SIZE, AUDIT_EPOCH_INTERVAL)
+from models.connection import connection, transaction
+from utils.crypto import get_keyring
+from utils.merkle import leaf_hash, merkle_root, inclusion_proof, verify_inclusion
+
+_STOP = object()
+
+
+def canonical_encoding(obj: dict) -> bytes:
+    """The exact bytes that are signed or hashed for an audit entry or epoch."""
+    return json.dumps(obj, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+class AuditSink:
+    """
+    Write-behind audit logger.
+
+    In "async" mode entries go into a bounded in-memory queue and a background
+    thread signs and inserts them in batches, one commit per batch, so the
+    request path pays neither the Ed25519 signature nor the commit. In "sync"
+    mode each entry is written before `submit` returns. `flush()` waits until
+    everything queued so far is on disk; `close()` flushes and stops the writer
+    and runs automatically at interpreter exit.
+
+    With signing="epoch", entries are stored unsigned and sealed into epochs:
+    once AUDIT_EPOCH_SIZE entries are pending, or the oldest has waited
+    AUDIT_EPOCH_INTERVAL seconds, one Merkle root over them is signed.
+    """
+
+    def __init__(self, durability: str = AUDIT_DURABILITY, max_queue: int = AUDIT_QUEUE_SIZE,
+                 batch_size: int = AUDIT_BATCH_SIZE, flush_interval: float = AUDIT_FLUSH_INTERVAL,
+                 signing: str = AUDIT_SIGNING, epoch_size: int = AUDIT_EPOCH_SIZE,
+                 epoch_interval: float = AUDIT_EPOCH_INTERVAL):
+        if durability not in ("async", "sync"):
+            raise ValueError(f"Unknown audit durability mode: {durability}")
+        if signing not in ("entry", "epoch"):
+            raise ValueError(f"Unknown audit signing mode: {signing}")
+        self.durability = durability
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.signing = signing
+        self.epoch_size = epoch_size
+        self.epoch_interval = epoch_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._seal_lock = threading.Lock()
+        self._closed = False
+        self._atexit_registered = False
+        self._unsealed = 0
+        self._unsealed_since = None
+
+    def _ensure_writer(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+                    self._thread.start()
+                    self._register_atexit()
+
+    def _register_atexit(self):
+        if not self._atexit_registered:
+            self._atexit_registered = True
+            atexit.register(self.close)
+
+    def submit(self, entry: dict):
+        """Records one audit entry (action, performed_by, entity, record_id, timestamp)."""
+        if self.durability == "sync" or self._closed:
+            self._register_atexit()
+            self._write_batch([entry])
+            self._maybe_seal()
+            return
+        self._ensure_writer()
+        # Blocks when the queue is full, which pushes back on producers
+        # instead of growing memory without bound.
+        self._queue.put(entry)
+
+    def flush(self):
+        """Blocks until every entry submitted so far has been written."""
+        if self._thread is not None:
+            self._queue.join()
+
+    def close(self):
+        """Flushes pending entries and stops the writer thread."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join()
+        if self.signing == "epoch":
+            while self.seal_epoch() is not None:
+                pass
+
+    def _run(self):
+        while True:
+            try:
+                # Wake up while entries wait to be sealed, so a quiet period
+                # doesn't leave the last epoch unsigned.
+                timeout = self.epoch_interval if self._unsealed else None
+                entry = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                self._maybe_seal()
+                continue
+            batch = [entry]
+            # Give concurrent producers a moment to fill the batch
+            deadline = time.monotonic() + self.flush_interval
+            while entry is not _STOP and len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    entry = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(entry)
+
+            stopping = batch[-1] is _STOP
+            entries = [e for e in batch if e is not _STOP]
+            try:
+                if entries:
+                    self._write_batch(entries)
+                    self._maybe_seal()
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if stopping:
+                return
+
+    def _write_batch(self, entries: list):
+        signing_key = None
+        if self.signing == "entry":
+            try:
+                signing_key = get_keyring().signing_key
+            except (IOError, CryptoError) as e:
+                print(f"Error: Could not load private key. Cannot sign {len(entries)} audit entries. {e}")
+                return
+
+        rows = []
+        for entry in entries:
+            payload = canonical_encoding(entry)
+            # In epoch mode the row is covered by its epoch's signed root instead
+            signature_hex = signing_key.sign(payload).signature.hex() if signing_key else None
+            rows.append((entry["action"], entry["performed_by"], entry["entity"],
+                         entry["record_id"], entry["timestamp"], signature_hex, payload.decode('utf-8')))
+
+        try:
+            with transaction() as conn:
+                conn.executemany(
+                    "INSERT INTO audit_log (action, performed_by, entity, record_id, timestamp, signature, payload) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+        except sqlite3.Error as e:
+            print(f"Database error while logging {len(rows)} audit entries: {e}")
+            return
+
+        if self.signing == "epoch":
+            with self._seal_lock:
+                if not self._unsealed:
+                    self._unsealed_since = time.monotonic()
+                self._unsealed += len(rows)
+
+    def _maybe_seal(self):
+        if self.signing != "epoch" or not self._unsealed:
+            return
+        while self._unsealed >= self.epoch_size:
+            if self.seal_epoch() is None:
+                break
+        if self._unsealed and time.monotonic() - self._unsealed_since >= self.epoch_interval:
+            self.seal_epoch()
+
+    def seal_epoch(self) -> Optional[int]:
+        """
+        Seals up to `epoch_size` unsealed entries (oldest first) into a new
+        epoch: builds the Merkle tree over their canonical encodings, signs the
+        root (chained to the previous epoch's root) and records each entry's
+        leaf position. Returns the epoch id, or None if nothing was pending.
+        """
+        with self._seal_lock:
+            try:
+                signing_key = get_keyring().signing_key
+            except (IOError, CryptoError) as e:
+                print(f"Error: Could not load private key. Cannot seal audit epoch. {e}")
+                return None
+            try:
+                with transaction() as conn:
+                    rows = conn.execute(
+                        "SELECT id, payload FROM audit_log "
+                        "WHERE epoch_id IS NULL AND signature IS NULL AND payload IS NOT NULL "
+                        "ORDER BY id LIMIT ?",
+                        (self.epoch_size,)
+                    ).fetchall()
+                    if not rows:
+                        self._unsealed = 0
+                        return None
+
+                    leaves = [leaf_hash(row['payload'].encode('utf-8')) for row in rows]
+                    previous = conn.execute("SELECT root FROM audit_epochs ORDER BY id DESC LIMIT 1").fetchone()
+                    header = {
+                        "root": merkle_root(leaves).hex(),
+                        "prev_root": previous['root'] if previous else None,
+                        "size": len(rows),
+                        "first_entry_id": rows[0]['id'],
+                        "last_entry_id": rows[-1]['id'],
+                    }
+                    signature_hex = signing_key.sign(canonical_encoding(header)).signature.hex()
+                    cursor = conn.execute(
+                        "INSERT INTO audit_epochs (root, prev_root, size, first_entry_id, last_entry_id, signature) VALUES (?, ?, ?, ?, ?, ?)",
+                        (header["root"], header["prev_root"], header["size"],
+                         header["first_entry_id"], header["last_entry_id"], signature_hex)
+                    )
+                    epoch_id = cursor.lastrowid
+                    conn.executemany(
+                        "UPDATE audit_log SET epoch_id = ?, leaf_index = ? WHERE id = ?",
+                        [(epoch_id, index, row['id']) for index, row in enumerate(rows)]
+                    )
+            except sqlite3.Error as e:
+                print(f"Database error while sealing audit epoch: {e}")
+                return None
+
+            self._unsealed = max(0, self._unsealed - len(rows))
+            if self._unsealed:
+                self._unsealed_since = time.monotonic()
+            return epoch_id
+
+
+def get_inclusion_proof(entry_id: int) -> Optional[dict]:
+    """
+    Returns a self-contained proof that an audit entry belongs to its signed
+    epoch: the entry's canonical payload, its leaf index, the O(log n) audit
+    path and the signed epoch header. None if the entry isn't sealed yet.
+    """
+    with connection() as conn:
+        entry = conn.execute(
+            "SELECT id, payload, epoch_id, leaf_index FROM audit_log WHERE id = ?", (entry_id,)
+        ).fetchone()
+        if entry is None or entry['epoch_id'] is None:
+            return None
+        epoch = conn.execute("SELECT * FROM audit_epochs WHERE id = ?", (entry['epoch_id'],)).fetchone()
+        payloads = conn.execute(
+            "SELECT payload FROM audit_log WHERE epoch_id = ? ORDER BY leaf_index", (entry['epoch_id'],)
+        ).fetchall()
+
+    leaves = [leaf_hash(row['payload'].encode('utf-8')) for row in payloads]
+    return {
+        "entry_id": entry['id'],
+        "payload": entry['payload'],
+        "leaf_index": entry['leaf_index'],
+        "path": [node.hex() for node in inclusion_proof(leaves, entry['leaf_index'])],
+        "epoch": {
+            "root": epoch['root'],
+            "prev_root": epoch['prev_root'],
+            "size": epoch['size'],
+            "first_entry_id": epoch['first_entry_id'],
+            "last_entry_id": epoch['last_entry_id'],
+        },
+        "signature": epoch['signature'],
+    }
+
+
+def verify_inclusion_proof(proof: dict, public_key_hex: str) -> bool:
+    """Checks a proof from get_inclusion_proof against the signer's public key."""
+    try:
+        VerifyKey(bytes.fromhex(public_key_hex)).verify(
+            canonical_encoding(proof["epoch"]), bytes.fromhex(proof["signature"])
+        )
+        return verify_inclusion(
+            leaf_hash(proof["payload"].encode('utf-8')),
+            proof["leaf_index"],
+            proof["epoch"]["size"],
+            [bytes.fromhex(node) for node in proof["path"]],
+            bytes.fromhex(proof["epoch"]["root"]),
+        )
+    except (CryptoError, KeyError, TypeError, ValueError):
+        return False
+
+
+_sink = None
+_sink_lock = threading.Lock()
+
+
+def get_audit_sink() -> AuditSink:
+    """Returns the process-wide audit sink."""
+    global _sink
+    if _sink is None:
+        with _sink_lock:
+            if _sink is None:
+                _sink = AuditSink()
+    return _sink
+
 
 def log_action(action: str, performed_by: int, entity: str, record_id: int):
-    """Creates a signed audit log for a specific action."""
+    """
+    Creates a signed audit log for a specific action. With the default "async"
+    durability the entry is signed and written shortly afterwards by the
+    audit writer thread; see AuditSink.
+    """
     print(f"Logging action: {action} on {entity} (ID: {record_id}) by user {performed_by}")
-    
-    try:
-        with open(PRIVATE_KEY_PATH, "rb") as f:
-            signing_key = SigningKey(f.read())
-    except (IOError, CryptoError) as e:
-        print(f"Error: Could not load private key. Cannot sign action. {e}")
-        return
 
+    # The signature covers the canonical (sorted-key) encoding, so key order here doesn't matter
     payload = {
         "action": action,
         "performed_by": performed_by,
@@ -24,21 +316,4 @@ def log_action(action: str, performed_by: int, entity: str, record_id: int):
         "record_id": record_id,
         "timestamp": int(time.time())
     }
-    payload_json = json.dumps(payload, separators=(',', ':')).encode('utf-8')
-
-    signed = signing_key.sign(payload_json)
-    signature_hex = signed.signature.hex()
-
-    conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO audit_log (action, performed_by, entity, record_id, timestamp, signature) VALUES (?, ?, ?, ?, ?, ?)",
-            (action, performed_by, entity, record_id, payload["timestamp"], signature_hex)
-        )
-        conn.commit()
-        print("Action successfully logged and signed.")
-    except sqlite3.Error as e:
-        print(f"Database error while logging action: {e}")
-    finally:
-        conn.close()
+    get_audit_sink().submit(payload)
@@ -0,0 +1,205 @@
+"""
+Fast path for CTA link clicks.
+
+A click is answered from memory: the redirect target comes from an LRU
+cache of token -> cta_link (warmed as campaigns are dispatched), and the
+click itself goes into a write-behind buffer that a background thread
+flushes with one batched UPDATE every CLICK_FLUSH_INTERVAL seconds. A burst
+of clicks after a mass send therefore costs one write transaction per
+interval instead of one per click. The same transaction credits each first
+response to the recipient's CC score (core.engagement).
+"""
+
+import atexit
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, Optional, Tuple
+
+from config import CLICK_FLUSH_INTERVAL, CLICK_BUFFER_MAX, REDIRECT_CACHE_SIZE, ENGAGEMENT_WEIGHTS
+from core.engagement import apply_deltas
+from models.connection import connection, transaction
+from utils.tokens import KIND_CTA, InvalidTokenError, is_signed_token, verify_token
+
+
+class RedirectCache:
+    """Thread-safe LRU map from CTA token to its destination link."""
+
+    def __init__(self, max_size: int = REDIRECT_CACHE_SIZE):
+        self.max_size = max_size
+        self._links = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put_many(self, pairs: Iterable[Tuple[str, str]]):
+        """Caches (token, cta_link) pairs, evicting the least recently used."""
+        with self._lock:
+            for token, link in pairs:
+                self._links[token] = link
+                self._links.move_to_end(token)
+            while len(self._links) > self.max_size:
+                self._links.popitem(last=False)
+
+    def get(self, token: str, load: bool = True) -> Optional[str]:
+        """
+        Returns the link for `token`, reading it from email_log on a miss; None
+        if unknown. Signed tokens are checked first and invalid ones rejected
+        without touching the database; valid ones are looked up by row id.
+        With `load=False` a miss returns None without reading the database.
+        """
+        row_id = None
+        if is_signed_token(token):
+            try:
+                row_id = verify_token(token, KIND_CTA)
+            except InvalidTokenError as e:
+                print(f"Rejected CTA token: {e}")
+                return None
+        with self._lock:
+            link = self._links.get(token)
+            if link is not None:
+                self._links.move_to_end(token)
+                return link
+        if not load:
+            return None
+        with connection() as conn:
+            if row_id is not None:
+                row = conn.execute(
+                    "SELECT cta_link FROM email_log WHERE id = ? AND token = ?", (row_id, token)
+                ).fetchone()
+            else:
+                row = conn.execute("SELECT cta_link FROM email_log WHERE token = ?", (token,)).fetchone()
+        if row is None:
+            return None
+        link = row['cta_link'] or ""
+        self.put_many([(token, link)])
+        return link
+
+
+class ClickBuffer:
+    """
+    Write-behind buffer of CTA clicks. Only the first click per token is
+    kept, matching the `responded_at IS NULL` guard in the UPDATE. `close()`
+    flushes what is left and runs automatically at interpreter exit.
+    """
+
+    def __init__(self, flush_interval: float = CLICK_FLUSH_INTERVAL, max_pending: int = CLICK_BUFFER_MAX):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending = {}  # token -> click timestamp
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._closed = False
+
+    def _ensure_flusher(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="click-flusher", daemon=True)
+                    self._thread.start()
+                    atexit.register(self.close)
+
+    def record(self, token: str, timestamp: Optional[int] = None):
+        """Queues a click; it reaches the database on the next flush."""
+        if self._closed:
+            self._write({token: timestamp or int(time.time())})
+            return
+        self._ensure_flusher()
+        with self._lock:
+            self._pending.setdefault(token, timestamp or int(time.time()))
+            full = len(self._pending) >= self.max_pending
+        if full:
+            self._wake.set()
+
+    def flush(self) -> int:
+        """Writes every buffered click now; returns the number of rows updated."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            return self._write(pending)
+
+    def close(self):
+        """Stops the flusher thread and writes the remaining clicks."""
+        self._closed = True
+        if self._thread is not None:
+            self._wake.set()
+            self._thread.join()
+        self.flush()
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def _write(self, pending: dict) -> int:
+        if not pending:
+            return 0
+        # Signed tokens name their row, so most clicks are resolved by primary key
+        by_id, by_token = {}, []
+        for token, timestamp in pending.items():
+            if not is_signed_token(token):
+                by_token.append(token)
+                continue
+            try:
+                by_id[verify_token(token, KIND_CTA, now=timestamp)] = token
+            except InvalidTokenError:
+                continue
+        try:
+            with transaction() as conn:
+                # Rows not responded to yet: these are updated and earn engagement points
+                fresh = []
+                for start in range(0, max(len(by_id), len(by_token)), 500):
+                    ids = list(by_id)[start:start + 500]
+                    if ids:
+                        rows = conn.execute(
+                            "SELECT id, token, recipient_id FROM email_log "
+                            f"WHERE id IN ({', '.join('?' for _ in ids)}) AND responded_at IS NULL",
+                            ids
+                        )
+                        fresh += [row for row in rows if by_id[row['id']] == row['token']]
+                    tokens = by_token[start:start + 500]
+                    if tokens:
+                        fresh += conn.execute(
+                            "SELECT id, token, recipient_id FROM email_log "
+                            f"WHERE token IN ({', '.join('?' for _ in tokens)}) AND responded_at IS NULL",
+                            tokens
+                        ).fetchall()
+                conn.executemany(
+                    "UPDATE email_log SET responded_at = ? WHERE id = ?",
+                    [(pending[row['token']], row['id']) for row in fresh]
+                )
+                deltas = {}
+                for row in fresh:
+                    deltas[row['recipient_id']] = deltas.get(row['recipient_id'], 0) + ENGAGEMENT_WEIGHTS['cta_response']
+                apply_deltas(conn, deltas)
+                return len(fresh)
+        except sqlite3.Error as e:
+            print(f"Database error while recording {len(pending)} CTA clicks: {e}")
+            return 0
+
+
+_redirect_cache = None
+_click_buffer = None
+_singleton_lock = threading.Lock()
+
+
+def get_redirect_cache() -> RedirectCache:
+    """Returns the process-wide RedirectCache."""
+    global _redirect_cache
+    if _redirect_cache is None:
+        with _singleton_lock:
+            if _redirect_cache is None:
+                _redirect_cache = RedirectCache()
+    return _redirect_cache
+
+
+def get_click_buffer() -> ClickBuffer:
+    """Returns the process-wide ClickBuffer."""
+    global _click_buffer
+    if _click_buffer is None:
+        with _singleton_lock:
+            if _click_buffer is None:
+                _click_buffer = ClickBuffer()
+    return _click_buffer
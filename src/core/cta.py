@@ -1,17 +1,29 @@
-import secrets
 import sqlite3
-import time
-from typing import List
+from typing import Optional
 
+from core.clicks import get_click_buffer, get_redirect_cache
+from core.dispatch import CtaDispatcher
 from core.models import User
-from models.database import get_db_connection, find_records
 
 class CtaManager:
     """Handles the logic for sending and tracking Calls to Action (CTAs)."""
 
-    def send_cta(self, sender: User, subject: str, body: str, cta_link: str):
+    def __init__(self, dispatcher: Optional[CtaDispatcher] = None):
+        self._dispatcher = dispatcher
+        # A dispatcher passed in belongs to the caller; one created here is closed after each campaign
+        self._owns_dispatcher = dispatcher is None
+
+    @property
+    def dispatcher(self) -> CtaDispatcher:
+        # Created on first send so that merely tracking clicks never opens a mail transport
+        if self._dispatcher is None:
+            self._dispatcher = CtaDispatcher()
+        return self._dispatcher
+
+    def send_cta(self, sender: User, subject: str, body: str, cta_link: str) -> Optional[int]:
         """
         Sends a CTA to all users the sender is allowed to see.
+        Returns the campaign id, which `resume_cta` accepts if dispatch is interrupted.
         """
         print(f"\nUser '{sender.id}' is sending a new CTA: '{subject}'")
 
@@ -21,54 +33,54 @@ class CtaManager:
             print("Permission Denied: User cannot send mass CTAs.")
             return
 
-        # 2. Get Recipients using our existing ACL-filtered function
+        # 2. Stream ACL-filtered recipients through the batched dispatch pipeline.
         # A full implementation would allow for more specific filters.
-        recipients = find_records('users', sender)
-        print(f"Found {len(recipients)} recipients based on ACLs.")
-
-        conn = get_db_connection()
         try:
-            for recipient in recipients:
-                # 3. For each recipient, generate a unique token and log it
-                token = secrets.token_urlsafe(16)
-                recipient_id = recipient['id']
-
-                conn.execute(
-                    "INSERT INTO email_log (sender_id, recipient_id, subject, cta_link, token) VALUES (?, ?, ?, ?, ?)",
-                    (sender.id, recipient_id, subject, cta_link, token)
-                )
-
-                # 4. Simulate sending the email
-                # The personalized link points back to our server's tracking endpoint
-                personalized_link = f"http://127.0.0.1:5000/cta/{token}"
-                print(f"  -> SIMULATING EMAIL to user {recipient_id}: {body}. Click here: {personalized_link}")
-            
-            conn.commit()
+            campaign_id = self.dispatcher.create_campaign(sender, subject, body, cta_link)
+            return self._run(campaign_id, sender)
         except sqlite3.Error as e:
             print(f"Database error while sending CTA: {e}")
         finally:
-            conn.close()
+            self._release()
+
+    def resume_cta(self, campaign_id: int, sender: User) -> Optional[int]:
+        """Finishes a campaign whose dispatch was interrupted."""
+        try:
+            return self._run(campaign_id, sender)
+        except sqlite3.Error as e:
+            print(f"Database error while resuming CTA: {e}")
+        finally:
+            self._release()
+
+    def _release(self):
+        """Closes a dispatcher created here, with its SMTP connections or sink file, until the next send."""
+        if self._owns_dispatcher and self._dispatcher is not None:
+            self._dispatcher.close()
+            self._dispatcher = None
+
+    def _run(self, campaign_id: int, sender: User) -> int:
+        progress = self.dispatcher.run(campaign_id, sender)
+        print(f"Campaign {campaign_id}: {progress['sent']} of {progress['queued']} emails sent, "
+              f"{progress['failed']} failed.")
+        return campaign_id
 
-    def track_click(self, token: str):
+    def track_click(self, token: str, load: bool = True) -> Optional[str]:
         """
         Tracks a click on a CTA link, marking it as responded.
+        Returns the CTA's destination link, or None if the token is unknown.
+        The click is buffered and written with the next batch (see core.clicks).
+        With `load=False` only cached links are tracked and a miss returns None
+        without reading the database, so the call never blocks on SQLite.
         """
+        cta_link = get_redirect_cache().get(token, load=load)
+        if cta_link is None:
+            if load:
+                print(f"\n--- [/cta] Tracking click for token: {token} ---")
+                print("Warning: Could not track click. Token not found.")
+            return None
         print(f"\n--- [/cta] Tracking click for token: {token} ---")
-        conn = get_db_connection()
-        cursor = conn.cursor()
 
-        # Find the log entry and update it if it exists and hasn't been used
-        cursor.execute(
-            "UPDATE email_log SET responded_at = ? WHERE token = ? AND responded_at IS NULL",
-            (int(time.time()), token)
-        )
-        
-        # cursor.rowcount will be 1 if a row was updated, 0 otherwise
-        if cursor.rowcount > 0:
-            print("Successfully tracked CTA click.")
-            # TODO: A full implementation would also update the user's CC score here.
-        else:
-            print("Warning: Could not track click. Token not found or already used.")
-            
-        conn.commit()
-        conn.close()
+        # Repeat clicks are ignored when the buffer is flushed (responded_at is already set)
+        get_click_buffer().record(token)
+        # The flush also credits the recipient's CC score (ClickBuffer._write in core.clicks)
+        return cta_link
@@ -0,0 +1,323 @@
+"""
+CTA dispatch pipeline.
+
+A campaign is dispatched in batches of CTA_BATCH_SIZE recipients:
+
+1. The next page of recipients is read from the ACL-filtered users table
+   by keyset (id > last_recipient_id), so the full list is never in memory.
+2. Their tokens are logged, and the campaign's progress is advanced in the
+   same transaction.
+3. The batch is delivered by a pool of workers through a pluggable
+   MailTransport, throttled per recipient domain at the transport's rate
+   (CTA_TRANSPORT_DOMAIN_RATES), so a campaign takes at least as many seconds
+   as its largest domain has recipients divided by that rate. Delivery
+   failures are recorded per message and never abort the campaign.
+4. Delivery outcomes are written back in one executemany.
+
+Because progress is committed with the tokens, an interrupted campaign can
+be resumed: messages still marked 'pending' are re-delivered first, then
+dispatch continues after the last logged recipient.
+"""
+
+import json
+import secrets
+import smtplib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict
+from email.message import EmailMessage
+from pathlib import Path
+from typing import Optional
+
+from config import (CTA_LINK_BASE, CTA_TRANSPORT, CTA_FILE_SINK_PATH, CTA_SMTP_HOST, CTA_SMTP_PORT,
+                    CTA_FROM_ADDRESS, CTA_DISPATCH_WORKERS, CTA_BATCH_SIZE,
+                    CTA_TRANSPORT_DOMAIN_RATES, CTA_DEFAULT_DOMAIN_RATE, CTA_DOMAIN_RATES,
+                    TOKEN_FORMAT, CTA_TOKEN_TTL)
+from acl.permissions import get_acl_filter_clause
+from core.clicks import get_redirect_cache
+from core.models import User
+from models.connection import connection, transaction
+from utils.tokens import KIND_CTA, issue_token
+
+
+@dataclass
+class OutgoingEmail:
+    """One personalized CTA message."""
+    log_id: int  # email_log row
+    recipient_id: int
+    to_address: str
+    subject: str
+    body: str
+    link: str
+    token: str
+
+
+class MailTransport:
+    """Interface for delivering CTA emails. `send` raises on failure."""
+
+    kind = None  # Key into CTA_TRANSPORT_DOMAIN_RATES
+
+    def send(self, message: OutgoingEmail):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class PrintTransport(MailTransport):
+    """Simulates delivery by printing each message (the original demo behaviour)."""
+
+    kind = "print"
+
+    def send(self, message: OutgoingEmail):
+        print(f"  -> SIMULATING EMAIL to user {message.recipient_id}: {message.body}. Click here: {message.link}")
+
+
+class FileSinkTransport(MailTransport):
+    """Appends each message as a JSON line to a file, e.g. for a separate mailer to pick up."""
+
+    kind = "file"
+
+    def __init__(self, path: Path = CTA_FILE_SINK_PATH):
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8")
+
+    def send(self, message: OutgoingEmail):
+        line = json.dumps(asdict(message), separators=(',', ':')) + "\n"
+        with self._lock:
+            self._file.write(line)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class SmtpTransport(MailTransport):
+    """
+    Delivers through an SMTP server (by default a local relay or stand-in on
+    CTA_SMTP_HOST:CTA_SMTP_PORT). Each worker thread keeps one connection open
+    and reconnects if the server drops it.
+    """
+
+    kind = "smtp"
+
+    def __init__(self, host: str = CTA_SMTP_HOST, port: int = CTA_SMTP_PORT,
+                 from_address: str = CTA_FROM_ADDRESS):
+        self.host = host
+        self.port = port
+        self.from_address = from_address
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _client(self) -> smtplib.SMTP:
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = smtplib.SMTP(self.host, self.port, timeout=30)
+            self._local.client = client
+            with self._lock:
+                self._connections.append(client)
+        return client
+
+    def send(self, message: OutgoingEmail):
+        email = EmailMessage()
+        email["From"] = self.from_address
+        email["To"] = message.to_address
+        email["Subject"] = message.subject
+        email.set_content(f"{message.body}\n\n{message.link}\n")
+        try:
+            self._client().send_message(email)
+        except smtplib.SMTPServerDisconnected:
+            # Stale keep-alive connection; retry once on a fresh one
+            self._local.client = None
+            self._client().send_message(email)
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for client in connections:
+            try:
+                client.quit()
+            except smtplib.SMTPException:
+                pass
+
+
+def make_transport(kind: str = CTA_TRANSPORT) -> MailTransport:
+    """Builds the transport named in config (CTA_TRANSPORT)."""
+    if kind == "print":
+        return PrintTransport()
+    if kind == "file":
+        return FileSinkTransport()
+    if kind == "smtp":
+        return SmtpTransport()
+    raise ValueError(f"Unknown CTA transport: {kind}")
+
+
+class DomainRateLimiter:
+    """Token bucket per recipient domain, shared by all delivery workers."""
+
+    def __init__(self, default_rate: float = CTA_DEFAULT_DOMAIN_RATE, rates: Optional[dict] = None):
+        self.default_rate = default_rate
+        self.rates = dict(CTA_DOMAIN_RATES if rates is None else rates)
+        self._buckets = {}  # domain -> [tokens, last_refill]
+        self._lock = threading.Lock()
+
+    def acquire(self, domain: str):
+        """Blocks until a message to `domain` may be sent."""
+        rate = self.rates.get(domain, self.default_rate)
+        if rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                tokens, last = self._buckets.get(domain, (rate, now))
+                # Allow bursts of up to one second's worth of messages
+                tokens = min(rate, tokens + (now - last) * rate)
+                if tokens >= 1:
+                    self._buckets[domain] = (tokens - 1, now)
+                    return
+                self._buckets[domain] = (tokens, now)
+                wait = (1 - tokens) / rate
+            time.sleep(wait)
+
+
+class CtaDispatcher:
+    """Runs CTA campaigns through the batched pipeline described above."""
+
+    def __init__(self, transport: Optional[MailTransport] = None, workers: int = CTA_DISPATCH_WORKERS,
+                 batch_size: int = CTA_BATCH_SIZE, rate_limiter: Optional[DomainRateLimiter] = None,
+                 link_base: str = CTA_LINK_BASE, token_format: str = TOKEN_FORMAT):
+        if token_format not in ("signed", "random"):
+            raise ValueError(f"Unknown token format: {token_format}")
+        self.transport = transport or make_transport()
+        self.workers = workers
+        self.batch_size = batch_size
+        self.rate_limiter = rate_limiter or DomainRateLimiter(
+            CTA_TRANSPORT_DOMAIN_RATES.get(self.transport.kind, CTA_DEFAULT_DOMAIN_RATE)
+        )
+        self.link_base = link_base
+        self.token_format = token_format
+
+    def create_campaign(self, sender: User, subject: str, body: str, cta_link: str) -> int:
+        """Records a new campaign and returns its id."""
+        with transaction() as conn:
+            cursor = conn.execute(
+                "INSERT INTO cta_campaigns (sender_id, subject, body, cta_link) VALUES (?, ?, ?, ?)",
+                (sender.id, subject, body, cta_link)
+            )
+            return cursor.lastrowid
+
+    def run(self, campaign_id: int, sender: User) -> dict:
+        """
+        Dispatches (or resumes) a campaign to every user `sender` may see and
+        returns its progress counters.
+        """
+        with connection() as conn:
+            campaign = conn.execute("SELECT * FROM cta_campaigns WHERE id = ?", (campaign_id,)).fetchone()
+        if campaign is None:
+            raise ValueError(f"Unknown CTA campaign: {campaign_id}")
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="cta") as pool:
+            # Messages logged but not delivered before an interruption
+            pending = self._pending_messages(campaign)
+            if pending:
+                print(f"Resuming campaign {campaign_id}: re-delivering {len(pending)} pending messages.")
+                self._deliver(campaign_id, pending, pool)
+
+            last_recipient_id = campaign['last_recipient_id'] or 0
+            while True:
+                messages = self._log_next_batch(campaign, sender, last_recipient_id)
+                if not messages:
+                    break
+                last_recipient_id = messages[-1].recipient_id
+                self._deliver(campaign_id, messages, pool)
+
+        with transaction() as conn:
+            conn.execute(
+                "UPDATE cta_campaigns SET status = 'completed', completed_at = CURRENT_TIMESTAMP WHERE id = ?",
+                (campaign_id,)
+            )
+            progress = conn.execute(
+                "SELECT queued, sent, failed FROM cta_campaigns WHERE id = ?", (campaign_id,)
+            ).fetchone()
+        return dict(progress)
+
+    def close(self):
+        """Closes the mail transport."""
+        self.transport.close()
+
+    def _message(self, campaign, log_id: int, recipient_id: int, to_address: str, token: str) -> OutgoingEmail:
+        return OutgoingEmail(
+            log_id=log_id,
+            recipient_id=recipient_id,
+            to_address=to_address,
+            subject=campaign['subject'],
+            body=campaign['body'],
+            link=f"{self.link_base}/cta/{token}",
+            token=token,
+        )
+
+    def _pending_messages(self, campaign) -> list:
+        with connection() as conn:
+            rows = conn.execute(
+                "SELECT e.id, e.recipient_id, e.token, u.email FROM email_log e JOIN users u ON u.id = e.recipient_id "
+                "WHERE e.campaign_id = ? AND e.delivery_status = 'pending' ORDER BY e.recipient_id",
+                (campaign['id'],)
+            ).fetchall()
+        return [self._message(campaign, row['id'], row['recipient_id'], row['email'], row['token']) for row in rows]
+
+    def _log_next_batch(self, campaign, sender: User, after_recipient_id: int) -> list:
+        """Reads the next page of recipients and logs their tokens together with the progress marker."""
+        clause, params = get_acl_filter_clause(sender, 'users')
+        with transaction() as conn:
+            rows = conn.execute(
+                f"SELECT id, email FROM users WHERE ({clause}) AND id > ? ORDER BY id LIMIT ?",
+                (*params, after_recipient_id, self.batch_size)
+            ).fetchall()
+            if not rows:
+                return []
+            # Each row is logged with a random token; a signed token embeds the
+            # row id, so it replaces that once the insert has assigned one.
+            messages = []
+            for row in rows:
+                token = secrets.token_urlsafe(16)
+                log_id = conn.execute(
+                    "INSERT INTO email_log (sender_id, recipient_id, subject, cta_link, token, campaign_id, delivery_status) "
+                    "VALUES (?, ?, ?, ?, ?, ?, 'pending')",
+                    (sender.id, row['id'], campaign['subject'], campaign['cta_link'], token, campaign['id'])
+                ).lastrowid
+                if self.token_format == "signed":
+                    token = issue_token(KIND_CTA, log_id, CTA_TOKEN_TTL)
+                messages.append(self._message(campaign, log_id, row['id'], row['email'], token))
+            if self.token_format == "signed":
+                conn.executemany("UPDATE email_log SET token = ? WHERE id = ?", [(m.token, m.log_id) for m in messages])
+            conn.execute(
+                "UPDATE cta_campaigns SET last_recipient_id = ?, queued = queued + ? WHERE id = ?",
+                (messages[-1].recipient_id, len(messages), campaign['id'])
+            )
+        # Clicks tend to arrive right after delivery; have their redirects ready
+        get_redirect_cache().put_many((m.token, campaign['cta_link']) for m in messages)
+        return messages
+
+    def _send_one(self, message: OutgoingEmail) -> str:
+        try:
+            self.rate_limiter.acquire(message.to_address.rpartition("@")[2].lower())
+            self.transport.send(message)
+            return 'sent'
+        except Exception as e:  # A bad address or flaky server must not abort the campaign
+            print(f"  -> Delivery to user {message.recipient_id} failed: {e}")
+            return 'failed'
+
+    def _deliver(self, campaign_id: int, messages: list, pool: ThreadPoolExecutor):
+        outcomes = list(pool.map(self._send_one, messages))
+        sent = outcomes.count('sent')
+        with transaction() as conn:
+            conn.executemany(
+                "UPDATE email_log SET delivery_status = ? WHERE id = ?",
+                [(outcome, message.log_id) for outcome, message in zip(outcomes, messages)]
+            )
+            conn.execute(
+                "UPDATE cta_campaigns SET sent = sent + ?, failed = failed + ? WHERE id = ?",
+                (sent, len(outcomes) - sent, campaign_id)
+            )
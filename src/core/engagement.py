@@ -0,0 +1,312 @@
+"""
+Engagement (CC score) aggregation and leaderboards.
+
+Scores change by deltas applied inside the transaction that records the
+event, so `users.cc_score` is always current:
+
+- a first response to a CTA (core.clicks flushes) credits the recipient,
+- attending a meeting credits the attendee (and un-marking it debits),
+- a redeemed invitation credits the inviter.
+
+cc_leaderboard materializes the top LEADERBOARD_SIZE users of every region,
+plus GLOBAL_REGION across all of them, ranked by score. Reading a board is
+a primary-key range of at most K rows. A delta only refreshes a region's
+board when the user is on it or now scores at least its lowest entry, and a
+refresh re-reads just the top K from the (region, cc_score) index. Changes
+that bypass the deltas, such as user rows merged from a peer, are picked up
+by `reconcile_leaderboards`, which a background thread runs periodically.
+
+A score is a counter that several nodes add to, so it isn't replicated as a
+value: concurrent increments on two nodes would lose one side when the newer
+version wins. What is synced is `users.cc_shares`, a JSON object holding one
+[credits, debits] pair per node that changed the score (keyed by the node id
+in engagement_node), plus BASE_SHARE for scores from before shares existed.
+A node only ever grows its own pair, so replicas merge shares by taking the
+larger of each number (`merge_shares`), and cc_score is always the sum of
+credits minus debits.
+"""
+
+import json
+import secrets
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+from config import ENGAGEMENT_WEIGHTS, LEADERBOARD_SIZE, LEADERBOARD_RECONCILE_INTERVAL
+from models.connection import connection, transaction
+from models.field_versions import merging
+
+# Board key for the ranking across all regions
+GLOBAL_REGION = "*"
+
+# Share key for scores recorded before shares existed; every replica seeds it alike
+BASE_SHARE = "base"
+
+# Users whose shares are read per statement
+SHARES_BATCH = 500
+
+CREATE_ATTENDANCE_TABLE = """
+CREATE TABLE IF NOT EXISTS attendance (
+    meeting_id INTEGER NOT NULL REFERENCES meetings(id),
+    node_id INTEGER NOT NULL REFERENCES users(id),
+    attended BOOLEAN NOT NULL DEFAULT 1,
+    recorded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (meeting_id, node_id)
+)
+"""
+
+CREATE_LEADERBOARD_TABLE = """
+CREATE TABLE IF NOT EXISTS cc_leaderboard (
+    region TEXT NOT NULL,
+    rank INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    score INTEGER NOT NULL,
+    PRIMARY KEY (region, rank)
+) WITHOUT ROWID
+"""
+
+
+CREATE_NODE_TABLE = "CREATE TABLE IF NOT EXISTS engagement_node (id TEXT NOT NULL)"
+
+
+def ensure_engagement_schema(conn):
+    """Creates the attendance and leaderboard tables, their indexes, and the initial boards."""
+    conn.execute(CREATE_ATTENDANCE_TABLE)
+    conn.execute(CREATE_LEADERBOARD_TABLE)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_attendance_node ON attendance (node_id)")
+    # Top-K reads for one region and across all of them
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_region_score ON users (region, cc_score DESC, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_score ON users (cc_score DESC, id)")
+    rebuild_leaderboards(conn)
+
+
+def _refresh_region(conn, region: str, size: int):
+    conn.execute("DELETE FROM cc_leaderboard WHERE region = ?", (region,))
+    if region == GLOBAL_REGION:
+        source, params = "SELECT id, cc_score FROM users ORDER BY cc_score DESC, id LIMIT ?", (size,)
+    else:
+        source, params = (
+            "SELECT id, cc_score FROM users WHERE region = ? ORDER BY cc_score DESC, id LIMIT ?", (region, size)
+        )
+    conn.execute(
+        "INSERT INTO cc_leaderboard (region, rank, user_id, score) "
+        f"SELECT ?, row_number() OVER (ORDER BY cc_score DESC, id), id, cc_score FROM ({source})",
+        (region, *params)
+    )
+
+
+def refresh_regions(conn, regions: Iterable[str], size: int = LEADERBOARD_SIZE):
+    """Rebuilds the boards of `regions` from the score index (O(K) each)."""
+    for region in set(regions):
+        _refresh_region(conn, region, size)
+
+
+def _needs_refresh(conn, region: str, user_id: int, score: int, size: int) -> bool:
+    entries, lowest, on_board = conn.execute(
+        "SELECT count(*), min(score), max(user_id = ?) FROM cc_leaderboard WHERE region = ?",
+        (user_id, region)
+    ).fetchone()
+    return entries < size or score >= lowest or bool(on_board)
+
+
+def ensure_score_shares(conn):
+    """
+    Gives this database its node id, and seeds the shares of users scored
+    before shares existed with their whole score under BASE_SHARE. The seed
+    is a merge-style write, so the rows aren't stamped as changed.
+    """
+    conn.execute(CREATE_NODE_TABLE)
+    if conn.execute("SELECT count(*) FROM engagement_node").fetchone()[0] == 0:
+        conn.execute("INSERT INTO engagement_node (id) VALUES (?)", (secrets.token_hex(8),))
+    seeds = [
+        (encode_shares(base_shares(row['cc_score'])), row['id']) for row in conn.execute(
+            "SELECT id, cc_score FROM users WHERE cc_shares IS NULL AND coalesce(cc_score, 0) != 0"
+        )
+    ]
+    with merging(conn):
+        conn.executemany("UPDATE users SET cc_shares = ? WHERE id = ?", seeds)
+
+
+def local_node(conn) -> str:
+    """This database's key in cc_shares."""
+    return conn.execute("SELECT id FROM engagement_node").fetchone()[0]
+
+
+def base_shares(score: Optional[int]) -> dict:
+    """The shares of a score that predates them."""
+    score = score or 0
+    return {BASE_SHARE: (max(score, 0), max(-score, 0))} if score else {}
+
+
+def parse_shares(value) -> dict:
+    """{node: (credits, debits)} from a cc_shares value; malformed entries are ignored."""
+    try:
+        shares = json.loads(value) if value else {}
+    except (TypeError, ValueError):
+        return {}
+    if not isinstance(shares, dict):
+        return {}
+    return {
+        node: tuple(pair) for node, pair in shares.items()
+        if isinstance(pair, list) and len(pair) == 2
+        and all(type(count) is int and count >= 0 for count in pair)
+    }
+
+
+def encode_shares(shares: dict) -> str:
+    """The canonical cc_shares text, identical on every replica holding the same shares."""
+    return json.dumps({node: list(shares[node]) for node in sorted(shares)}, separators=(',', ':'))
+
+
+def shares_score(shares: dict) -> int:
+    return sum(credits - debits for credits, debits in shares.values())
+
+
+def _union(a: dict, b: dict) -> dict:
+    return {
+        node: tuple(max(x, y) for x, y in zip(a.get(node, (0, 0)), b.get(node, (0, 0))))
+        for node in a.keys() | b.keys()
+    }
+
+
+def read_shares(conn, user_ids: Iterable[int]) -> Dict[int, sqlite3.Row]:
+    """(id, region, cc_score, cc_shares) of each of `user_ids` that exists."""
+    user_ids = list(user_ids)
+    rows = {}
+    for start in range(0, len(user_ids), SHARES_BATCH):
+        batch = user_ids[start:start + SHARES_BATCH]
+        rows.update(
+            (row['id'], row) for row in conn.execute(
+                f"SELECT id, region, cc_score, cc_shares FROM users WHERE id IN ({', '.join('?' for _ in batch)})",
+                batch
+            )
+        )
+    return rows
+
+
+def apply_deltas(conn, deltas: Dict[int, int], size: int = LEADERBOARD_SIZE):
+    """
+    Adds {user_id: points} to this node's share of each user's score on
+    `conn` (the caller owns the transaction), updates users.cc_score to
+    match, and refreshes only the boards the changes can affect.
+    """
+    deltas = {user_id: points for user_id, points in deltas.items() if user_id is not None and points}
+    if not deltas:
+        return
+    node = local_node(conn)
+    rows = read_shares(conn, deltas)
+    updates = []
+    dirty = set()
+    for user_id, row in rows.items():
+        shares = parse_shares(row['cc_shares']) if row['cc_shares'] else base_shares(row['cc_score'])
+        credits, debits = shares.get(node, (0, 0))
+        points = deltas[user_id]
+        shares[node] = (credits + max(points, 0), debits + max(-points, 0))
+        score = shares_score(shares)
+        updates.append((encode_shares(shares), score, user_id))
+        for region in (GLOBAL_REGION, row['region']):
+            if region is None or region in dirty:
+                continue
+            if _needs_refresh(conn, region, user_id, score, size):
+                dirty.add(region)
+    conn.executemany("UPDATE users SET cc_shares = ?, cc_score = ? WHERE id = ?", updates)
+    refresh_regions(conn, dirty, size)
+
+
+def merge_shares(conn, records: list, before: Dict[int, sqlite3.Row]) -> set:
+    """
+    Completes a merge of user records on `conn` (the caller owns the
+    transaction): each merged user's shares become the union of the local
+    shares read into `before` ahead of the merge, what the merge left and
+    every incoming copy, and cc_score is recomputed from them. Returns the
+    regions of the users whose score changed.
+    """
+    incoming = {}
+    for record in records:
+        if record.get('id') and 'cc_shares' in record:
+            incoming[record['id']] = _union(incoming.get(record['id'], {}), parse_shares(record['cc_shares']))
+    updates = []
+    regions = set()
+    for user_id, row in read_shares(conn, incoming).items():
+        local = before.get(user_id)
+        shares = _union(incoming[user_id], parse_shares(row['cc_shares']))
+        if local is not None:
+            shares = _union(shares, parse_shares(local['cc_shares']))
+        encoded, score = encode_shares(shares), shares_score(shares)
+        if encoded != row['cc_shares'] or score != row['cc_score']:
+            updates.append((encoded, score, user_id))
+            if score != row['cc_score']:
+                regions.update((GLOBAL_REGION, row['region']) if row['region'] else (GLOBAL_REGION,))
+    with merging(conn):
+        conn.executemany("UPDATE users SET cc_shares = ?, cc_score = ? WHERE id = ?", updates)
+    return regions
+
+
+def credit(conn, user_id: int, event: str, count: int = 1):
+    """Applies `count` occurrences of `event` (a key of ENGAGEMENT_WEIGHTS) to one user."""
+    apply_deltas(conn, {user_id: ENGAGEMENT_WEIGHTS[event] * count})
+
+
+def rebuild_leaderboards(conn, size: int = LEADERBOARD_SIZE):
+    """Recomputes every board from users.cc_score."""
+    regions = [row[0] for row in conn.execute("SELECT DISTINCT region FROM users WHERE region IS NOT NULL")]
+    conn.execute("DELETE FROM cc_leaderboard")
+    refresh_regions(conn, [GLOBAL_REGION, *regions], size)
+
+
+def reconcile_leaderboards() -> bool:
+    """Rebuilds all boards in one transaction; returns False on a database error."""
+    try:
+        with transaction() as conn:
+            rebuild_leaderboards(conn)
+        return True
+    except sqlite3.Error as e:
+        print(f"Database error while reconciling leaderboards: {e}")
+        return False
+
+
+def recompute_scores():
+    """
+    Recomputes every users.cc_score from its replicated shares, then rebuilds
+    the boards. The shares cover scores earned on every node; this node's own
+    event tables (email_log, attendance, signups) only hold its own events.
+    """
+    with transaction() as conn:
+        updates = [
+            (shares_score(parse_shares(row['cc_shares'])), row['id'])
+            for row in conn.execute("SELECT id, cc_shares FROM users WHERE cc_shares IS NOT NULL")
+        ]
+        with merging(conn):
+            conn.executemany("UPDATE users SET cc_score = ? WHERE id = ?", updates)
+        rebuild_leaderboards(conn)
+
+
+def leaderboard(region: Optional[str] = None, limit: int = LEADERBOARD_SIZE) -> List[dict]:
+    """The top `limit` users of `region` (all regions if None), best first."""
+    with connection() as conn:
+        rows = conn.execute(
+            "SELECT rank, user_id, score FROM cc_leaderboard WHERE region = ? ORDER BY rank LIMIT ?",
+            (region or GLOBAL_REGION, limit)
+        )
+        return [dict(row) for row in rows]
+
+
+_reconciler = None
+_reconciler_lock = threading.Lock()
+
+
+def start_reconciler(interval: float = LEADERBOARD_RECONCILE_INTERVAL):
+    """Starts (once per process) a daemon thread that reconciles the boards every `interval` seconds."""
+    global _reconciler
+    with _reconciler_lock:
+        if _reconciler is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                reconcile_leaderboards()
+
+        _reconciler = threading.Thread(target=run, name="leaderboard-reconciler", daemon=True)
+        _reconciler.start()
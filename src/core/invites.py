@@ -2,8 +2,12 @@ import secrets
 import sqlite3
 from typing import Optional
 
+from config import TOKEN_FORMAT, INVITE_TOKEN_TTL
 from core.models import User
-from models.database import get_db_connection
+from models.connection import connection, transaction
+from core.engagement import credit
+from models.invite_tree import link_records
+from utils.tokens import KIND_INVITE, InvalidTokenError, is_signed_token, issue_token, verify_token
 
 class InvitationManager:
     """Handles the logic for creating and redeeming invitation tokens."""
@@ -14,17 +18,18 @@ class InvitationManager:
         Returns the token if successful.
         """
         print(f"User '{inviter.id}' is generating an invite for '{invitee_email}'...")
-        # Generate a cryptographically secure, URL-safe token 
-        token = secrets.token_urlsafe(32)
-        
         try:
-            conn = get_db_connection()
-            conn.execute(
-                "INSERT INTO invitations (email, invited_by, token) VALUES (?, ?, ?)",
-                (invitee_email, inviter.id, token)
-            )
-            conn.commit()
-            conn.close()
+            with transaction() as conn:
+                # Generate a cryptographically secure, URL-safe token
+                token = secrets.token_urlsafe(32)
+                invite_id = conn.execute(
+                    "INSERT INTO invitations (email, invited_by, token) VALUES (?, ?, ?)",
+                    (invitee_email, inviter.id, token)
+                ).lastrowid
+                if TOKEN_FORMAT == "signed":
+                    # A signed token embeds the row id, so it's issued once the insert has assigned one
+                    token = issue_token(KIND_INVITE, invite_id, INVITE_TOKEN_TTL)
+                    conn.execute("UPDATE invitations SET token = ? WHERE id = ?", (token, invite_id))
             print(f"Successfully created invitation with token: {token}")
             return token
         except sqlite3.Error as e:
@@ -36,12 +41,22 @@ class InvitationManager:
         Validates an invitation token and marks it as used upon successful signup.
         """
         print(f"Attempting to redeem invitation token '{token}' for email '{signup_email}'...")
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        # 1. Find the invitation
-        cursor.execute("SELECT * FROM invitations WHERE token = ?", (token,))
-        invite = cursor.fetchone()
+        # 1. Find the invitation. Signed tokens are checked without touching the
+        # database and name their row directly.
+        invite_id = None
+        if is_signed_token(token):
+            try:
+                invite_id = verify_token(token, KIND_INVITE)
+            except InvalidTokenError as e:
+                print(f"Redemption failed: {e}.")
+                return False
+        with connection() as conn:
+            if invite_id is not None:
+                invite = conn.execute(
+                    "SELECT * FROM invitations WHERE id = ? AND token = ?", (invite_id, token)
+                ).fetchone()
+            else:
+                invite = conn.execute("SELECT * FROM invitations WHERE token = ?", (token,)).fetchone()
 
         # 2. Validate the invitation
         if not invite:
@@ -56,20 +71,21 @@ class InvitationManager:
 
         # 3. If valid, proceed to mark as used and create signup record
         try:
-            # Mark the token as used in the 'invitations' table 
-            cursor.execute("UPDATE invitations SET used = 1 WHERE id = ?", (invite['id'],))
-            
-            # Create a record in the 'signups' table 
-            # In a real app, this data would come from a sign-up form.
-            cursor.execute(
-                "INSERT INTO signups (name, email, invited_by, token) VALUES (?, ?, ?, ?)",
-                ("New User", signup_email, invite['invited_by'], token)
-            )
-            conn.commit()
+            with transaction() as conn:
+                # Mark the token as used in the 'invitations' table 
+                conn.execute("UPDATE invitations SET used = 1 WHERE id = ?", (invite['id'],))
+
+                # Create a record in the 'signups' table 
+                # In a real app, this data would come from a sign-up form.
+                conn.execute(
+                    "INSERT INTO signups (name, email, invited_by, token) VALUES (?, ?, ?, ?)",
+                    ("New User", signup_email, invite['invited_by'], token)
+                )
+                # Extend the invitation tree if the invitee already has an account
+                link_records(conn, 'signups', [{'email': signup_email}])
+                credit(conn, invite['invited_by'], 'invite_redeemed')
             print("Invitation successfully redeemed!")
             return True
         except sqlite3.Error as e:
             print(f"Database error during redemption: {e}")
             return False
-        finally:
-            conn.close()
@@ -2,9 +2,11 @@ import sqlite3
 import time
 from typing import Optional
 
+from acl.permissions import get_acl_filter_clause
 from core.models import User
-from models.database import get_db_connection
+from models.connection import transaction
 from core.audit import log_action # Import our existing audit logger
+from core.engagement import credit
 
 class MeetingScheduler:
     """Handles the business logic for creating and managing meetings."""
@@ -32,20 +34,15 @@ class MeetingScheduler:
 
         # 2. Insert the new meeting into the database 
         try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            
-            # The scheduled_at and last_modified timestamps are handled by the database defaults
-            cursor.execute(
-                "INSERT INTO meetings (host_id, city, state, title, notes) VALUES (?, ?, ?, ?, ?)",
-                (host.id, city, state, title, notes)
-            )
-            
-            # Get the ID of the meeting we just created
-            new_meeting_id = cursor.lastrowid
-            
-            conn.commit()
-            conn.close()
+            with transaction() as conn:
+                # The scheduled_at and last_modified timestamps are handled by the database defaults
+                cursor = conn.execute(
+                    "INSERT INTO meetings (host_id, city, state, title, notes) VALUES (?, ?, ?, ?, ?)",
+                    (host.id, city, state, title, notes)
+                )
+
+                # Get the ID of the meeting we just created
+                new_meeting_id = cursor.lastrowid
             print(f"Successfully inserted new meeting with ID: {new_meeting_id}")
 
         except sqlite3.Error as e:
@@ -61,3 +58,42 @@ class MeetingScheduler:
         )
 
         return new_meeting_id
+
+    def record_attendance(self, recorder: User, meeting_id: int, attendee_id: int, attended: bool = True) -> bool:
+        """
+        Records whether a user attended a meeting the recorder can see, and
+        credits (or, when un-marking, debits) the attendee's CC score.
+        """
+        print(f"\nUser '{recorder.id}' recording attendance of user '{attendee_id}' at meeting {meeting_id}...")
+        try:
+            with transaction() as conn:
+                clause, params = get_acl_filter_clause(recorder, 'meetings')
+                meeting = conn.execute(
+                    f"SELECT id FROM meetings WHERE id = ? AND ({clause})", (meeting_id, *params)
+                ).fetchone()
+                if not meeting:
+                    print("Permission denied: Meeting not found or not visible to this user.")
+                    return False
+
+                previous = conn.execute(
+                    "SELECT attended FROM attendance WHERE meeting_id = ? AND node_id = ?", (meeting_id, attendee_id)
+                ).fetchone()
+                conn.execute(
+                    "INSERT INTO attendance (meeting_id, node_id, attended) VALUES (?, ?, ?) "
+                    "ON CONFLICT (meeting_id, node_id) DO UPDATE SET "
+                    "attended = excluded.attended, recorded_at = CURRENT_TIMESTAMP",
+                    (meeting_id, attendee_id, attended)
+                )
+                if attended != bool(previous and previous['attended']):
+                    credit(conn, attendee_id, 'attendance', 1 if attended else -1)
+        except sqlite3.Error as e:
+            print(f"Database error while recording attendance: {e}")
+            return False
+
+        log_action(
+            action="record_attendance",
+            performed_by=recorder.id,
+            entity="attendance",
+            record_id=meeting_id
+        )
+        return True
@@ -15,3 +15,7 @@ class Peer:
     public_key: str # Stored in hex format
     address: str # e.g., "http://127.0.0.1:5000"
     last_synced: Optional[int] = None # Unix timestamp
+    # Outcome of the most recent sync attempt, as reported by the SyncCoordinator
+    last_sync_status: Optional[str] = None # "ok" or an error description
+    last_sync_latency_ms: Optional[int] = None
+    last_sync_bytes: Optional[int] = None
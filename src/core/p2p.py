@@ -1,87 +1,78 @@
-import json
 import requests
-import time
-from nacl.public import PrivateKey, Box
-from nacl.signing import SigningKey, VerifyKey
 from nacl.exceptions import CryptoError
 
-from acl.permissions import has_access
-from config import PRIVATE_KEY_PATH, PUBLIC_KEY_PATH
 from core.models import User, Peer
-from models.database import get_db_connection
+from core.sync_protocol import encode_sync_stream
+from models.database import iter_records
+from models.field_versions import versioned_records
+from models.sync import SYNC_TABLES
+from utils.compression import negotiate
+from utils.crypto import get_keyring
 
-def gather_changed_records(last_sync_timestamp: int) -> list:
-    """Gathers records from the database that have changed since the last sync."""
-    # ... (This function is unchanged) ...
+# Rows read per keyset page while gathering changes
+GATHER_PAGE_SIZE = 500
+
+def gather_changed_records(last_sync_timestamp: int, page_size: int = GATHER_PAGE_SIZE, profile: User = None):
+    """
+    Yields (table_name, record) for every row of every synced table that changed
+    at or after the peer's watermark (a Unix timestamp). With a `profile`, only
+    rows that profile may see are read; the ACL is part of the query.
+
+    Rows are read in keyset pages (see iter_records) ordered by the indexed
+    (last_modified, id) pair, so no read transaction is held while the caller
+    consumes a page. The boundary second is included on purpose: last_modified
+    has one-second resolution, and re-sending a row the peer already has is
+    harmless while skipping one is not.
+
+    Rows the peer already had before the watermark are sent as deltas of
+    just the columns changed since then (see models.field_versions).
+    """
     print(f"Gathering records modified since timestamp {last_sync_timestamp}...")
-    conn = get_db_connection()
-    meetings = conn.execute("SELECT * FROM meetings").fetchall()
-    conn.close()
-    return [dict(row) for row in meetings]
+    for table in SYNC_TABLES.values():
+        rows = iter_records(
+            table.name, profile, table.columns, order_by=('last_modified', 'id'), page_size=page_size,
+            where="last_modified >= datetime(?, 'unixepoch')", params=(last_sync_timestamp,)
+        )
+        for record in versioned_records(table.name, rows, since=last_sync_timestamp):
+            yield table.name, record
+
+def peer_profile(peer: Peer) -> User:
+    """The User profile a peer's ACL checks are made against."""
+    # A full implementation would need to sync user profiles as well.
+    # For now, we grant the peer 'dev' access for the purpose of the demo.
+    return User(id=0, role='dev', region=None) # A placeholder profile
+
+def records_for_peer(profile: User, last_sync_timestamp: int):
+    """Yields the (table_name, record) pairs changed since the watermark that `profile` may see."""
+    return gather_changed_records(last_sync_timestamp, profile=profile)
 
 # The function signature is now cleaner
 def initiate_sync(current_user: User, peer: Peer):
-    """Prepares and sends a filtered, signed, and encrypted payload to a peer."""
+    """Streams filtered records to a peer as signed, encrypted chunks (see core.sync_protocol)."""
     print(f"\n--- Initiating Sync with Peer '{peer.email}' at {peer.address} ---")
     
     # We create a User object for the peer to perform ACL checks
-    peer_user_profile = User(id=0, role='dev', region=None) # A placeholder profile
-    # A full implementation would need to sync user profiles as well.
-    # For now, we grant the peer 'dev' access for the purpose of the demo.
+    records_to_send = records_for_peer(peer_profile(peer), peer.last_synced or 0)
 
-    all_records = gather_changed_records(peer.last_synced or 0)
-    print(f"Found {len(all_records)} total records to consider for sync.")
-    
-    records_to_send = [
-        record for record in all_records if has_access(peer_user_profile, record)
-    ]
-    print(f"Applying ACLs. Sending {len(records_to_send)} records to peer.")
-    
-    payload = {
-        "sender_id": current_user.id,
-        "records": records_to_send,
-        "timestamp": int(time.time())
-    }
-    
     try:
-        with open(PRIVATE_KEY_PATH, "rb") as f:
-            signing_key = SigningKey(f.read())
-        
-        # ... (Signature logic is unchanged) ...
-        payload_json = json.dumps(payload, separators=(',', ':')).encode('utf-8')
-        signed_message = signing_key.sign(payload_json)
-        verify_key = signing_key.verify_key
-        public_key_hex = verify_key.encode().hex()
-
-        final_payload = {
-            "data": payload,
-            "signature": signed_message.signature.hex(),
-            "public_key": public_key_hex
-        }
-        
-        # --- Encryption Step ---
-        print("Encrypting payload for secure transport...")
-        encryption_private_key = signing_key.to_curve25519_private_key()
-        
-        # Get the peer's public key from the Peer object
-        peer_encryption_public_key = VerifyKey(bytes.fromhex(peer.public_key)).to_curve25519_public_key()
-        
-        box = Box(encryption_private_key, peer_encryption_public_key)
-        final_payload_json = json.dumps(final_payload).encode('utf-8')
-        encrypted_payload = box.encrypt(final_payload_json)
-        
-    except (IOError, CryptoError) as e:
+        # Records are signed and encrypted chunk by chunk as the body streams out
+        stats = {}
+        # A one-off sync hasn't seen the peer's X-Sync-Compression header, so it goes out uncompressed
+        body = encode_sync_stream(get_keyring(), peer.public_key, current_user.id, records_to_send, stats=stats,
+                                  compression=negotiate(None))
+    except (IOError, ValueError, CryptoError) as e:
         print(f"Error: Could not process keys for encryption/signing. {e}")
         return
 
     try:
-        print("Sending encrypted payload to peer...")
+        print("Streaming signed, encrypted chunks to peer...")
         response = requests.post(
             f"{peer.address}/sync", # Use the peer's address from the Peer object
-            data=encrypted_payload,
+            data=body,  # A generator, so requests uses chunked transfer encoding
             headers={"Content-Type": "application/octet-stream"},
             timeout=10
         )
+        print(f"Sent {stats['records']} records in {stats['chunks']} chunks ({stats['bytes']} bytes).")
         if response.status_code == 200:
             print("Sync request successfully sent and acknowledged by peer.")
             print(f"Peer response: {response.json()}")
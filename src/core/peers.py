@@ -1,60 +1,137 @@
 import json
+import sqlite3
 import time
+from dataclasses import asdict, fields
 from typing import List, Optional
 from pathlib import Path
 
 from config import CONFIG_DIR
 from core.models import Peer
+from models.connection import connection, transaction
 
 PEERS_FILE_PATH = CONFIG_DIR / "peers.json"
 
+_PEER_COLUMNS = tuple(f.name for f in fields(Peer))
+
+
 class PeerManager:
-    """Handles loading, saving, and managing the list of known peers."""
+    """
+    Handles loading, saving, and managing the list of known peers.
+    Peers live in the `peers` table; every change is a single-row write.
+    """
 
     def __init__(self, peers_file_path: Path = PEERS_FILE_PATH):
         self.peers_file_path = peers_file_path
-        self._peers = {}  # In-memory cache, mapping email to Peer object
-        self.load_peers()
+        self.import_peers_file()
 
-    def load_peers(self):
-        """Loads the list of peers from the peers.json file."""
-        print("Loading peers from peers.json...")
+    def import_peers_file(self):
+        """
+        One-time migration from the old peers.json file: imports its peers into
+        the database and renames the file so it isn't imported again.
+        """
+        if not self.peers_file_path.exists():
+            return
+        print("Importing peers from peers.json...")
         try:
             with open(self.peers_file_path, 'r') as f:
                 peers_data = json.load(f)
-                for email, data in peers_data.items():
-                    self._peers[email] = Peer(**data)
-            print(f"Loaded {len(self._peers)} peers.")
-        except (FileNotFoundError, json.JSONDecodeError):
-            print("peers.json not found or is empty. Starting with an empty peer list.")
-            self._peers = {}
-
-    def save_peers(self):
-        """Saves the current list of peers back to peers.json."""
-        peers_to_save = {
-            email: peer.__dict__ for email, peer in self._peers.items()
-        }
-        with open(self.peers_file_path, 'w') as f:
-            json.dump(peers_to_save, f, indent=4)
+        except json.JSONDecodeError:
+            print("peers.json is empty or invalid. Nothing to import.")
+            peers_data = {}
+
+        if not isinstance(peers_data, dict):
+            print("peers.json does not hold a mapping of peers. Nothing to import.")
+            peers_data = {}
+
+        imported = 0
+        with transaction() as conn:
+            for email, data in peers_data.items():
+                peer = self._peer_from_json(data)
+                if peer is None:
+                    print(f"Skipping invalid peers.json entry '{email}'.")
+                    continue
+                self._upsert(conn, peer)
+                imported += 1
+        self.peers_file_path.rename(self.peers_file_path.with_name(self.peers_file_path.name + ".imported"))
+        print(f"Imported {imported} peers.")
+
+    @staticmethod
+    def _peer_from_json(data) -> Optional[Peer]:
+        """A Peer from one peers.json entry, or None if the entry is malformed. Unknown keys are ignored."""
+        if not isinstance(data, dict):
+            return None
+        if not all(isinstance(data.get(name), str) and data[name] for name in ('email', 'public_key', 'address')):
+            return None
+        return Peer(**{name: data[name] for name in _PEER_COLUMNS if name in data})
+
+    @staticmethod
+    def _upsert(conn, peer: Peer):
+        values = asdict(peer)
+        columns = ", ".join(_PEER_COLUMNS)
+        placeholders = ", ".join(f":{name}" for name in _PEER_COLUMNS)
+        assignments = ", ".join(f"{name} = excluded.{name}" for name in _PEER_COLUMNS if name != 'email')
+        conn.execute(
+            f"INSERT INTO peers ({columns}) VALUES ({placeholders}) "
+            f"ON CONFLICT (email) DO UPDATE SET {assignments}",
+            values
+        )
+
+    @staticmethod
+    def _to_peer(row: Optional[sqlite3.Row]) -> Optional[Peer]:
+        return Peer(**{name: row[name] for name in _PEER_COLUMNS}) if row else None
 
     def add_peer(self, peer: Peer):
-        """Adds a new peer to the list and saves the file."""
+        """Adds a new peer (or replaces the peer with the same email)."""
         print(f"Adding peer: {peer.email}")
-        self._peers[peer.email] = peer
-        self.save_peers()
+        with transaction() as conn:
+            self._upsert(conn, peer)
 
     def get_peer(self, email: str) -> Optional[Peer]:
         """Retrieves a peer by their email address."""
-        return self._peers.get(email)
+        with connection() as conn:
+            row = conn.execute("SELECT * FROM peers WHERE email = ?", (email,)).fetchone()
+        return self._to_peer(row)
+
+    def get_peer_by_public_key(self, public_key: str) -> Optional[Peer]:
+        """Retrieves a peer by their hex-encoded public key."""
+        with connection() as conn:
+            row = conn.execute("SELECT * FROM peers WHERE public_key = ?", (public_key,)).fetchone()
+        return self._to_peer(row)
+
+    def is_known_peer(self, public_key: str) -> bool:
+        """Whether `public_key` (hex) belongs to a registered peer."""
+        return self.get_peer_by_public_key(public_key) is not None
 
     def get_all_peers(self) -> List[Peer]:
         """Returns a list of all known peer objects."""
-        return list(self._peers.values())
-
-    def update_last_synced(self, email: str):
-        """Updates the last_synced timestamp for a peer after a successful sync."""
-        peer = self.get_peer(email)
-        if peer:
-            peer.last_synced = int(time.time())
-            self.save_peers()
+        with connection() as conn:
+            rows = conn.execute("SELECT * FROM peers ORDER BY email").fetchall()
+        return [self._to_peer(row) for row in rows]
+
+    def update_last_synced(self, email: str, timestamp: Optional[int] = None, stats: Optional[dict] = None):
+        """
+        Updates the last_synced timestamp for a peer after a successful sync.
+        Pass the time the sync *started* so rows changed while it was running
+        are picked up by the next one; defaults to now.
+
+        `stats` ({"status", "latency_ms", "bytes"}) records the outcome of the
+        attempt; when its status isn't "ok" only the outcome is stored and the
+        watermark stays where it was.
+        """
+        advance = stats is None or stats.get('status') == 'ok'
+        last_synced = timestamp if timestamp is not None else int(time.time())
+        try:
+            with transaction() as conn:
+                if stats is not None:
+                    cursor = conn.execute(
+                        "UPDATE peers SET last_sync_status = ?, last_sync_latency_ms = ?, last_sync_bytes = ? WHERE email = ?",
+                        (stats.get('status'), stats.get('latency_ms'), stats.get('bytes'), email)
+                    )
+                if advance:
+                    cursor = conn.execute("UPDATE peers SET last_synced = ? WHERE email = ?", (last_synced, email))
+        except sqlite3.Error as e:
+            # The watermark stays put, so the next round sends these rows again
+            print(f"Database error while updating last_synced for peer {email}: {e}")
+            return
+        if advance and cursor.rowcount:
             print(f"Updated last_synced for peer: {email}")
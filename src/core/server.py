@@ -1,71 +1,67 @@
-import json
 import logging
 from flask import Flask, request, jsonify, redirect
-from nacl.public import PrivateKey, Box
-from nacl.signing import SigningKey, VerifyKey
-from nacl.exceptions import BadSignatureError, CryptoError
+from nacl.exceptions import CryptoError
+
+from config import SERVER_HOST, SERVER_MODE, SERVER_PORT
 
 from models.database import merge_records
 from core.cta import CtaManager # Import the new manager
-from config import PRIVATE_KEY_PATH, PUBLIC_KEY_PATH
+from core.sync_protocol import SyncReceiver, SyncProtocolError
+from core.anti_entropy import answer_bucket_query
+from core.async_server import run_async_server
+from core.peers import PeerManager
+from utils.compression import accepted_header
+from utils.crypto import get_keyring
 
 log = logging.getLogger('werkzeug')
 log.setLevel(logging.ERROR)
 
 app = Flask(__name__)
+cta_manager = CtaManager()
+_peer_manager = None
+
+def peer_manager() -> PeerManager:
+    """The PeerManager shared by all requests; created on first use, after the database is set up."""
+    global _peer_manager
+    if _peer_manager is None:
+        _peer_manager = PeerManager()
+    return _peer_manager
+
+@app.after_request
+def advertise_compression(response):
+    """Tells syncing peers which compression methods this node accepts (see utils.compression)."""
+    if request.path.startswith('/sync'):
+        response.headers['X-Sync-Compression'] = accepted_header()
+    return response
 
 @app.route('/sync', methods=['POST'])
 def sync():
     """
-    Receives an encrypted sync payload, decrypts it, verifies the signature,
-    and merges the data.
+    Receives a framed sync stream (see core.sync_protocol) and decrypts,
+    verifies and merges it chunk by chunk as the body arrives.
     """
-    # Get the raw encrypted bytes from the request
-    encrypted_payload = request.get_data()
-    
-    # 1. Decrypt the payload
+    print("\n--- [/sync] Receiving sync stream... ---")
+    keyring = get_keyring()
     try:
-        print("\n--- [/sync] Received encrypted payload, attempting decryption... ---")
-        # Load our own private key for decryption
-        with open(PRIVATE_KEY_PATH, "rb") as f:
-            server_signing_key = SigningKey(f.read())
-        server_private_key = server_signing_key.to_curve25519_private_key()
-        
-        # For the demo, we assume we know the sender's public key (our own)
-        with open(PUBLIC_KEY_PATH, "rb") as f:
-            sender_public_key_bytes = f.read()
-        sender_encryption_public_key = VerifyKey(sender_public_key_bytes).to_curve25519_public_key()
-
-        # Create the Box to decrypt the message
-        box = Box(server_private_key, sender_encryption_public_key)
-        
-        # The decrypt() method will raise CryptoError if decryption fails
-        decrypted_payload_json = box.decrypt(encrypted_payload)
-        payload = json.loads(decrypted_payload_json)
-        print("Decryption successful.")
-
-    except (CryptoError, json.JSONDecodeError, IOError):
-        print("--- [/sync] DECRYPTION FAILED. Rejecting request. ---")
-        return jsonify({"status": "error", "message": "Decryption failed or invalid payload"}), 403
+        # Make sure our own key is loadable before reading the stream
+        keyring.signing_key
+    except (IOError, CryptoError):
+        print("--- [/sync] Could not load server key. Rejecting request. ---")
+        return jsonify({"status": "error", "message": "Server key unavailable"}), 500
 
-    # 2. Verify the signature (on the now-decrypted payload)
-    data = payload.get('data')
-    signature_hex = payload.get('signature')
-    public_key_hex = payload.get('public_key')
-    
+    receiver = SyncReceiver(keyring, merge_records, peer_manager().is_known_peer)
     try:
-        verify_key = VerifyKey(bytes.fromhex(public_key_hex))
-        data_json = json.dumps(data, separators=(',', ':')).encode('utf-8')
-        verify_key.verify(data_json, bytes.fromhex(signature_hex))
-        print("--- [/sync] Signature VERIFIED. Request is authentic. ---")
-    except (BadSignatureError, TypeError, KeyError, ValueError):
-        print("--- [/sync] Signature INVALID. Rejecting request. ---")
-        return jsonify({"status": "error", "message": "Invalid signature"}), 403
+        # request.stream is read incrementally, also for chunked request bodies
+        merge_summary = receiver.receive(request.stream)
+    except SyncProtocolError as e:
+        print(f"--- [/sync] {e}. Rejecting rest of stream. ---")
+        return jsonify({
+            "status": "error",
+            "message": str(e),
+            "summary": receiver.summary  # Chunks verified before the failure stay merged
+        }), e.status_code
 
-    # 3. If verification passes, process the data using the merge function
-    records_to_merge = data.get('records', [])
-    print(f"Received {len(records_to_merge)} records to merge.")
-    merge_summary = merge_records(records_to_merge)
+    print(f"--- [/sync] Stream VERIFIED. Merged {receiver.records} records from sender {receiver.sender_id}. ---")
     print("----------------------------------------------------\n")
     
     return jsonify({
@@ -74,6 +70,19 @@ def sync():
         "summary": merge_summary
     }), 200
 
+@app.route('/sync/buckets', methods=['POST'])
+def sync_buckets():
+    """
+    Answers a peer's signed anti-entropy query with the range hashes of one
+    synced table (see core.anti_entropy).
+    """
+    try:
+        answer = answer_bucket_query(request.get_data(), get_keyring(), peer_manager().is_known_peer)
+    except SyncProtocolError as e:
+        print(f"--- [/sync/buckets] {e}. Rejecting query. ---")
+        return jsonify({"status": "error", "message": str(e)}), e.status_code
+    return jsonify(answer), 200
+
 # --- New Endpoint for CTA Tracking ---
 @app.route('/cta/<token>', methods=['GET'])
 def track_cta_click(token: str):
@@ -81,14 +90,23 @@ def track_cta_click(token: str):
     This endpoint is hit when a user clicks a CTA link in an email.
     It logs the click and then redirects the user to the original destination.
     """
-    cta_manager.track_click(token)
-    # For a real user experience, you could fetch the original cta_link
-    # from the database and redirect them. For now, we show a simple message.
-    return "Thank you for your response! Your click has been recorded."
+    cta_link = cta_manager.track_click(token)
+    if cta_link is None:
+        return "This link is invalid or has expired.", 404
+    if not cta_link:
+        return "Thank you for your response! Your click has been recorded."
+    return redirect(cta_link, code=302)
     
-def run_server():
+def run_server(mode: str = SERVER_MODE):
     """
-    Runs the Flask server on a local-only address.
+    Runs the P2P server on a local-only address: the asyncio server
+    (core.async_server) in "async" mode, or this Flask app on Flask's
+    development server in "flask" mode.
     """
-    print("Starting local P2P server on http://127.0.0.1:5000...")
-    app.run(host='127.0.0.1', port=5000, debug=False)
+    if mode == "async":
+        run_async_server(SERVER_HOST, SERVER_PORT)
+    elif mode == "flask":
+        print(f"Starting local P2P server on http://{SERVER_HOST}:{SERVER_PORT}...")
+        app.run(host=SERVER_HOST, port=SERVER_PORT, debug=False)
+    else:
+        raise ValueError(f"Unknown server mode: {mode}")
@@ -0,0 +1,228 @@
+"""
+Concurrent sync of all known peers.
+
+The coordinator syncs every peer from the PeerManager in a bounded thread
+pool, so one slow or offline peer no longer stalls the round. Each peer
+address keeps its own keep-alive requests.Session across rounds. Peers that
+see the same change set (same ACL profile, watermark and compression method)
+share one gathered and signed copy of it, spooled to a temporary file once it
+outgrows SYNC_SPOOL_MAX_BYTES; only the per-peer encryption is repeated. The
+compression method for each peer is negotiated from the X-Sync-Compression
+header of its last /sync response; the first sync with a peer is sent
+uncompressed.
+"""
+
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import astuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from nacl.exceptions import CryptoError
+
+from config import SYNC_MAX_WORKERS, SYNC_CONNECT_TIMEOUT, SYNC_READ_TIMEOUT, SYNC_SPOOL_MAX_BYTES
+from core.anti_entropy import reconcile_peer
+from core.models import User, Peer
+from core.p2p import peer_profile, records_for_peer
+from core.peers import PeerManager
+from core.sync_protocol import sign_chunks, seal_stream
+from utils.compression import negotiate, parse_accepted
+from utils.crypto import get_keyring
+
+
+class _SharedChangeSet:
+    """
+    Signed chunks for one (ACL profile, watermark, compression) group, built
+    once on first use. They are written to a spooled temporary file, so only
+    their offsets stay in memory once the set outgrows `spool_max_bytes`, and
+    each peer's stream reads back one chunk at a time.
+    """
+
+    def __init__(self, profile: User, watermark: int, compression: str, spool_max_bytes: int = SYNC_SPOOL_MAX_BYTES):
+        self.profile = profile
+        self.watermark = watermark
+        self.compression = compression
+        self.spool_max_bytes = spool_max_bytes
+        self._lock = threading.Lock()
+        self._spool = None
+        self._index = None  # (offset, length, record_count) per signed chunk
+
+    def chunks(self, signing_key):
+        """Yields (signed_message, record_count) like sign_chunks, signing on the first call only."""
+        with self._lock:
+            if self._index is None:
+                spool = tempfile.SpooledTemporaryFile(max_size=self.spool_max_bytes)
+                index = []
+                try:
+                    for signed, record_count in sign_chunks(
+                        signing_key, records_for_peer(self.profile, self.watermark), compression=self.compression
+                    ):
+                        index.append((spool.tell(), len(signed), record_count))
+                        spool.write(signed)
+                except BaseException:
+                    spool.close()
+                    raise
+                self._spool, self._index = spool, index
+        return self._read()
+
+    def _read(self):
+        for offset, length, record_count in self._index:
+            # Peers read concurrently; each read repositions the shared file
+            with self._lock:
+                self._spool.seek(offset)
+                signed = self._spool.read(length)
+            yield signed, record_count
+
+    def close(self):
+        """Releases the spooled chunks."""
+        with self._lock:
+            if self._spool is not None:
+                self._spool.close()
+
+
+class SyncCoordinator:
+    """Syncs all known peers concurrently with bounded parallelism."""
+
+    def __init__(self, current_user: User, peer_manager: PeerManager,
+                 max_workers: int = SYNC_MAX_WORKERS,
+                 timeout: tuple = (SYNC_CONNECT_TIMEOUT, SYNC_READ_TIMEOUT)):
+        self.current_user = current_user
+        self.peer_manager = peer_manager
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+        self._accepted = {}  # peer address -> compression methods it advertised
+
+    def _session_for(self, address: str) -> requests.Session:
+        with self._sessions_lock:
+            session = self._sessions.get(address)
+            if session is None:
+                session = requests.Session()
+                # One sync at a time per peer, so one pooled connection suffices
+                session.mount(address, HTTPAdapter(pool_connections=1, pool_maxsize=1))
+                self._sessions[address] = session
+            return session
+
+    def _sync_peer(self, peer: Peer, change_set: _SharedChangeSet) -> dict:
+        started = time.perf_counter()
+        stats = {}
+        result = {'status': 'ok', 'records': 0, 'bytes': 0, 'summary': None}
+        try:
+            keyring = get_keyring()
+            signed_chunks = change_set.chunks(keyring.signing_key)
+            body = seal_stream(keyring, peer.public_key, self.current_user.id, signed_chunks, stats=stats,
+                               compression=change_set.compression)
+            response = self._session_for(peer.address).post(
+                f"{peer.address}/sync",
+                data=body,
+                headers={"Content-Type": "application/octet-stream"},
+                timeout=self.timeout
+            )
+            self._accepted[peer.address] = parse_accepted(response.headers.get('X-Sync-Compression'))
+            if response.status_code == 200:
+                try:
+                    result['summary'] = response.json().get('summary')
+                except (ValueError, AttributeError) as e:
+                    result['status'] = f"bad response: {e}"
+            else:
+                result['status'] = f"http {response.status_code}"
+        except requests.exceptions.RequestException as e:
+            result['status'] = f"unreachable: {e.__class__.__name__}"
+        except (IOError, ValueError, CryptoError) as e:
+            result['status'] = f"key error: {e}"
+        except sqlite3.Error as e:
+            # Raised while the change set is gathered, e.g. a lock timeout; the other peers still sync
+            result['status'] = f"database error: {e}"
+        result['records'] = stats.get('records', 0)
+        result['bytes'] = stats.get('bytes', 0)
+        result['latency_ms'] = int((time.perf_counter() - started) * 1000)
+        return result
+
+    def sync_all(self) -> dict:
+        """
+        Runs one sync round against every known peer and returns a result per
+        peer email ({status, latency_ms, bytes, records, summary}). Outcomes
+        are reported to PeerManager.update_last_synced; the watermark of each
+        successful peer advances to the time this round started.
+        """
+        round_started = int(time.time())
+        peers = self.peer_manager.get_all_peers()
+        print(f"\n--- Syncing {len(peers)} peers (up to {self.max_workers} at a time) ---")
+
+        change_sets = {}
+        jobs = []
+        for peer in peers:
+            profile = peer_profile(peer)
+            watermark = peer.last_synced or 0
+            compression = negotiate(self._accepted.get(peer.address))
+            key = (astuple(profile), watermark, compression)
+            if key not in change_sets:
+                change_sets[key] = _SharedChangeSet(profile, watermark, compression)
+            jobs.append((peer, change_sets[key]))
+
+        results = {}
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="sync") as pool:
+                futures = {pool.submit(self._sync_peer, peer, change_set): peer for peer, change_set in jobs}
+                for future in as_completed(futures):
+                    peer = futures[future]
+                    result = future.result()
+                    results[peer.email] = result
+                    print(f"  {peer.email}: {result['status']} in {result['latency_ms']} ms, "
+                          f"{result['records']} records, {result['bytes']} bytes")
+                    self.peer_manager.update_last_synced(peer.email, round_started, stats=result)
+        finally:
+            for change_set in change_sets.values():
+                change_set.close()
+
+        ok = sum(1 for result in results.values() if result['status'] == 'ok')
+        print(f"--- Sync round complete: {ok}/{len(peers)} peers succeeded "
+              f"({len(change_sets)} distinct change sets) ---")
+        return results
+
+    def reconcile_all(self) -> dict:
+        """
+        Runs anti-entropy reconciliation (core.anti_entropy) against every known
+        peer and returns a result per peer email. Unlike sync_all this doesn't
+        depend on the watermark, so it repairs rows a skewed clock or a missed
+        round left behind; a peer that reconciled successfully has everything
+        we had when the round started, so its watermark advances to then.
+        """
+        round_started = int(time.time())
+        peers = self.peer_manager.get_all_peers()
+        print(f"\n--- Reconciling {len(peers)} peers (up to {self.max_workers} at a time) ---")
+
+        def run(peer: Peer) -> dict:
+            started = time.perf_counter()
+            result = reconcile_peer(self.current_user, peer, self._session_for(peer.address), timeout=self.timeout)
+            result['latency_ms'] = int((time.perf_counter() - started) * 1000)
+            return result
+
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="reconcile") as pool:
+            futures = {pool.submit(run, peer): peer for peer in peers}
+            for future in as_completed(futures):
+                peer = futures[future]
+                result = future.result()
+                results[peer.email] = result
+                print(f"  {peer.email}: {result['status']} in {result['latency_ms']} ms, "
+                      f"{result['buckets']} buckets differed, {result['records']} records, "
+                      f"{result['hash_bytes']} + {result['bytes']} bytes")
+                self.peer_manager.update_last_synced(peer.email, round_started, stats=dict(
+                    result, bytes=result['hash_bytes'] + result['bytes']
+                ))
+
+        ok = sum(1 for result in results.values() if result['status'] == 'ok')
+        print(f"--- Reconciliation complete: {ok}/{len(peers)} peers succeeded ---")
+        return results
+
+    def close(self):
+        """Closes the keep-alive sessions."""
+        with self._sessions_lock:
+            sessions, self._sessions = self._sessions, {}
+        for session in sessions.values():
+            session.close()
@@ -0,0 +1,327 @@
+"""
+Framed streaming protocol used by /sync.
+
+A sync request body is a sequence of frames, each a 4-byte big-endian length
+followed by that many bytes:
+
+1. A plaintext *hello* frame: JSON with the protocol version, the sender's id,
+   the sender's Ed25519 public key (hex) and a random per-stream nonce. The
+   version names the chunk encoding: 2 for the binary codec (utils.codec), 1
+   for JSON. The receiver only accepts keys of registered peers.
+2. Any number of *chunk* frames. Each holds at most MAX_CHUNK_RECORDS records
+   of one table, encoded, signed with the sender's signing key and then
+   encrypted, behind the stream's nonce, with a Box between the sender and
+   the receiver. Only the two of them can produce such a frame, and the
+   receiver checks the nonce, so chunks can't be spliced or replayed from
+   one stream into another. The signature
+   covers the encoded bytes exactly as sent, so the receiver verifies them
+   before decoding and never re-encodes anything. If the hello names a
+   compression method (utils.compression), chunks are compressed before they
+   are signed and inflated, under MAX_MESSAGE_BYTES, after they are verified.
+3. A final *end* frame, signed and encrypted like a chunk, carrying the
+   number of chunks sent so a truncated stream is detected.
+
+Every chunk is verified and merged on its own, so neither side ever holds
+more than one chunk in memory, whatever the size of the dataset.
+"""
+
+import json
+import os
+import struct
+import time
+from itertools import groupby
+
+from nacl.exceptions import BadSignatureError, CryptoError
+
+from config import SYNC_ENCODING
+from utils.codec import decode_message, encode_message
+from utils.compression import Compressor, Decompressor, dictionary_id, require_dictionary
+from utils.crypto import KeyRing
+
+# Chunk encoding per protocol version
+ENCODINGS = {1: 'json', 2: 'binary'}
+ENCODING_VERSIONS = {encoding: version for version, encoding in ENCODINGS.items()}
+PROTOCOL_VERSION = ENCODING_VERSIONS['binary']
+
+# Upper bound on records per chunk; keeps each frame small and bounded.
+MAX_CHUNK_RECORDS = 200
+
+# Frames larger than this are rejected before being read into memory.
+MAX_FRAME_BYTES = 4 * 1024 * 1024
+
+# A compressed chunk may not inflate beyond this.
+MAX_MESSAGE_BYTES = 16 * 1024 * 1024
+
+# Random bytes that bind a stream's sealed frames to its hello
+STREAM_NONCE_BYTES = 16
+
+_LENGTH = struct.Struct(">I")
+
+# Bytes of the length prefix in front of every frame
+FRAME_HEADER_BYTES = _LENGTH.size
+
+
+class SyncProtocolError(Exception):
+    """The stream is malformed (bad framing, bad JSON, out-of-order chunks)."""
+    status_code = 400
+
+
+class SyncAuthError(SyncProtocolError):
+    """A frame could not be decrypted or its signature did not verify."""
+    status_code = 403
+
+
+def encode_frame(body: bytes) -> bytes:
+    """Prefixes a frame body with its length."""
+    return _LENGTH.pack(len(body)) + body
+
+
+def _read_exactly(stream, size: int) -> bytes:
+    buf = b""
+    while len(buf) < size:
+        piece = stream.read(size - len(buf))
+        if not piece:
+            break
+        buf += piece
+    return buf
+
+
+def frame_size(header: bytes, max_frame_bytes: int = MAX_FRAME_BYTES) -> int:
+    """The body size announced by a frame's length prefix, checked against the limit."""
+    if len(header) < _LENGTH.size:
+        raise SyncProtocolError("Truncated frame header")
+    (size,) = _LENGTH.unpack(header)
+    if size > max_frame_bytes:
+        raise SyncProtocolError(f"Frame of {size} bytes exceeds the {max_frame_bytes} byte limit")
+    return size
+
+
+def read_frames(stream, max_frame_bytes: int = MAX_FRAME_BYTES):
+    """Yields frame bodies from a file-like stream until it is exhausted."""
+    while True:
+        header = _read_exactly(stream, _LENGTH.size)
+        if not header:
+            return
+        size = frame_size(header, max_frame_bytes)
+        body = _read_exactly(stream, size)
+        if len(body) < size:
+            raise SyncProtocolError("Truncated frame body")
+        yield body
+
+
+def _encode_json(obj) -> bytes:
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+def _decode_json(message: bytes) -> dict:
+    chunk = json.loads(message)
+    if not isinstance(chunk, dict):
+        raise ValueError("expected an object")
+    return chunk
+
+
+_ENCODERS = {'json': _encode_json, 'binary': encode_message}
+_DECODERS = {'json': _decode_json, 'binary': decode_message}
+
+
+def iter_chunks(records, max_records: int = MAX_CHUNK_RECORDS):
+    """
+    Groups an iterable of (table_name, record) pairs into (table_name, [records])
+    chunks of at most `max_records`, preserving order.
+    """
+    for table_name, pairs in groupby(records, key=lambda pair: pair[0]):
+        chunk = []
+        for _, record in pairs:
+            chunk.append(record)
+            if len(chunk) >= max_records:
+                yield table_name, chunk
+                chunk = []
+        if chunk:
+            yield table_name, chunk
+
+
+def sign_chunks(signing_key, records, max_records: int = MAX_CHUNK_RECORDS, encoding: str = SYNC_ENCODING,
+                compression: str = 'none'):
+    """
+    Lazily yields (signed_message, record_count) for each chunk of `records`,
+    encoded with `encoding` ('binary' or 'json') and compressed with
+    `compression`, followed by the signed end marker with a record_count of
+    None. Signed chunks don't depend on the receiver, so a sender fanning out
+    to several peers can sign once and only seal (encrypt) per peer, with the
+    same `encoding` and `compression`.
+    """
+    encode = _ENCODERS[encoding]
+    compress = Compressor(compression).compress
+    chunks = 0
+    for seq, (table_name, chunk) in enumerate(iter_chunks(records, max_records)):
+        message = {
+            "seq": seq,
+            "table": table_name,
+            "records": chunk,
+            "timestamp": int(time.time()),
+        }
+        yield signing_key.sign(compress(encode(message))), len(chunk)
+        chunks += 1
+    yield signing_key.sign(compress(encode({"seq": chunks, "end": True, "chunks": chunks}))), None
+
+
+def seal_stream(keyring: KeyRing, peer_public_key_hex: str, sender_id: int,
+                signed_chunks, stats: dict = None, encoding: str = SYNC_ENCODING, compression: str = 'none'):
+    """
+    Returns a lazy iterator over the frames of a sync request: the hello frame,
+    then each of `signed_chunks` (from sign_chunks) encrypted for the peer.
+    Suitable as a chunked HTTP request body. Key errors are raised here rather
+    than mid-stream. If `stats` is given, it is updated with the chunk, record
+    and byte counts as frames are produced. `encoding` and `compression`
+    must be the ones the chunks were signed with.
+    """
+    box = keyring.box_for(peer_public_key_hex)
+    nonce = os.urandom(STREAM_NONCE_BYTES)
+    hello = {
+        "version": ENCODING_VERSIONS[encoding],
+        "sender_id": sender_id,
+        "public_key": keyring.public_key_hex,
+        "nonce": nonce.hex(),
+        "compression": compression,
+    }
+    if compression == 'zlib+dict':
+        hello["dictionary"] = dictionary_id(require_dictionary())
+    hello = encode_frame(_encode_json(hello))
+    stats = stats if stats is not None else {}
+    stats.update(chunks=0, records=0, bytes=0)
+    return _seal_frames(box, nonce, hello, signed_chunks, stats)
+
+
+def _seal_frames(box, nonce, hello, signed_chunks, stats):
+    stats['bytes'] += len(hello)
+    yield hello
+    for signed, record_count in signed_chunks:
+        frame = encode_frame(box.encrypt(nonce + signed))
+        stats['bytes'] += len(frame)
+        if record_count is not None:
+            stats['chunks'] += 1
+            stats['records'] += record_count
+        yield frame
+
+
+def encode_sync_stream(keyring: KeyRing, peer_public_key_hex: str, sender_id: int,
+                       records, max_records: int = MAX_CHUNK_RECORDS, stats: dict = None,
+                       encoding: str = SYNC_ENCODING, compression: str = 'none'):
+    """
+    Signs and seals `records`, an iterable of (table_name, record) pairs, into
+    a lazy frame stream for one peer. See sign_chunks and seal_stream.
+    """
+    signed_chunks = sign_chunks(keyring.signing_key, records, max_records, encoding, compression)
+    return seal_stream(keyring, peer_public_key_hex, sender_id, signed_chunks, stats, encoding, compression)
+
+
+class SyncReceiver:
+    """
+    Server side of the protocol: feed it frame bodies in order with
+    `handle_frame`, then call `finish` for the merge summary.
+    """
+
+    def __init__(self, keyring: KeyRing, merge, is_known_peer):
+        """
+        `merge(records, table_name)` applies one verified chunk and returns its
+        summary; streams are only accepted from senders for which
+        `is_known_peer(public_key_hex)` holds.
+        """
+        self.keyring = keyring
+        self.merge = merge
+        self.is_known_peer = is_known_peer
+        self.sender_id = None
+        self._nonce = None
+        self.summary = {'inserted': 0, 'updated': 0, 'skipped': 0, 'conflicts': 0}
+        self.records = 0
+        self._box = None
+        self._verify_key = None
+        self._decode = None
+        self._decompressor = None
+        self._next_seq = 0
+        self._ended = False
+
+    def _open_hello(self, body: bytes):
+        try:
+            hello = json.loads(body)
+            encoding = ENCODINGS.get(hello.get('version'))
+            if encoding is None:
+                raise SyncProtocolError(f"Unsupported sync protocol version: {hello.get('version')}")
+            self._decode = _DECODERS[encoding]
+            self._decompressor = Decompressor(
+                hello.get('compression', 'none'), MAX_MESSAGE_BYTES, hello.get('dictionary')
+            )
+            public_key = hello['public_key']
+            nonce = bytes.fromhex(hello['nonce'])
+            if len(nonce) != STREAM_NONCE_BYTES:
+                raise ValueError(f"nonce must be {STREAM_NONCE_BYTES} bytes")
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            # CompressionError (an unsupported method or dictionary) lands here too
+            raise SyncProtocolError(f"Invalid hello frame: {e}")
+        if not isinstance(public_key, str) or not self.is_known_peer(public_key):
+            raise SyncAuthError("Unknown peer")
+        try:
+            self._verify_key = self.keyring.verify_key_for(public_key)
+            self.sender_id = hello.get('sender_id')
+            self._nonce = nonce
+            self._box = self.keyring.box_for(public_key)
+        except (ValueError, TypeError) as e:
+            raise SyncProtocolError(f"Invalid hello frame: {e}")
+        except CryptoError as e:
+            raise SyncAuthError(f"Invalid sender public key: {e}")
+
+    def _open_sealed(self, body: bytes) -> dict:
+        try:
+            sealed = self._box.decrypt(body)
+        except CryptoError:
+            raise SyncAuthError("Decryption failed")
+        if sealed[:STREAM_NONCE_BYTES] != self._nonce:
+            raise SyncAuthError("Frame belongs to another stream")
+        signed = sealed[STREAM_NONCE_BYTES:]
+        try:
+            message = self._verify_key.verify(signed)
+        except BadSignatureError:
+            raise SyncAuthError("Invalid signature")
+        try:
+            return self._decode(self._decompressor.decompress(message))
+        except ValueError as e:
+            raise SyncProtocolError(f"Invalid chunk: {e}")
+
+    def handle_frame(self, body: bytes):
+        """Processes one frame body."""
+        if self._ended:
+            raise SyncProtocolError("Frame received after end of stream")
+        if self._box is None:
+            self._open_hello(body)
+            return
+
+        message = self._open_sealed(body)
+        if message.get('seq') != self._next_seq:
+            raise SyncProtocolError(f"Expected chunk {self._next_seq}, got {message.get('seq')}")
+        self._next_seq += 1
+
+        if message.get('end'):
+            self._ended = True
+            return
+
+        table_name = message.get('table')
+        records = message.get('records')
+        if not isinstance(table_name, str) or not isinstance(records, list):
+            raise SyncProtocolError("Chunk is missing its table or records")
+        if not all(isinstance(record, dict) for record in records):
+            raise SyncProtocolError("Chunk records must be objects")
+        self.records += len(records)
+        for key, count in self.merge(records, table_name).items():
+            self.summary[key] += count
+
+    def finish(self) -> dict:
+        """Returns the merge summary; fails if the stream ended early."""
+        if not self._ended:
+            raise SyncProtocolError("Stream ended before the end frame")
+        return self.summary
+
+    def receive(self, stream, max_frame_bytes: int = MAX_FRAME_BYTES) -> dict:
+        """Reads, verifies and merges a whole framed stream."""
+        for body in read_frames(stream, max_frame_bytes):
+            self.handle_frame(body)
+        return self.finish()
@@ -8,6 +8,9 @@ from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Any
 
 from ..acl.manager import ACLManager
+from core.engagement import credit
+from core.models import User
+from models.export import DictSink, ExportSink, export_visible
 
 
 class DataManager:
@@ -88,17 +91,17 @@ class DataManager:
             raise PermissionError("Cannot access this meeting")
         
         with self.db.get_connection() as conn:
+            previous = conn.execute("""
+                SELECT attended FROM attendance WHERE meeting_id = ? AND node_id = ?
+            """, (meeting_id, node_id)).fetchone()
             cursor = conn.execute("""
                 INSERT OR REPLACE INTO attendance (meeting_id, node_id, attended)
                 VALUES (?, ?, ?)
             """, (meeting_id, node_id, attended))
             
-            # Update CC score if attended
-            if attended:
-                conn.execute("""
-                    UPDATE nodes SET cc_score = cc_score + 1 
-                    WHERE id = ?
-                """, (node_id,))
+            # Credit (or, when un-marking, debit) the attendee's CC score
+            if attended != bool(previous and previous['attended']):
+                credit(conn, node_id, 'attendance', 1 if attended else -1)
             
             # Log the action
             self.log_action(user['id'], 'record_attendance', cursor.lastrowid, 
@@ -148,41 +151,18 @@ class DataManager:
             
             return user_id
     
-    def export_filtered_data(self, user: Dict[str, Any]) -> Dict[str, List]:
-        """Export all data visible to user for sync purposes"""
-        export_data = {}
-        
-        # Export each table with ACL filtering
-        tables_to_export = ['meetings', 'nodes', 'attendance', 'invitations', 'cta_log']
-        
-        for table in tables_to_export:
-            if table == 'meetings':
-                export_data[table] = self.get_filtered_meetings(user)
-            elif table == 'nodes':
-                export_data[table] = self.get_filtered_nodes(user)
-            elif table == 'attendance':
-                export_data[table] = self._get_filtered_attendance(user)
-            # Add other tables as needed
-        
-        return export_data
-    
-    def _get_filtered_attendance(self, user: Dict[str, Any]) -> List[Dict[str, Any]]:
-        """Get attendance records user can access"""
-        # Get meetings user can access, then get attendance for those meetings
-        accessible_meetings = self.get_filtered_meetings(user)
-        meeting_ids = [m['id'] for m in accessible_meetings]
-        
-        if not meeting_ids:
-            return []
-        
-        placeholders = ','.join('?' * len(meeting_ids))
-        
-        with self.db.get_connection() as conn:
-            cursor = conn.execute(f"""
-                SELECT * FROM attendance 
-                WHERE meeting_id IN ({placeholders})
-            """, meeting_ids)
-            return [dict(row) for row in cursor.fetchall()]
+    def export_filtered_data(self, user: Dict[str, Any], sink: ExportSink = None) -> Dict[str, Any]:
+        """
+        Export all data visible to user for sync purposes, streamed into `sink`
+        from one snapshot (see models.export). Without a sink the records are
+        collected and returned as {table: [records]}; with one, the row counts.
+        """
+        acl_user = User(id=user['id'], role=user['role'], region=user.get('region'))
+        if sink is not None:
+            return export_visible(acl_user, sink)
+        collected = DictSink()
+        export_visible(acl_user, collected)
+        return collected.data
     
     def cleanup_inactive_users(self, days_threshold: int = 45):
         """Deactivate users inactive for more than threshold days"""
@@ -0,0 +1,449 @@
+"""
+Multi-node sync load test.
+
+Starts `--nodes` independent nodes on ephemeral local ports. Each node is a
+child process with its own SQLite file, key pair (generate_and_store_keys)
+and config directory, selected with the SPANNING_TREE_* environment
+variables read by config.py; the database, key ring and connection pool are
+process-wide, so nodes can't share one process. Every node serves
+core.async_server and starts from the same seeded synthetic data set
+(utils.synthetic), so only the load test's own writes need to travel.
+
+The driver registers the nodes with each other through PeerManager (a full
+mesh, or `--peers` neighbours each on a connected random graph) and talks to
+them over their stdin/stdout, one JSON command and reply per line. It then
+runs rounds, all nodes at once:
+
+    write      each node inserts meetings and edits shared ones while it
+               syncs its peers (SyncCoordinator.sync_all)
+    sync       each node syncs its peers, with no new writes
+    reconcile  each node runs anti-entropy against its peers
+               (SyncCoordinator.reconcile_all); used once a sync round
+               delivers nothing and the nodes still differ
+
+After `--rounds` write rounds it keeps syncing until every node holds the
+same rows, or `--max-rounds` is reached, and reports the time and rounds to
+converge, records and bytes sent, merge throughput, failed syncs and merge
+conflicts (incoming edits that lost to a local one). Rows still different
+across nodes at the end are counted.
+
+    python loadtest.py --nodes 50 --peers 6 --rounds 5 --writes 20 --out load.json
+"""
+
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from pathlib import Path
+
+RESULTS_FORMAT = 1
+
+# New meetings take ids from a range per node; autoincrement ids aren't unique across nodes
+NODE_ID_RANGE = 10_000_000
+
+SUMMARY_KEYS = ('inserted', 'updated', 'skipped', 'conflicts')
+
+
+# --- Node side -------------------------------------------------------------
+
+class Node:
+    """One load-test node, driven by commands from the harness."""
+
+    def __init__(self, index: int, seed: int, max_syncs: int):
+        from config import SERVER_MAX_SYNCS
+        from core.async_server import AsyncServer
+        from core.models import User
+        from core.peers import PeerManager
+        from core.sync_coordinator import SyncCoordinator
+        from utils.crypto import get_keyring
+
+        self.index = index
+        self.rng = random.Random(seed * 100_003 + index)
+        self.email = f"node{index}@loadtest"
+        self.next_id = (index + 1) * NODE_ID_RANGE
+        self.peer_manager = PeerManager()
+        self.coordinator = SyncCoordinator(User(id=index + 1, role='national', region=None), self.peer_manager)
+        self.shared = []
+        self.host_id = None
+
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        server = AsyncServer(host="127.0.0.1", port=0, max_syncs=max_syncs or SERVER_MAX_SYNCS,
+                             peer_manager=self.peer_manager)
+        host, port = asyncio.run_coroutine_threadsafe(server.start(), loop).result()
+        self.address = f"http://{host}:{port}"
+        self.public_key = get_keyring().public_key_hex
+
+    def populate(self, rows: int, seed: int, now: int) -> dict:
+        from models.connection import connection
+        from utils.synthetic import populate
+
+        counts = populate(rows, seed, now) if rows else {}
+        with connection() as conn:
+            self.shared = [row['id'] for row in conn.execute("SELECT id FROM meetings ORDER BY id")]
+            self.host_id = conn.execute("SELECT min(id) FROM users").fetchone()[0]
+        return {"rows": sum(counts.values()), "shared": len(self.shared)}
+
+    def add_peers(self, peers: list, last_synced: int) -> dict:
+        from core.models import Peer
+
+        for peer in peers:
+            self.peer_manager.add_peer(Peer(email=peer['email'], public_key=peer['public_key'],
+                                            address=peer['address'], last_synced=last_synced))
+        return {"peers": len(peers)}
+
+    def write(self, count: int, edit_share: float, round_number: int) -> int:
+        """Makes `count` local writes, each in its own transaction; returns how many were made."""
+        from models.connection import transaction
+
+        for n in range(count):
+            with transaction() as conn:
+                if self.shared and self.rng.random() < edit_share:
+                    # Edits to the shared rows are what conflict across nodes
+                    conn.execute("UPDATE meetings SET title = ? WHERE id = ?",
+                                 (f"Edited by node {self.index} in round {round_number} ({n})",
+                                  self.rng.choice(self.shared)))
+                else:
+                    self.next_id += 1
+                    conn.execute(
+                        "INSERT INTO meetings (id, host_id, city, state, title) VALUES (?, ?, ?, ?, ?)",
+                        (self.next_id, self.host_id, "loadtest", "lt", f"Node {self.index} meeting {self.next_id}")
+                    )
+        return count
+
+    def round(self, kind: str, writes: int = 0, edit_share: float = 0.5, round_number: int = 0) -> dict:
+        """Runs one round; writes happen on a second thread while this node syncs its peers."""
+        writer = None
+        if writes:
+            writer = threading.Thread(target=self.write, args=(writes, edit_share, round_number))
+            writer.start()
+        if kind == 'reconcile':
+            results = self.coordinator.reconcile_all()
+        else:
+            results = self.coordinator.sync_all()
+        if writer is not None:
+            writer.join()
+
+        totals = {"writes": writes, "ok": 0, "failed": 0, "records": 0, "bytes": 0, "latency_ms": [],
+                  **{key: 0 for key in SUMMARY_KEYS}}
+        for result in results.values():
+            totals["ok" if result['status'] == 'ok' else "failed"] += 1
+            totals["records"] += result.get('records', 0)
+            totals["bytes"] += result.get('bytes', 0) + result.get('hash_bytes', 0)
+            totals["latency_ms"].append(result.get('latency_ms', 0))
+            for key, count in (result.get('summary') or {}).items():
+                if key in SUMMARY_KEYS:
+                    totals[key] += count
+        return totals
+
+    def row_hashes(self) -> dict:
+        """A short hash of every synced row, by table and id."""
+        from models.connection import connection
+        from models.sync import SYNC_TABLES
+
+        hashes = {}
+        with connection() as conn:
+            for table in SYNC_TABLES.values():
+                hashes[table.name] = {
+                    row[0]: hashlib.blake2b(repr(tuple(row)).encode(), digest_size=8).hexdigest()
+                    for row in conn.execute(f"SELECT {', '.join(table.columns)} FROM {table.name} ORDER BY id")
+                }
+        return hashes
+
+    def digest(self) -> dict:
+        """One hash over every synced row, for comparing nodes cheaply."""
+        hashes = self.row_hashes()
+        digest = hashlib.sha256()
+        for table in sorted(hashes):
+            for row_id, row_hash in hashes[table].items():
+                digest.update(f"{table}:{row_id}:{row_hash};".encode())
+        return {"digest": digest.hexdigest(), "rows": sum(len(rows) for rows in hashes.values())}
+
+
+def run_node(workdir: Path, index: int, seed: int, max_syncs: int):
+    """Child process entry point: answers JSON commands from stdin on stdout; the node's own output goes to node.log."""
+    for name in ('data', 'keys', 'config'):
+        (workdir / name).mkdir(parents=True, exist_ok=True)
+        os.environ[f"SPANNING_TREE_{name.upper()}_DIR"] = str(workdir / name)
+    replies = sys.stdout
+    sys.stdout = sys.stderr = open(workdir / "node.log", "w", buffering=1)
+
+    def reply(message: dict):
+        replies.write(json.dumps(message) + "\n")
+        replies.flush()
+
+    from models.database import initialize_database
+    from utils.crypto import generate_and_store_keys
+
+    generate_and_store_keys()
+    initialize_database()
+    node = Node(index, seed, max_syncs)
+    reply({"email": node.email, "address": node.address, "public_key": node.public_key})
+
+    commands = {
+        "populate": node.populate,
+        "peers": node.add_peers,
+        "round": node.round,
+        "digest": node.digest,
+        "rows": node.row_hashes,
+    }
+    for line in sys.stdin:
+        command = json.loads(line)
+        op = command.pop("op")
+        if op == "quit":
+            break
+        try:
+            reply({"ok": commands[op](**command)})
+        except Exception as e:
+            print(f"Command '{op}' failed: {e!r}")
+            traceback.print_exc()
+            reply({"error": f"{op}: {e!r}"})
+    node.coordinator.close()
+
+
+# --- Driver side -----------------------------------------------------------
+
+class NodeProcess:
+    """The harness's handle on one node child process."""
+
+    def __init__(self, index: int, workdir: Path, seed: int, max_syncs: int):
+        self.index = index
+        self.workdir = workdir
+        self.process = subprocess.Popen(
+            [sys.executable, str(Path(__file__).resolve()), "--node", str(workdir), "--index", str(index),
+             "--seed", str(seed), "--max-syncs", str(max_syncs)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, cwd=Path(__file__).parent
+        )
+        self.info = None
+
+    def _read(self) -> dict:
+        line = self.process.stdout.readline()
+        if not line:
+            raise RuntimeError(f"Node {self.index} exited; see {self.workdir / 'node.log'}")
+        message = json.loads(line)
+        if "error" in message:
+            raise RuntimeError(f"Node {self.index}: {message['error']}")
+        return message
+
+    def started(self) -> dict:
+        if self.info is None:
+            self.info = self._read()
+        return self.info
+
+    def send(self, op: str, **arguments):
+        self.process.stdin.write(json.dumps({"op": op, **arguments}) + "\n")
+        self.process.stdin.flush()
+
+    def result(self):
+        return self._read()["ok"]
+
+    def stop(self):
+        if self.process.poll() is None:
+            try:
+                self.send("quit")
+                self.process.wait(timeout=30)
+            except (OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+
+
+def _broadcast(nodes: list, op: str, **arguments) -> list:
+    """Sends a command to every node at once, then collects the replies in order."""
+    for node in nodes:
+        node.send(op, **arguments)
+    return [node.result() for node in nodes]
+
+
+def build_topology(count: int, degree: int, seed: int) -> dict:
+    """
+    Undirected neighbour sets: a full mesh when `degree` is 0 or covers every
+    node, otherwise a ring (so the graph is connected) plus random links until
+    each node has at least `degree` neighbours.
+    """
+    if not degree or degree >= count - 1:
+        return {i: {j for j in range(count) if j != i} for i in range(count)}
+    rng = random.Random(seed)
+    neighbours = {i: {(i - 1) % count, (i + 1) % count} - {i} for i in range(count)}
+    for i in range(count):
+        candidates = [j for j in range(count) if j != i and j not in neighbours[i]]
+        rng.shuffle(candidates)
+        while len(neighbours[i]) < degree and candidates:
+            j = candidates.pop()
+            neighbours[i].add(j)
+            neighbours[j].add(i)
+    return neighbours
+
+
+def _divergent_rows(nodes: list) -> int:
+    """Rows (table and id) that are missing on some node or differ between nodes."""
+    hashes = _broadcast(nodes, "rows")
+    divergent = 0
+    for table in hashes[0]:
+        ids = set().union(*(node_hashes[table].keys() for node_hashes in hashes))
+        for row_id in ids:
+            if len({node_hashes[table].get(row_id) for node_hashes in hashes}) > 1:
+                divergent += 1
+    return divergent
+
+
+def run_load_test(args, workdir: Path, log) -> dict:
+    nodes = []
+    try:
+        started = time.perf_counter()
+        nodes = [NodeProcess(i, workdir / f"node{i}", args.seed, args.max_syncs) for i in range(args.nodes)]
+        infos = [node.started() for node in nodes]
+        log(f"Started {len(nodes)} nodes in {time.perf_counter() - started:.1f}s")
+
+        now = int(time.time())
+        populated = _broadcast(nodes, "populate", rows=args.base_rows, seed=args.seed, now=now)
+        log(f"Each node holds {populated[0]['rows']} shared rows ({populated[0]['shared']} editable meetings)")
+
+        topology = build_topology(args.nodes, args.peers, args.seed)
+        # The shared data set is already everywhere, so the watermarks start now
+        registered = int(time.time())
+        for node in nodes:
+            node.send("peers", peers=[infos[j] for j in sorted(topology[node.index])], last_synced=registered)
+        for node in nodes:
+            node.result()
+        edges = sum(len(neighbours) for neighbours in topology.values()) // 2
+        log(f"Registered {edges} peer links ({min(len(n) for n in topology.values())}"
+            f"-{max(len(n) for n in topology.values())} peers per node)")
+
+        baseline = {info['digest'] for info in _broadcast(nodes, "digest")}
+        if len(baseline) != 1:
+            raise RuntimeError("Nodes didn't start from the same data")
+
+        rounds, writes_ended, converged_at = [], None, None
+        kind = 'write'
+        for number in range(1, args.max_rounds + 1):
+            if number > args.rounds and kind == 'write':
+                kind = 'sync'
+            round_started = time.perf_counter()
+            totals = _broadcast(nodes, "round", kind=kind, writes=args.writes if kind == 'write' else 0,
+                                edit_share=args.edit_share, round_number=number)
+            duration = time.perf_counter() - round_started
+            if kind == 'write':
+                writes_ended = time.perf_counter()
+
+            latencies = sorted(ms for total in totals for ms in total['latency_ms'])
+            record = {
+                "round": number, "kind": kind, "duration_ms": round(duration * 1000, 1),
+                **{key: sum(total[key] for total in totals)
+                   for key in ('writes', 'ok', 'failed', 'records', 'bytes', *SUMMARY_KEYS)},
+                "latency_p50_ms": latencies[len(latencies) // 2] if latencies else None,
+                "latency_max_ms": latencies[-1] if latencies else None,
+            }
+            digests = _broadcast(nodes, "digest")
+            record["distinct_states"] = len({digest['digest'] for digest in digests})
+            rounds.append(record)
+            log(f"  round {number:>3} {kind:<9} {record['duration_ms']:9.1f} ms  "
+                f"{record['ok']} ok / {record['failed']} failed syncs, {record['records']} records, "
+                f"{record['bytes']} bytes, {record['inserted']} inserted, {record['updated']} updated, "
+                f"{record['conflicts']} conflicts, {record['distinct_states']} distinct states")
+
+            if kind == 'write':
+                continue
+            if record['distinct_states'] == 1:
+                converged_at = time.perf_counter()
+                break
+            delivered = record['inserted'] + record['updated']
+            if kind == 'sync' and not delivered and args.reconcile:
+                kind = 'reconcile'  # Watermark sync has nothing left to send
+            elif kind == 'reconcile' and not delivered and not record['failed']:
+                log("  reconciliation delivered nothing; the remaining differences won't converge")
+                break
+
+        sync_rounds = [r for r in rounds if r['kind'] != 'write']
+        sent = sum(r['records'] for r in rounds)
+        merged = sum(r['inserted'] + r['updated'] for r in rounds)
+        busy = sum(r['duration_ms'] for r in rounds) / 1000
+        summary = {
+            "converged": converged_at is not None,
+            "convergence_s": round(converged_at - writes_ended, 3) if converged_at and writes_ended else None,
+            "convergence_rounds": len(sync_rounds) if converged_at else None,
+            "reconcile_rounds": sum(1 for r in rounds if r['kind'] == 'reconcile'),
+            "writes": sum(r['writes'] for r in rounds),
+            "records_sent": sent,
+            "bytes": sum(r['bytes'] for r in rounds),
+            "records_sent_per_s": round(sent / busy, 1) if busy else None,
+            "records_merged_per_s": round(merged / busy, 1) if busy else None,
+            "failed_syncs": sum(r['failed'] for r in rounds),
+            "conflicts": sum(r['conflicts'] for r in rounds),
+            "divergent_rows": 0 if converged_at else _divergent_rows(nodes),
+        }
+        return {"populated": populated[0], "links": edges, "rounds": rounds, "summary": summary}
+    finally:
+        for node in nodes:
+            node.stop()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Load-test sync across many local nodes.")
+    parser.add_argument("--nodes", type=int, default=10)
+    parser.add_argument("--peers", type=int, default=0, help="neighbours per node (default 0: full mesh)")
+    parser.add_argument("--base-rows", type=int, default=5000, help="shared synthetic rows every node starts with")
+    parser.add_argument("--rounds", type=int, default=3, help="rounds with writes")
+    parser.add_argument("--writes", type=int, default=20, help="writes per node per write round")
+    parser.add_argument("--edit-share", type=float, default=0.5, help="share of writes that edit shared meetings")
+    parser.add_argument("--max-rounds", type=int, default=30, help="rounds in total, including the write rounds")
+    parser.add_argument("--no-reconcile", dest="reconcile", action="store_false",
+                        help="don't fall back to anti-entropy when sync stops delivering")
+    parser.add_argument("--max-syncs", type=int, default=0, help="sync streams each node serves at once")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="write the results as JSON to this file")
+    parser.add_argument("--workdir", help="empty or new directory for the nodes' files (default: a temporary one)")
+    parser.add_argument("--node", help=argparse.SUPPRESS)
+    parser.add_argument("--index", type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.node:
+        run_node(Path(args.node), args.index, args.seed, args.max_syncs)
+        return 0
+
+    def log(line: str):
+        print(line, flush=True)
+
+    if args.workdir and Path(args.workdir).exists() and any(Path(args.workdir).iterdir()):
+        # Nodes would pick up the databases and keys of an earlier run
+        parser.error(f"--workdir {args.workdir} is not empty")
+
+    with contextlib.ExitStack() as stack:
+        workdir = Path(args.workdir) if args.workdir else Path(stack.enter_context(tempfile.TemporaryDirectory()))
+        log(f"Load test: {args.nodes} nodes, {args.peers or 'all'} peers each, {args.rounds} write rounds "
+            f"of {args.writes} writes per node, in {workdir}")
+        outcome = run_load_test(args, workdir, log)
+
+    summary = outcome["summary"]
+    if summary["converged"]:
+        log(f"Converged {summary['convergence_s']}s after the last write round "
+            f"({summary['convergence_rounds']} rounds, {summary['reconcile_rounds']} of them reconciliation).")
+    else:
+        log(f"Did not converge: {summary['divergent_rows']} rows still differ between nodes.")
+    log(f"{summary['records_sent']} records and {summary['bytes']} bytes sent, "
+        f"{summary['records_merged_per_s']} records merged/s, {summary['failed_syncs']} failed syncs, "
+        f"{summary['conflicts']} conflicts.")
+
+    if args.out:
+        report = {
+            "format": RESULTS_FORMAT,
+            "meta": {key: getattr(args, key) for key in ('nodes', 'peers', 'base_rows', 'rounds', 'writes',
+                                                          'edit_share', 'max_rounds', 'reconcile', 'max_syncs', 'seed')},
+            **outcome,
+        }
+        report["meta"].update(timestamp=int(time.time()), cpus=os.cpu_count())
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        log(f"Results written to {args.out}")
+    return 0 if summary["converged"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,11 +3,13 @@ import time
 import threading
 import requests # We'll use requests to simulate a link click
 
-from models.database import initialize_database, get_db_connection
+from models.database import initialize_database
+from models.connection import connection, transaction, db_manager
 from utils.crypto import generate_and_store_keys
 from core.models import User
 from core.server import run_server
 from core.cta import CtaManager
+from core.engagement import start_reconciler
 
 def initialize_environment():
     """Ensures all necessary directories exist and runs all setup functions."""
@@ -29,19 +31,18 @@ def setup_cta_demo_data(conn):
     ]
     conn.execute("DELETE FROM users")
     conn.executemany("INSERT INTO users (id, email, public_key, role, region) VALUES (?, ?, ?, ?, ?)", users)
-    conn.commit()
 
 def run_app():
     """Demonstrates the Mass Email CTA workflow."""
     print("\nWelcome to the Spanning Tree of Life Organizer System!")
     
-    conn = get_db_connection()
-    setup_cta_demo_data(conn)
-    conn.close()
+    with transaction() as conn:
+        setup_cta_demo_data(conn)
 
     # --- Start the P2P server in a background thread ---
     server_thread = threading.Thread(target=run_server, daemon=True)
     server_thread.start()
+    start_reconciler()
     time.sleep(1) 
 
     # --- DEMO: CTA Workflow ---
@@ -61,15 +62,15 @@ def run_app():
     # In a real scenario, the user would click this link in their email client.
     # We will grab a token from the database to simulate this.
     print("\n--- Simulating a user clicking a CTA link ---")
-    conn = get_db_connection()
-    # Get a token that was just sent to the municipal user (ID 30)
-    result = conn.execute("SELECT token FROM email_log WHERE recipient_id = 30").fetchone()
-    conn.close()
+    with connection() as conn:
+        # Get a token that was just sent to the municipal user (ID 30)
+        result = conn.execute("SELECT token FROM email_log WHERE recipient_id = 30").fetchone()
     
     if result:
         token_to_click = result['token']
         # Use requests to "click" the link by sending a request to our server
-        requests.get(f"http://127.0.0.1:5000/cta/{token_to_click}")
+        response = requests.get(f"http://127.0.0.1:5000/cta/{token_to_click}", allow_redirects=False)
+        print(f"Server redirected the click to: {response.headers.get('Location')}")
     
     print("\n--- Demo Complete. Application is idle. ---")
     print("Press Ctrl+C to exit.")
@@ -79,6 +80,7 @@ def run_app():
             time.sleep(1)
     except KeyboardInterrupt:
         print("\nShutting down application.")
+        db_manager.close_all()
 
 
 if __name__ == "__main__":
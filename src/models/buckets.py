@@ -0,0 +1,148 @@
+"""
+Range hashes over the synced tables, for anti-entropy reconciliation.
+
+Every synced table is cut into buckets of BUCKET_SIZE consecutive ids. A
+bucket's digest is the XOR of a 64-bit hash of (id, last_modified) for each
+of its rows; that pair decides what a merge keeps, so two replicas whose
+digests match for a bucket need nothing from each other for it. XOR makes a
+group of buckets hash to the XOR of the bucket digests, so any range can be
+summarized at any granularity from sync_buckets alone, like the levels of a
+Merkle tree.
+
+Digests are maintained lazily. Triggers record which buckets a write touched
+in sync_dirty_buckets (plain SQL, so every writer is covered), and
+`refresh_buckets` rehashes only those buckets before digests are read.
+Ids are assumed positive, as SQLite assigns them.
+"""
+
+import hashlib
+from typing import Dict, List, Optional, Tuple
+
+from models.connection import connection, transaction
+from models.sync import SYNC_TABLES
+
+# Ids per bucket. Peers must agree on it; it is part of every bucket exchange.
+BUCKET_SIZE = 256
+
+CREATE_BUCKETS_TABLE = """
+CREATE TABLE IF NOT EXISTS sync_buckets (
+    table_name TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    digest INTEGER NOT NULL,
+    rows INTEGER NOT NULL,
+    PRIMARY KEY (table_name, bucket)
+) WITHOUT ROWID
+"""
+
+CREATE_DIRTY_TABLE = """
+CREATE TABLE IF NOT EXISTS sync_dirty_buckets (
+    table_name TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    PRIMARY KEY (table_name, bucket)
+) WITHOUT ROWID
+"""
+
+
+def row_digest(row_id: int, last_modified) -> int:
+    """64-bit hash of a row's (id, last_modified), as a signed SQLite INTEGER."""
+    digest = hashlib.blake2b(f"{row_id}|{last_modified}".encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def bucket_bounds(bucket: int) -> Tuple[int, int]:
+    """The first and last id of a bucket."""
+    return bucket * BUCKET_SIZE, bucket * BUCKET_SIZE + BUCKET_SIZE - 1
+
+
+def ensure_bucket_schema(conn):
+    """Creates the bucket tables and triggers, and marks every existing bucket for hashing."""
+    conn.execute(CREATE_BUCKETS_TABLE)
+    conn.execute(CREATE_DIRTY_TABLE)
+    for table in SYNC_TABLES.values():
+        # Not INSERT OR IGNORE: inside an upsert's trigger the outer statement's
+        # conflict handling applies, and a duplicate would abort the merge.
+        mark = (
+            "INSERT INTO sync_dirty_buckets (table_name, bucket) SELECT '{table}', {row}.id / {size} "
+            "WHERE NOT EXISTS (SELECT 1 FROM sync_dirty_buckets "
+            "WHERE table_name = '{table}' AND bucket = {row}.id / {size});"
+        )
+        for event, rows in (('INSERT', ('NEW',)), ('UPDATE OF id, last_modified', ('NEW', 'OLD')), ('DELETE', ('OLD',))):
+            name = f"trg_{table.name}_buckets_{event.split()[0].lower()}"
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON {table.name}
+                BEGIN
+                    {" ".join(mark.format(table=table.name, row=row, size=BUCKET_SIZE) for row in rows)}
+                END
+            """)
+        conn.execute(
+            "INSERT OR IGNORE INTO sync_dirty_buckets (table_name, bucket) "
+            f"SELECT DISTINCT ?, id / {BUCKET_SIZE} FROM {table.name}",
+            (table.name,)
+        )
+
+
+def refresh_buckets(conn) -> int:
+    """Rehashes the dirty buckets on `conn` (the caller owns the transaction); returns how many."""
+    dirty = conn.execute("SELECT table_name, bucket FROM sync_dirty_buckets").fetchall()
+    for table_name, bucket in dirty:
+        if table_name not in SYNC_TABLES:
+            continue
+        digest, rows = 0, 0
+        for row_id, last_modified in conn.execute(
+            f"SELECT id, last_modified FROM {table_name} WHERE id BETWEEN ? AND ?", bucket_bounds(bucket)
+        ):
+            digest ^= row_digest(row_id, last_modified)
+            rows += 1
+        if rows:
+            conn.execute(
+                "INSERT INTO sync_buckets (table_name, bucket, digest, rows) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (table_name, bucket) DO UPDATE SET digest = excluded.digest, rows = excluded.rows",
+                (table_name, bucket, digest, rows)
+            )
+        else:
+            conn.execute("DELETE FROM sync_buckets WHERE table_name = ? AND bucket = ?", (table_name, bucket))
+    conn.execute("DELETE FROM sync_dirty_buckets")
+    return len(dirty)
+
+
+def _refresh_if_dirty():
+    # Most reads find nothing to rehash and never take the write lock
+    with connection() as conn:
+        if conn.execute("SELECT 1 FROM sync_dirty_buckets LIMIT 1").fetchone() is None:
+            return
+    with transaction() as conn:
+        refresh_buckets(conn)
+
+
+def group_hashes(table_name: str, ranges: List[Tuple[int, Optional[int], int]]) -> List[Dict[int, Tuple[int, int]]]:
+    """
+    Summarizes `table_name` over each (first bucket, last bucket or None for
+    no limit, span) range: {group: (digest, rows)} for the non-empty groups,
+    where group g covers buckets g * span to g * span + span - 1. All ranges
+    are read from one snapshot, after the dirty buckets are rehashed.
+    """
+    if table_name not in SYNC_TABLES:
+        raise ValueError(f"Not a synced table: {table_name}")
+    _refresh_if_dirty()
+    results = []
+    with transaction(immediate=False) as conn:
+        for first, last, span in ranges:
+            groups = {}
+            rows = conn.execute(
+                "SELECT bucket, digest, rows FROM sync_buckets WHERE table_name = ? AND bucket BETWEEN ? AND ?",
+                (table_name, first, last if last is not None else 2 ** 62)
+            )
+            for bucket, digest, count in rows:
+                group_digest, group_rows = groups.get(bucket // span, (0, 0))
+                groups[bucket // span] = (group_digest ^ digest, group_rows + count)
+            results.append(groups)
+    return results
+
+
+def top_bucket(table_name: str) -> int:
+    """The highest non-empty bucket of a table (-1 if it is empty)."""
+    _refresh_if_dirty()
+    with connection() as conn:
+        return conn.execute(
+            "SELECT coalesce(max(bucket), -1) FROM sync_buckets WHERE table_name = ?", (table_name,)
+        ).fetchone()[0]
@@ -1,223 +1,186 @@
 import sqlite3
+from typing import Iterator, Optional, Sequence
 from config import DB_PATH
 from core.models import User
 from acl.permissions import get_acl_filter_clause
+from models.connection import connection, transaction, configure_connection
+from core.engagement import GLOBAL_REGION, merge_shares, read_shares, refresh_regions
+from models.invite_tree import link_records
+from models.migrations import migrate
+from models.sync import SYNC_TABLES, bulk_merge
+from models.field_versions import merge_versioned
 
 
 def get_db_connection():
-    """Establishes and returns a connection to the SQLite database."""
+    """
+    Establishes and returns a new, caller-owned connection to the SQLite database.
+    Prefer `connection()` / `transaction()` from models.connection, which reuse a
+    pooled per-thread connection instead of opening a new one on every call.
+    """
     conn = sqlite3.connect(DB_PATH)
     # This line allows us to access columns by name (e.g., results['title'])
     conn.row_factory = sqlite3.Row
+    configure_connection(conn)
     return conn
 
 def initialize_database():
     """
-    Connects to the database and creates all necessary tables if they don't exist.
+    Connects to the database and brings its schema up to date (see models.migrations).
     """
     print("Initializing database...")
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Defines the schema for the 'users' table
-        create_users_table = """
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY,
-            email TEXT UNIQUE NOT NULL,
-            public_key TEXT NOT NULL,
-            role TEXT CHECK(role IN ('connector', 'shadower', 'facilitator', 'municipal', 'statal', 'national', 'dev')),
-            region TEXT,
-            cc_score INTEGER DEFAULT 0,
-            last_active TIMESTAMP,
-            is_active BOOLEAN DEFAULT 1
-        );
-        """
-
-        # Defines the schema for the 'audit_log' table
-        create_audit_log_table = """
-        CREATE TABLE IF NOT EXISTS audit_log (
-            id INTEGER PRIMARY KEY,
-            action TEXT,
-            performed_by INTEGER REFERENCES users(id),
-            record_id INTEGER,
-            entity TEXT,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            signature TEXT
-        );
-        """
-        
-        # Defines the schema for the 'meetings' table, including the last_modified column for syncing
-        create_meetings_table = """
-        CREATE TABLE IF NOT EXISTS meetings (
-            id INTEGER PRIMARY KEY,
-            host_id INTEGER REFERENCES users(id),
-            city TEXT,
-            state TEXT,
-            scheduled_at TIMESTAMP,
-            title TEXT,
-            notes TEXT,
-            last_modified TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-        """
-        
-        create_invitations_table = """
-        CREATE TABLE IF NOT EXISTS invitations (
-            id INTEGER PRIMARY KEY,
-            email TEXT NOT NULL,
-            invited_by INTEGER REFERENCES users(id),
-            used BOOLEAN DEFAULT 0,
-            token TEXT UNIQUE NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-        """
-
-        create_signups_table = """
-        CREATE TABLE IF NOT EXISTS signups (
-            id INTEGER PRIMARY KEY,
-            name TEXT,
-            email TEXT UNIQUE,
-            invited_by INTEGER REFERENCES users(id),
-            city TEXT,
-            state TEXT,
-            zip TEXT,
-            neighborhood TEXT,
-            occupation TEXT,
-            token TEXT UNIQUE,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-        """
-
-        create_email_log_table = """
-        CREATE TABLE IF NOT EXISTS email_log (
-            id INTEGER PRIMARY KEY,
-            sender_id INTEGER REFERENCES users(id),
-            recipient_id INTEGER REFERENCES users(id),
-            subject TEXT,
-            cta_link TEXT,
-            token TEXT UNIQUE NOT NULL,
-            sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            responded_at TIMESTAMP
-        );
-        """
-
-        # Execute the SQL commands to create the tables
-        cursor.execute(create_users_table)
-        cursor.execute(create_audit_log_table)
-        cursor.execute(create_meetings_table)
-        cursor.execute(create_invitations_table)
-        cursor.execute(create_signups_table)
-        cursor.execute(create_email_log_table)
-        
-        conn.commit()
-        conn.close()
-        print(f"Database ready at: {DB_PATH}")
+        version = migrate()
+        print(f"Database ready at: {DB_PATH} (schema version {version})")
     except sqlite3.Error as e:
         print(f"Database error: {e}")
 
 
-def find_records(table_name: str, user: User) -> list:
+# Rows fetched per query by iter_records
+FIND_PAGE_SIZE = 500
+
+_table_columns = {}
+
+
+def _columns_of(table_name: str) -> tuple:
+    """The table's column names; also guards the names interpolated into SQL."""
+    columns = _table_columns.get(table_name)
+    if columns is None:
+        with connection() as conn:
+            columns = tuple(row['name'] for row in conn.execute(f"PRAGMA table_info({table_name})"))
+        if not columns:
+            raise ValueError(f"Unknown table: {table_name}")
+        _table_columns[table_name] = columns
+    return columns
+
+
+def iter_records(table_name: str, user: Optional[User], columns: Optional[Sequence[str]] = None,
+                 order_by: Sequence[str] = ('id',), page_size: int = FIND_PAGE_SIZE,
+                 after: Optional[tuple] = None, where: str = None, params: tuple = ()) -> Iterator[sqlite3.Row]:
+    """
+    Lazily yields the rows of `table_name` that `user` may see (no ACL filter
+    if `user` is None), a page at a time, with no read held open between pages.
+
+    - `columns`: the projection (default: every column). The `order_by`
+      columns are always selected too.
+    - `order_by`: the keyset, ascending. 'id' is appended if missing so the
+      order is total; the columns should be NOT NULL, since a NULL key ends
+      the scan early.
+    - `after`: resume cursor, the `order_by` values of the last row already
+      seen (see `record_cursor`).
+    - `where`/`params`: an extra filter ANDed with the ACL clause.
+    """
+    known = _columns_of(table_name)
+    order_by = tuple(order_by) if 'id' in order_by else (*order_by, 'id')
+    selected = list(known if columns is None else columns)
+    selected += [column for column in order_by if column not in selected]
+    unknown = [column for column in selected if column not in known]
+    if unknown:
+        raise ValueError(f"Unknown columns for {table_name}: {', '.join(unknown)}")
+
+    clause, acl_params = get_acl_filter_clause(user, table_name) if user else ("1 = 1", ())
+    if clause == "1 = 0":
+        return
+    filters = f"({clause})" + (f" AND ({where})" if where else "")
+    key = ", ".join(order_by)
+    projection = ", ".join(selected)
+    first_page_sql = f"SELECT {projection} FROM {table_name} WHERE {filters} ORDER BY {key} LIMIT ?"
+    next_page_sql = (
+        f"SELECT {projection} FROM {table_name} WHERE {filters} AND ({key}) > ({', '.join('?' for _ in order_by)}) "
+        f"ORDER BY {key} LIMIT ?"
+    )
+
+    while True:
+        with connection() as conn:
+            if after is None:
+                rows = conn.execute(first_page_sql, (*acl_params, *params, page_size)).fetchall()
+            else:
+                rows = conn.execute(next_page_sql, (*acl_params, *params, *after, page_size)).fetchall()
+        yield from rows
+        if len(rows) < page_size:
+            return
+        after = record_cursor(rows[-1], order_by)
+
+
+def record_cursor(row, order_by: Sequence[str] = ('id',)) -> tuple:
+    """The resume cursor for iter_records after `row`."""
+    order_by = tuple(order_by) if 'id' in order_by else (*order_by, 'id')
+    return tuple(row[column] for column in order_by)
+
+
+def find_records(table_name: str, user: User, columns: Optional[Sequence[str]] = None) -> list:
     """
     Finds records from a table, automatically applying ACL filtering.
+    Returns them all as dicts; use iter_records to stream large results.
     """
-    # The table_name is now passed to the ACL function
-    clause, params = get_acl_filter_clause(user, table_name)
-    
-    sql = f"SELECT * FROM {table_name} WHERE {clause}"
-    
-    print(f"\nExecuting query for user '{user.role}' in '{user.region}':")
-    print(f"SQL: {sql}")
-    print(f"Params: {params}")
-    
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(sql, params)
-    results = cursor.fetchall()
-    conn.close()
-    
-    return [dict(row) for row in results]
+    return [dict(row) for row in iter_records(table_name, user, columns)]
 
 
 def setup_demo_data():
     """Inserts or resets sample data in the database for demos."""
     print("Setting up demo data...")
-    conn = get_db_connection()
-
-    # Setup meetings data
-    meetings = [
-        (20, 'nyc', 'ny', 'Meeting A in NYC'),
-        (21, 'nyc', 'ny', 'Meeting B in NYC'),
-        (40, 'albany', 'ny', 'Meeting C in Albany'),
-        (41, 'sf', 'ca', 'Meeting D in SF')
-    ]
-    conn.execute("DELETE FROM meetings")
-    conn.executemany("INSERT INTO meetings (host_id, city, state, title) VALUES (?, ?, ?, ?)", meetings)
-    
-    # Setup users data
-    users = [
-        (10, 'shadower@example.com', 'key1', 'shadower', 'nyc'),
-        (20, 'facilitator@example.com', 'key2', 'facilitator', 'nyc'),
-        (30, 'municipal@example.com', 'key3', 'municipal', 'nyc')
-    ]
-    conn.execute("DELETE FROM users")
-    conn.executemany("INSERT INTO users (id, email, public_key, role, region) VALUES (?, ?, ?, ?, ?)", users)
-
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        # Setup meetings data
+        meetings = [
+            (20, 'nyc', 'ny', 'Meeting A in NYC'),
+            (21, 'nyc', 'ny', 'Meeting B in NYC'),
+            (40, 'albany', 'ny', 'Meeting C in Albany'),
+            (41, 'sf', 'ca', 'Meeting D in SF')
+        ]
+        conn.execute("DELETE FROM meetings")
+        conn.executemany("INSERT INTO meetings (host_id, city, state, title) VALUES (?, ?, ?, ?)", meetings)
+
+        # Setup users data
+        users = [
+            (10, 'shadower@example.com', 'key1', 'shadower', 'nyc'),
+            (20, 'facilitator@example.com', 'key2', 'facilitator', 'nyc'),
+            (30, 'municipal@example.com', 'key3', 'municipal', 'nyc')
+        ]
+        conn.execute("DELETE FROM users")
+        conn.executemany("INSERT INTO users (id, email, public_key, role, region) VALUES (?, ?, ?, ?, ?)", users)
+
     print("Demo data has been set up.")
 
 
-def merge_records(records: list) -> dict:
+def merge_records(records: list, table_name: str = 'meetings') -> dict:
     """
-    Merges a list of incoming records into the local database.
+    Merges a list of incoming records for one table into the local database,
+    in a single transaction.
     - Inserts new records.
     - Updates existing records if the incoming one is newer.
-    - Skips existing records if the incoming one is older or the same.
+    - Skips existing records if the incoming one is older or the same, and
+      counts those whose values differ as conflicts.
+    - For users, unions the CC score shares and recomputes cc_score from them
+      (see core.engagement).
+    Records that carry field versions ('_v') are merged column by column
+    instead (see models.field_versions); peers that don't send them still
+    get the row-level rule.
     """
-    summary = {'inserted': 0, 'updated': 0, 'skipped': 0}
-    
-    # For now, we only handle the 'meetings' table. A full implementation
-    # would check the record type and dispatch to the correct table handler.
-    
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    for record in records:
-        record_id = record.get('id')
-        if not record_id:
-            continue
-
-        # Check if a record with this ID already exists
-        cursor.execute("SELECT last_modified FROM meetings WHERE id = ?", (record_id,))
-        local_record = cursor.fetchone()
-        
-        if local_record is None:
-            # Record does not exist locally, so insert it
-            print(f"Merging: Inserting new meeting with ID {record_id}.")
-            cursor.execute(
-                "INSERT INTO meetings (id, host_id, city, state, title, notes, last_modified) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                (record_id, record.get('host_id'), record.get('city'), record.get('state'), record.get('title'), record.get('notes'), record.get('last_modified'))
-            )
-            summary['inserted'] += 1
-        else:
-            # Record exists, compare timestamps
-            local_timestamp = local_record['last_modified']
-            incoming_timestamp = record.get('last_modified')
-
-            if incoming_timestamp and local_timestamp and incoming_timestamp > local_timestamp:
-                # Incoming record is newer, so update
-                print(f"Merging: Updating existing meeting with ID {record_id}.")
-                cursor.execute(
-                    "UPDATE meetings SET host_id = ?, city = ?, state = ?, title = ?, notes = ?, last_modified = ? WHERE id = ?",
-                    (record.get('host_id'), record.get('city'), record.get('state'), record.get('title'), record.get('notes'), incoming_timestamp, record_id)
-                )
-                summary['updated'] += 1
-            else:
-                # Local record is same age or newer, so skip
-                print(f"Merging: Skipping meeting with ID {record_id} (local is newer or timestamp missing).")
-                summary['skipped'] += 1
-
-    conn.commit()
-    conn.close()
-    
+    table = SYNC_TABLES.get(table_name)
+    if table is None:
+        print(f"Merging: No merge handler for table '{table_name}', skipping {len(records)} records.")
+        return {'inserted': 0, 'updated': 0, 'skipped': len(records), 'conflicts': 0}
+
+    with transaction() as conn:
+        summary = {'inserted': 0, 'updated': 0, 'skipped': 0, 'conflicts': 0}
+        if table_name == 'users':
+            # The local shares, which the row merge may overwrite
+            before = read_shares(conn, [record['id'] for record in records if record.get('id')])
+        versioned = [record for record in records if '_v' in record]
+        plain = [record for record in records if '_v' not in record]
+        for merge, part in ((merge_versioned, versioned), (bulk_merge, plain)):
+            if part:
+                for key, count in merge(conn, table, part).items():
+                    summary[key] += count
+        # New users or signups may complete invitation edges
+        link_records(conn, table_name, records)
+        if table_name == 'users':
+            regions = merge_shares(conn, records, before)
+            if summary['inserted'] + summary['updated']:
+                # Merged users may have moved region
+                regions |= {GLOBAL_REGION, *(r['region'] for r in records if r.get('region'))}
+            # Merged scores bypass the engagement deltas
+            refresh_regions(conn, regions)
+
+    print(f"Merging '{table_name}': {summary['inserted']} inserted, "
+          f"{summary['updated']} updated, {summary['skipped']} skipped ({summary['conflicts']} conflicts).")
     return summary
@@ -0,0 +1,151 @@
+"""
+Single-pass, ACL-filtered export of everything a user may see.
+
+Every table in EXPORT_TABLES is streamed from one read transaction, so the
+export is a consistent snapshot even while the node keeps writing (WAL
+readers see the database as of their first read). A table is filtered
+either by its ACL rule (acl.engine) or, when it has no rule of its own, as a
+semi-join against the visible rows of the table it belongs to; e.g. attendance
+rows are exported for the visible meetings. A parent's visible ids are
+computed once into a TEMP table and reused by its dependents, so there are
+no per-id parameter lists to hit SQLite's variable limit.
+
+Rows go straight to a sink as they are read; nothing is accumulated in memory
+unless the sink itself does so (DictSink).
+"""
+
+import json
+from dataclasses import dataclass
+from typing import Dict, IO, List, Optional, Sequence, Tuple
+
+from acl.permissions import get_acl_filter_clause
+from core.models import User
+from models.connection import transaction
+
+# Rows fetched from SQLite per round trip while streaming a table
+EXPORT_FETCH_SIZE = 500
+
+
+@dataclass(frozen=True)
+class ExportTable:
+    """
+    How one table is filtered and streamed. With `parent` = (column, table),
+    a row is exported when `column` is a visible id of that exported table;
+    otherwise the table's own ACL rule applies. `exclude` lists columns that
+    never leave the node (e.g. redeemable tokens).
+    """
+    name: str
+    parent: Optional[Tuple[str, str]] = None
+    exclude: Tuple[str, ...] = ()
+    order_by: Tuple[str, ...] = ('id',)
+
+
+# Parents come before their dependents
+EXPORT_TABLES: Tuple[ExportTable, ...] = (
+    ExportTable('meetings'),
+    ExportTable('users', exclude=('cc_shares',)),
+    ExportTable('attendance', parent=('meeting_id', 'meetings'), order_by=('meeting_id', 'node_id')),
+    ExportTable('invitations', exclude=('token',)),
+    ExportTable('signups', exclude=('token',)),
+    ExportTable('email_log', parent=('recipient_id', 'users'), exclude=('token',)),
+)
+
+
+class ExportSink:
+    """Receives an export table by table. Subclasses override what they need."""
+
+    def begin_table(self, table_name: str, columns: Sequence[str]):
+        pass
+
+    def write_rows(self, table_name: str, rows: List[tuple]):
+        raise NotImplementedError
+
+    def end_table(self, table_name: str, count: int):
+        pass
+
+
+class JsonLinesSink(ExportSink):
+    """Writes one JSON object per row, {"table": ..., "record": {...}}, to a text stream."""
+
+    def __init__(self, stream: IO[str]):
+        self.stream = stream
+        self._columns = ()
+
+    def begin_table(self, table_name: str, columns: Sequence[str]):
+        self._columns = tuple(columns)
+
+    def write_rows(self, table_name: str, rows: List[tuple]):
+        self.stream.writelines(
+            json.dumps({'table': table_name, 'record': dict(zip(self._columns, row))}, default=str) + "\n"
+            for row in rows
+        )
+
+
+class DictSink(ExportSink):
+    """Collects the export as {table: [record dicts]}, for small exports and callers that need a dict."""
+
+    def __init__(self):
+        self.data: Dict[str, List[dict]] = {}
+        self._columns = ()
+
+    def begin_table(self, table_name: str, columns: Sequence[str]):
+        self._columns = tuple(columns)
+        self.data[table_name] = []
+
+    def write_rows(self, table_name: str, rows: List[tuple]):
+        self.data[table_name].extend(dict(zip(self._columns, row)) for row in rows)
+
+
+def _visible_table(table_name: str) -> str:
+    return f"temp.export_visible_{table_name}"
+
+
+def export_visible(user: User, sink: ExportSink,
+                   tables: Sequence[ExportTable] = EXPORT_TABLES) -> Dict[str, int]:
+    """
+    Streams every row of `tables` that `user` may see into `sink`, all from
+    one snapshot. Returns the number of rows exported per table.
+    """
+    parents = {table.parent[1] for table in tables if table.parent}
+    counts = {}
+    with transaction(immediate=False) as conn:
+        try:
+            for table in tables:
+                columns = [
+                    row['name'] for row in conn.execute(f"PRAGMA table_info({table.name})")
+                    if row['name'] not in table.exclude
+                ]
+                if table.parent:
+                    column, parent = table.parent
+                    where, params = f"{column} IN (SELECT id FROM {_visible_table(parent)})", ()
+                else:
+                    where, params = get_acl_filter_clause(user, table.name)
+
+                if table.name in parents:
+                    # Computed once; the table itself and its dependents read from it
+                    visible = _visible_table(table.name)
+                    conn.execute(f"DROP TABLE IF EXISTS {visible}")
+                    conn.execute(f"CREATE TEMP TABLE {visible} (id INTEGER PRIMARY KEY)")
+                    conn.execute(f"INSERT INTO {visible} SELECT id FROM {table.name} WHERE {where}", params)
+                    where, params = f"id IN (SELECT id FROM {visible})", ()
+
+                cursor = conn.execute(
+                    f"SELECT {', '.join(columns)} FROM {table.name} WHERE {where} "
+                    f"ORDER BY {', '.join(table.order_by)}",
+                    params
+                )
+                sink.begin_table(table.name, columns)
+                count = 0
+                while True:
+                    rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+                    if not rows:
+                        break
+                    sink.write_rows(table.name, [tuple(row) for row in rows])
+                    count += len(rows)
+                sink.end_table(table.name, count)
+                counts[table.name] = count
+        finally:
+            # Temp tables live as long as the pooled connection, so don't leave them behind
+            for parent in parents:
+                conn.execute(f"DROP TABLE IF EXISTS {_visible_table(parent)}")
+    return counts
@@ -0,0 +1,352 @@
+"""
+Per-column versions for the synced tables, so sync ships and merges fields
+rather than whole rows.
+
+field_versions holds, for each row, the time each column was last changed,
+plus a '*' entry for when the row was created. Triggers keep it current for
+local writes: an UPDATE stamps every column whose value changed (with the
+row's new last_modified, or the current time when the statement left
+last_modified alone, as the stamp trigger then does).
+
+A sync record (see `versioned_records`) carries its versions under '_v'. A
+row the peer may not have yet (created since the watermark) is sent whole,
+with '_full' set; any other row is a delta with just its id, last_modified
+and the columns changed since the watermark. `merge_versioned` applies each
+incoming column only if its version is newer than the local one, so edits to
+different fields of a row on two nodes both survive, and a title edit
+rewrites only the title. Equal versions (edits within the same second) go to
+the canonically greater value, so every replica picks the same one. Columns
+without a version (never edited since this schema existed) fall back to the
+row-level rule: the newer last_modified wins, with the same tie-break. A row
+where an incoming value lost to a local one at least as new is counted as a
+conflict in the merge summary. Counter columns (SyncTable.counters) only have
+their versions merged here; the caller merges their values.
+
+Merges set sync_merge_flag inside their own transaction, which turns the
+local-write triggers off; the merge writes the incoming versions itself.
+"""
+
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, Optional
+
+from models.connection import transaction
+from models.sync import SYNC_TABLES, SyncTable
+
+# Version key for a row's creation
+CREATED = '*'
+
+# Rows whose versions are read, or that are merged, per statement batch
+VERSION_BATCH = 500
+
+CREATE_FIELD_VERSIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS field_versions (
+    table_name TEXT NOT NULL,
+    row_id INTEGER NOT NULL,
+    column_name TEXT NOT NULL,
+    modified TIMESTAMP NOT NULL,
+    PRIMARY KEY (table_name, row_id, column_name)
+) WITHOUT ROWID
+"""
+
+CREATE_MERGE_FLAG_TABLE = "CREATE TABLE IF NOT EXISTS sync_merge_flag (active INTEGER NOT NULL)"
+
+_NOT_MERGING = "(SELECT active FROM sync_merge_flag) = 0"
+
+_UPSERT_VERSION = (
+    "INSERT INTO field_versions (table_name, row_id, column_name, modified) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT (table_name, row_id, column_name) DO UPDATE SET modified = excluded.modified "
+    "WHERE excluded.modified > field_versions.modified"
+)
+
+
+def _fields(table: SyncTable) -> tuple:
+    return tuple(column for column in table.columns if column not in ('id', 'last_modified'))
+
+
+def ensure_field_versions_schema(conn):
+    """
+    Creates the version table, the merge flag and the triggers, makes the
+    last_modified stamp trigger skip merges, and records a creation version
+    for every existing row.
+    """
+    conn.execute(CREATE_FIELD_VERSIONS_TABLE)
+    conn.execute(CREATE_MERGE_FLAG_TABLE)
+    if conn.execute("SELECT count(*) FROM sync_merge_flag").fetchone()[0] == 0:
+        conn.execute("INSERT INTO sync_merge_flag (active) VALUES (0)")
+
+    for table in SYNC_TABLES.values():
+        name = table.name
+        conn.execute(f"DROP TRIGGER IF EXISTS trg_{name}_stamp_update")
+        conn.execute(f"""
+            CREATE TRIGGER trg_{name}_stamp_update
+            AFTER UPDATE ON {name} WHEN NEW.last_modified IS OLD.last_modified AND {_NOT_MERGING}
+            BEGIN
+                UPDATE {name} SET last_modified = CURRENT_TIMESTAMP WHERE id = NEW.id;
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{name}_fields_insert
+            AFTER INSERT ON {name} WHEN {_NOT_MERGING}
+            BEGIN
+                DELETE FROM field_versions WHERE table_name = '{name}' AND row_id = NEW.id;
+                INSERT INTO field_versions (table_name, row_id, column_name, modified)
+                VALUES ('{name}', NEW.id, '{CREATED}', coalesce(NEW.last_modified, CURRENT_TIMESTAMP));
+            END
+        """)
+        stamp = "CASE WHEN NEW.last_modified IS OLD.last_modified THEN CURRENT_TIMESTAMP ELSE NEW.last_modified END"
+        stamps = "\n".join(
+            f"INSERT INTO field_versions (table_name, row_id, column_name, modified) "
+            f"SELECT '{name}', NEW.id, '{column}', {stamp} WHERE NEW.{column} IS NOT OLD.{column} "
+            f"ON CONFLICT (table_name, row_id, column_name) DO UPDATE SET modified = excluded.modified;"
+            for column in _fields(table)
+        )
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{name}_fields_update
+            AFTER UPDATE ON {name} WHEN {_NOT_MERGING}
+            BEGIN
+                {stamps}
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{name}_fields_delete
+            AFTER DELETE ON {name}
+            BEGIN
+                DELETE FROM field_versions WHERE table_name = '{name}' AND row_id = OLD.id;
+            END
+        """)
+        conn.execute(
+            "INSERT OR IGNORE INTO field_versions (table_name, row_id, column_name, modified) "
+            f"SELECT ?, id, '{CREATED}', coalesce(last_modified, CURRENT_TIMESTAMP) FROM {name}",
+            (name,)
+        )
+
+
+@contextmanager
+def merging(conn):
+    """Turns the local-write triggers off on `conn` for the enclosed writes (the caller owns the transaction)."""
+    conn.execute("UPDATE sync_merge_flag SET active = 1")
+    try:
+        yield
+    finally:
+        conn.execute("UPDATE sync_merge_flag SET active = 0")
+
+
+def _stamp(unix_time: int) -> str:
+    """A Unix time in the format of last_modified (CURRENT_TIMESTAMP)."""
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(unix_time))
+
+
+def _placeholders(values) -> str:
+    return ', '.join('?' for _ in values)
+
+
+def _canonical(value) -> tuple:
+    """Orders values of any SQLite type, so replicas break version ties the same way."""
+    if value is None:
+        return (0,)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    if isinstance(value, (bytes, bytearray)):
+        return (3, bytes(value))
+    return (4, repr(value))
+
+
+def _wins(incoming, local) -> bool:
+    """Whether an incoming value beats the local one of the same version: the canonically greater wins."""
+    return _canonical(incoming) > _canonical(local)
+
+
+def versioned_records(table_name: str, rows: Iterable[dict], since: Optional[int] = None) -> Iterator[dict]:
+    """
+    Turns `rows` of a synced table into sync records with their column
+    versions: whole rows when `since` (the peer's watermark, Unix time) is
+    None or the row is newer than it, deltas of the columns changed at or
+    after `since` otherwise. Each batch of rows is re-read together with its
+    versions in one snapshot, so a value is never paired with a newer version.
+    """
+    table = SYNC_TABLES[table_name]
+    fields = _fields(table)
+    since_stamp = _stamp(since) if since is not None else None
+    batch = []
+    for row in rows:
+        batch.append(row['id'])
+        if len(batch) >= VERSION_BATCH:
+            yield from _versioned_batch(table, fields, batch, since_stamp)
+            batch = []
+    if batch:
+        yield from _versioned_batch(table, fields, batch, since_stamp)
+
+
+def _versioned_batch(table: SyncTable, fields: tuple, ids: list, since_stamp: Optional[str]) -> Iterator[dict]:
+    with transaction(immediate=False) as conn:
+        current = {
+            row['id']: dict(row) for row in conn.execute(
+                f"SELECT {', '.join(table.columns)} FROM {table.name} WHERE id IN ({_placeholders(ids)})", ids
+            )
+        }
+        versions: Dict[int, Dict[str, str]] = {}
+        for row_id, column, modified in conn.execute(
+            "SELECT row_id, column_name, modified FROM field_versions "
+            f"WHERE table_name = ? AND row_id IN ({_placeholders(ids)})",
+            (table.name, *ids)
+        ):
+            versions.setdefault(row_id, {})[column] = modified
+
+    for row_id in ids:
+        record = current.get(row_id)
+        if record is None:
+            continue  # Deleted since it was listed
+        row_versions = versions.get(row_id, {})
+        created = row_versions.pop(CREATED, None)
+        changed = None
+        if since_stamp is not None and created is not None and created < since_stamp:
+            changed = {column: stamp for column, stamp in row_versions.items() if stamp >= since_stamp and column in fields}
+        if changed:
+            delta = {'id': row_id, 'last_modified': record['last_modified']}
+            delta.update((column, record[column]) for column in changed)
+            delta['_v'] = changed
+            delta['_full'] = 0
+            yield delta
+        else:
+            record['_v'] = {column: stamp for column, stamp in row_versions.items() if column in fields}
+            record['_full'] = 1
+            yield record
+
+
+def merge_versioned(conn, table: SyncTable, records: list) -> dict:
+    """
+    Merges versioned sync records into `table` column by column on `conn`
+    (the caller owns the transaction). A delta for a row this node doesn't
+    have is skipped; the full row arrives with a later sync or reconciliation.
+    """
+    summary = {'inserted': 0, 'updated': 0, 'skipped': 0, 'conflicts': 0}
+    fields = _fields(table)
+    # The newest copy of each row in the batch
+    latest = {}
+    for record in records:
+        row_id = record.get('id')
+        if not row_id:
+            summary['skipped'] += 1
+            continue
+        if row_id in latest:
+            summary['skipped'] += 1
+            if str(record.get('last_modified')) <= str(latest[row_id].get('last_modified')):
+                continue
+        latest[row_id] = record
+
+    with merging(conn):
+        ids = list(latest)
+        for start in range(0, len(ids), VERSION_BATCH):
+            batch = ids[start:start + VERSION_BATCH]
+            _merge_batch(conn, table, fields, [latest[row_id] for row_id in batch], summary)
+    return summary
+
+
+def _merge_batch(conn, table: SyncTable, fields: tuple, records: list, summary: dict):
+    ids = [record['id'] for record in records]
+    existing = {
+        row['id']: row for row in conn.execute(
+            f"SELECT {', '.join(table.columns)} FROM {table.name} WHERE id IN ({_placeholders(ids)})", ids
+        )
+    }
+    local_versions = {
+        (row_id, column): modified for row_id, column, modified in conn.execute(
+            "SELECT row_id, column_name, modified FROM field_versions "
+            f"WHERE table_name = ? AND row_id IN ({_placeholders(ids)})",
+            (table.name, *ids)
+        )
+    }
+    # Current holders of the incoming values of secondary UNIQUE columns
+    holders = {}
+    for column in table.unique:
+        values = list({record[column] for record in records if record.get(column) is not None})
+        holders[column] = {
+            value: row_id for start in range(0, len(values), VERSION_BATCH) for row_id, value in conn.execute(
+                f"SELECT id, {column} FROM {table.name} "
+                f"WHERE {column} IN ({_placeholders(values[start:start + VERSION_BATCH])})",
+                values[start:start + VERSION_BATCH]
+            )
+        }
+
+    def collides(row_id: int, values: dict) -> bool:
+        # A value held by another row, here or earlier in the batch, would fail the UNIQUE constraint
+        claims = [(column, values[column]) for column in table.unique if values.get(column) is not None]
+        if any(holders[column].get(value, row_id) != row_id for column, value in claims):
+            return True
+        for column, value in claims:
+            holders[column][value] = row_id
+        return False
+
+    inserts, updates, new_versions = [], {}, []
+    for record in records:
+        row_id, incoming = record['id'], record.get('_v') or {}
+        last_modified = record.get('last_modified')
+        if row_id not in existing:
+            if not record.get('_full'):
+                summary['skipped'] += 1
+                continue
+            if collides(row_id, record):
+                summary['skipped'] += 1
+                summary['conflicts'] += 1
+                continue
+            inserts.append(tuple(record.get(column) for column in table.columns))
+            new_versions.append((table.name, row_id, CREATED, last_modified))
+            new_versions.extend((table.name, row_id, column, stamp) for column, stamp in incoming.items() if column in fields)
+            summary['inserted'] += 1
+            continue
+
+        current = existing[row_id]
+        newer_row = str(last_modified or '') > str(current['last_modified'] or '')
+        same_row = str(last_modified or '') == str(current['last_modified'] or '')
+        applied, applied_versions, lost = {}, [], False
+        for column in fields:
+            stamp = incoming.get(column)
+            local = local_versions.get((row_id, column))
+            if column in table.counters:
+                # The caller merges the value itself; only the newer version is kept
+                if stamp is not None and (local is None or stamp > local):
+                    new_versions.append((table.name, row_id, column, stamp))
+                continue
+            if stamp is not None:
+                # Equal versions are concurrent edits within the same second
+                if local is None or stamp > local or (stamp == local and _wins(record.get(column), current[column])):
+                    applied[column] = record.get(column)
+                    applied_versions.append((table.name, row_id, column, stamp))
+                    continue
+            elif not record.get('_full') or local is not None:
+                continue
+            elif newer_row or (same_row and _wins(record.get(column), current[column])):
+                # Neither side has versioned this column: the newer row wins
+                applied[column] = record.get(column)
+                continue
+            lost = lost or (column in record and record[column] != current[column])
+        if collides(row_id, applied):
+            summary['skipped'] += 1
+            summary['conflicts'] += 1
+            continue
+        if lost:
+            summary['conflicts'] += 1
+        if not applied and not newer_row:
+            summary['skipped'] += 1
+            continue
+        new_versions.extend(applied_versions)
+        columns = tuple(sorted(applied))
+        updates.setdefault(columns, []).append((*(applied[column] for column in columns), last_modified, row_id))
+        summary['updated'] += 1
+
+    if inserts:
+        conn.executemany(
+            f"INSERT INTO {table.name} ({', '.join(table.columns)}) VALUES ({_placeholders(table.columns)})", inserts
+        )
+    for columns, rows in updates.items():
+        # Rows whose changed columns match share one statement; untouched columns are not rewritten.
+        # SQLite's max() is NULL if any argument is, so a record without last_modified keeps the row's.
+        assignments = "".join(f"{column} = ?, " for column in columns)
+        conn.executemany(
+            f"UPDATE {table.name} SET {assignments}last_modified = max(coalesce(last_modified, ''), coalesce(?, '')) WHERE id = ?",
+            rows
+        )
+    conn.executemany(_UPSERT_VERSION, new_versions)
@@ -0,0 +1,233 @@
+"""
+Materialized closure of the invitation tree.
+
+invite_closure holds one row (ancestor, descendant, depth) for every pair
+of users where `ancestor` invited `descendant` directly (depth 1) or through
+a chain of invitations, plus a (user, user, 0) row for every user in the
+tree. A user's inviter is the `invited_by` of the signup with their email.
+
+Edges are added incrementally as invitations are redeemed or the rows are
+merged from a peer, so downline queries are index range scans on the
+(ancestor, ...) primary key or the (descendant, depth) index instead of a
+recursive walk.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Dict, FrozenSet, List, Optional
+
+from models.connection import after_commit, connection, transaction
+
+CREATE_CLOSURE_TABLE = """
+CREATE TABLE IF NOT EXISTS invite_closure (
+    ancestor INTEGER NOT NULL,
+    descendant INTEGER NOT NULL,
+    depth INTEGER NOT NULL,
+    PRIMARY KEY (ancestor, descendant)
+) WITHOUT ROWID
+"""
+
+CREATE_DESCENDANT_INDEX = (
+    "CREATE INDEX IF NOT EXISTS idx_invite_closure_descendant ON invite_closure (descendant, depth)"
+)
+
+# Lets a user be matched to their signup (users.email is stored lower-case)
+CREATE_SIGNUP_EMAIL_INDEX = "CREATE INDEX IF NOT EXISTS idx_signups_email_lower ON signups (lower(email))"
+
+# Downlines cached for ACL checks in Python (see descendant_set)
+MAX_CACHED_DOWNLINES = 1024
+
+_cache = OrderedDict()  # user id -> (generation, frozenset of descendant ids)
+_cache_lock = threading.Lock()
+_generation = 0
+
+
+def _bump_generation():
+    global _generation
+    with _cache_lock:
+        _generation += 1
+        _cache.clear()
+
+
+def _invalidate():
+    # Once now and again after the commit: a downline read on another connection
+    # before then still sees the old closure and must not stay cached
+    _bump_generation()
+    after_commit(_bump_generation)
+
+
+def attach(conn, parent_id: int, child_id: int) -> bool:
+    """
+    Records that `parent_id` invited `child_id`, linking the child's whole
+    subtree under every ancestor of the parent. The first inviter wins, and
+    an edge that would create a cycle is ignored. Returns whether it was added.
+    """
+    if parent_id is None or child_id is None or parent_id == child_id:
+        return False
+    conn.executemany(
+        "INSERT OR IGNORE INTO invite_closure (ancestor, descendant, depth) VALUES (?, ?, 0)",
+        ((parent_id, parent_id), (child_id, child_id))
+    )
+    has_parent = conn.execute(
+        "SELECT 1 FROM invite_closure WHERE descendant = ? AND depth = 1", (child_id,)
+    ).fetchone()
+    is_ancestor = conn.execute(
+        "SELECT 1 FROM invite_closure WHERE ancestor = ? AND descendant = ?", (child_id, parent_id)
+    ).fetchone()
+    if has_parent or is_ancestor:
+        return False
+    conn.execute(
+        "INSERT OR IGNORE INTO invite_closure (ancestor, descendant, depth) "
+        "SELECT a.ancestor, d.descendant, a.depth + d.depth + 1 "
+        "FROM invite_closure a JOIN invite_closure d "
+        "WHERE a.descendant = ? AND d.ancestor = ?",
+        (parent_id, child_id)
+    )
+    _invalidate()
+    return True
+
+
+def link_records(conn, table_name: str, records: list) -> int:
+    """
+    Attaches the invitation edges implied by newly written `users` or
+    `signups` rows (e.g. a merged sync chunk). Returns the number of edges added.
+    """
+    if table_name == 'users':
+        keys = [record['id'] for record in records if record.get('id') is not None]
+    elif table_name == 'signups':
+        keys = [record['email'] for record in records if record.get('email')]
+    else:
+        return 0
+    added = 0
+    # Stay well below SQLite's bound parameter limit
+    for start in range(0, len(keys), 500):
+        batch = keys[start:start + 500]
+        placeholders = ', '.join('?' for _ in batch)
+        if table_name == 'users':
+            # Two lookups rather than a join: SQLite won't probe the
+            # lower(email) expression index from the far side of a join.
+            user_ids = {
+                row['email']: row['id']
+                for row in conn.execute(f"SELECT id, email FROM users WHERE id IN ({placeholders})", batch)
+            }
+            if not user_ids:
+                continue
+            edges = [
+                (row['invited_by'], user_ids[row['email']])
+                for row in conn.execute(
+                    "SELECT invited_by, lower(email) AS email FROM signups "
+                    f"WHERE lower(email) IN ({', '.join('?' for _ in user_ids)}) AND invited_by IS NOT NULL",
+                    list(user_ids)
+                )
+            ]
+        else:
+            edges = conn.execute(
+                "SELECT s.invited_by, u.id FROM signups s JOIN users u ON u.email = lower(s.email) "
+                f"WHERE s.invited_by IS NOT NULL AND s.email IN ({placeholders})",
+                batch
+            ).fetchall()
+        added += sum(attach(conn, parent_id, child_id) for parent_id, child_id in edges)
+    return added
+
+
+def rebuild(conn) -> int:
+    """Recomputes the whole closure from signups and users; returns the row count."""
+    parents = {}
+    for parent_id, child_id in conn.execute(
+        "SELECT s.invited_by, u.id FROM signups s JOIN users u ON u.email = lower(s.email) "
+        "WHERE s.invited_by IS NOT NULL AND s.invited_by != u.id ORDER BY s.id"
+    ):
+        parents.setdefault(child_id, parent_id)
+
+    rows = []
+    nodes = set(parents) | set(parents.values())
+    for node in nodes:
+        rows.append((node, node, 0))
+        seen = {node}
+        ancestor, depth = parents.get(node), 1
+        # Walk up the inviter chain; stop on a cycle in the source data
+        while ancestor is not None and ancestor not in seen:
+            rows.append((ancestor, node, depth))
+            seen.add(ancestor)
+            ancestor, depth = parents.get(ancestor), depth + 1
+
+    conn.execute("DELETE FROM invite_closure")
+    conn.executemany("INSERT INTO invite_closure (ancestor, descendant, depth) VALUES (?, ?, ?)", rows)
+    _invalidate()
+    return len(rows)
+
+
+def ensure_closure_schema(conn):
+    """Creates the closure table and fills it from the existing invitations."""
+    conn.execute(CREATE_CLOSURE_TABLE)
+    conn.execute(CREATE_DESCENDANT_INDEX)
+    conn.execute(CREATE_SIGNUP_EMAIL_INDEX)
+    rebuild(conn)
+
+
+def rebuild_closure() -> int:
+    """Rebuilds the closure in its own transaction."""
+    with transaction() as conn:
+        return rebuild(conn)
+
+
+def descendants(user_id: int, max_depth: Optional[int] = None) -> List[dict]:
+    """Everyone `user_id` brought in, directly or not, as {'id', 'depth'} nearest first."""
+    sql = "SELECT descendant AS id, depth FROM invite_closure WHERE ancestor = ? AND depth > 0"
+    params = [user_id]
+    if max_depth is not None:
+        sql += " AND depth <= ?"
+        params.append(max_depth)
+    with connection() as conn:
+        return [dict(row) for row in conn.execute(sql + " ORDER BY depth, descendant", params)]
+
+
+def ancestors(user_id: int) -> List[dict]:
+    """The chain of inviters above `user_id` as {'id', 'depth'}, direct inviter first."""
+    with connection() as conn:
+        rows = conn.execute(
+            "SELECT ancestor AS id, depth FROM invite_closure WHERE descendant = ? AND depth > 0 ORDER BY depth",
+            (user_id,)
+        )
+        return [dict(row) for row in rows]
+
+
+def subtree_size(user_id: int) -> int:
+    """Number of users below `user_id` in the tree."""
+    with connection() as conn:
+        return conn.execute(
+            "SELECT count(*) FROM invite_closure WHERE ancestor = ? AND depth > 0", (user_id,)
+        ).fetchone()[0]
+
+
+def depth_histogram(user_id: int) -> Dict[int, int]:
+    """Users below `user_id` per generation: {depth: count}."""
+    with connection() as conn:
+        rows = conn.execute(
+            "SELECT depth, count(*) FROM invite_closure WHERE ancestor = ? AND depth > 0 GROUP BY depth",
+            (user_id,)
+        )
+        return {depth: count for depth, count in rows}
+
+
+def descendant_set(user_id: int) -> FrozenSet[int]:
+    """
+    `user_id` and everyone below them, cached until the tree next changes in
+    this process. Used for ACL checks on records already in memory.
+    """
+    with _cache_lock:
+        generation = _generation
+        cached = _cache.get(user_id)
+        if cached is not None and cached[0] == generation:
+            _cache.move_to_end(user_id)
+            return cached[1]
+    with connection() as conn:
+        ids = frozenset(
+            row[0] for row in conn.execute("SELECT descendant FROM invite_closure WHERE ancestor = ?", (user_id,))
+        ) | {user_id}
+    with _cache_lock:
+        if generation == _generation:
+            _cache[user_id] = (generation, ids)
+            while len(_cache) > MAX_CACHED_DOWNLINES:
+                _cache.popitem(last=False)
+    return ids
@@ -0,0 +1,349 @@
+"""
+Versioned schema migrations.
+
+The schema version is kept in SQLite's `PRAGMA user_version`. `migrate()`
+applies, in order, every migration newer than the database, each in its own
+transaction together with the version bump, so a start-up only does work
+when the schema is behind. Migrations are idempotent (IF NOT EXISTS, column
+checks) so a database created by an older release, before versioning, is
+brought up to date safely from version 0.
+
+INDEX_PLAN lists the secondary indexes the application's queries rely on,
+and `check_query_plans()` runs EXPLAIN QUERY PLAN over representative
+queries to confirm SQLite actually uses them.
+"""
+
+import sqlite3
+from typing import Callable, List, NamedTuple, Tuple
+
+from core.models import User
+from acl.permissions import get_acl_filter_clause
+from models.connection import connection, transaction
+from core.engagement import ensure_engagement_schema, ensure_score_shares
+from models.invite_tree import ensure_closure_schema
+from models.buckets import ensure_bucket_schema
+from models.field_versions import ensure_field_versions_schema
+from models.sync import ensure_sync_schema
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    apply: Callable[[sqlite3.Connection], None]
+
+
+def _add_missing_columns(conn, table_name: str, columns: dict):
+    """Adds any of `columns` (name -> declaration) that `table_name` lacks."""
+    existing = {row['name'] for row in conn.execute(f"PRAGMA table_info({table_name})")}
+    for name, declaration in columns.items():
+        if name not in existing:
+            conn.execute(f"ALTER TABLE {table_name} ADD COLUMN {name} {declaration}")
+
+
+def _create_tables(conn):
+    # Defines the schema for the 'users' table
+    create_users_table = """
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY,
+        email TEXT UNIQUE NOT NULL,
+        public_key TEXT NOT NULL,
+        role TEXT CHECK(role IN ('connector', 'shadower', 'facilitator', 'municipal', 'statal', 'national', 'dev')),
+        region TEXT,
+        cc_score INTEGER DEFAULT 0,
+        last_active TIMESTAMP,
+        is_active BOOLEAN DEFAULT 1,
+        last_modified TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    """
+
+    # Defines the schema for the 'audit_log' table
+    create_audit_log_table = """
+    CREATE TABLE IF NOT EXISTS audit_log (
+        id INTEGER PRIMARY KEY,
+        action TEXT,
+        performed_by INTEGER REFERENCES users(id),
+        record_id INTEGER,
+        entity TEXT,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        signature TEXT,
+        payload TEXT,
+        epoch_id INTEGER REFERENCES audit_epochs(id),
+        leaf_index INTEGER
+    );
+    """
+
+    # One signed Merkle root per epoch of audit entries (AUDIT_SIGNING = "epoch")
+    create_audit_epochs_table = """
+    CREATE TABLE IF NOT EXISTS audit_epochs (
+        id INTEGER PRIMARY KEY,
+        root TEXT NOT NULL,
+        prev_root TEXT,
+        size INTEGER NOT NULL,
+        first_entry_id INTEGER NOT NULL,
+        last_entry_id INTEGER NOT NULL,
+        signature TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    """
+
+    # Defines the schema for the 'meetings' table, including the last_modified column for syncing
+    create_meetings_table = """
+    CREATE TABLE IF NOT EXISTS meetings (
+        id INTEGER PRIMARY KEY,
+        host_id INTEGER REFERENCES users(id),
+        city TEXT,
+        state TEXT,
+        scheduled_at TIMESTAMP,
+        title TEXT,
+        notes TEXT,
+        last_modified TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    """
+
+    create_invitations_table = """
+    CREATE TABLE IF NOT EXISTS invitations (
+        id INTEGER PRIMARY KEY,
+        email TEXT NOT NULL,
+        invited_by INTEGER REFERENCES users(id),
+        used BOOLEAN DEFAULT 0,
+        token TEXT UNIQUE NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        last_modified TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    """
+
+    create_signups_table = """
+    CREATE TABLE IF NOT EXISTS signups (
+        id INTEGER PRIMARY KEY,
+        name TEXT,
+        email TEXT UNIQUE,
+        invited_by INTEGER REFERENCES users(id),
+        city TEXT,
+        state TEXT,
+        zip TEXT,
+        neighborhood TEXT,
+        occupation TEXT,
+        token TEXT UNIQUE,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        last_modified TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    """
+
+    create_email_log_table = """
+    CREATE TABLE IF NOT EXISTS email_log (
+        id INTEGER PRIMARY KEY,
+        sender_id INTEGER REFERENCES users(id),
+        recipient_id INTEGER REFERENCES users(id),
+        subject TEXT,
+        cta_link TEXT,
+        token TEXT UNIQUE NOT NULL,
+        sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        responded_at TIMESTAMP,
+        campaign_id INTEGER REFERENCES cta_campaigns(id),
+        delivery_status TEXT
+    );
+    """
+
+    # One row per CTA send, tracking how far dispatch has progressed
+    create_cta_campaigns_table = """
+    CREATE TABLE IF NOT EXISTS cta_campaigns (
+        id INTEGER PRIMARY KEY,
+        sender_id INTEGER REFERENCES users(id),
+        subject TEXT,
+        body TEXT,
+        cta_link TEXT,
+        status TEXT DEFAULT 'running',
+        last_recipient_id INTEGER DEFAULT 0,
+        queued INTEGER DEFAULT 0,
+        sent INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        completed_at TIMESTAMP
+    );
+    """
+
+    # Known peers; replaces the old config/peers.json file
+    create_peers_table = """
+    CREATE TABLE IF NOT EXISTS peers (
+        email TEXT PRIMARY KEY,
+        public_key TEXT NOT NULL,
+        address TEXT NOT NULL,
+        last_synced INTEGER,
+        last_sync_status TEXT,
+        last_sync_latency_ms INTEGER,
+        last_sync_bytes INTEGER
+    );
+    """
+
+    for statement in (create_users_table, create_audit_log_table, create_audit_epochs_table,
+                      create_meetings_table, create_invitations_table, create_signups_table,
+                      create_email_log_table, create_cta_campaigns_table, create_peers_table):
+        conn.execute(statement)
+
+
+def _add_columns(conn):
+    # Databases created before these columns existed
+    _add_missing_columns(conn, 'audit_log', {
+        'payload': 'TEXT',
+        'epoch_id': 'INTEGER REFERENCES audit_epochs(id)',
+        'leaf_index': 'INTEGER',
+    })
+    _add_missing_columns(conn, 'email_log', {
+        'campaign_id': 'INTEGER REFERENCES cta_campaigns(id)',
+        'delivery_status': 'TEXT',
+    })
+
+
+def _add_score_shares(conn):
+    _add_missing_columns(conn, 'users', {'cc_shares': 'TEXT'})
+    # Rebuild the users field-version trigger for the new synced column
+    conn.execute("DROP TRIGGER IF EXISTS trg_users_fields_update")
+    ensure_field_versions_schema(conn)
+    ensure_score_shares(conn)
+
+
+# (index name, table, columns). Each entry names the queries it serves.
+INDEX_PLAN: List[Tuple[str, str, str]] = [
+    # ACL filters (acl.engine) in find_records and DataManager; scheduled_at
+    # lets DataManager's "ORDER BY scheduled_at DESC" read the index in order.
+    ('idx_meetings_city', 'meetings', 'city, scheduled_at'),
+    ('idx_meetings_state', 'meetings', 'state, scheduled_at'),
+    ('idx_meetings_host', 'meetings', 'host_id, scheduled_at'),
+    ('idx_signups_city', 'signups', 'city'),
+    ('idx_signups_state', 'signups', 'state'),
+    ('idx_signups_invited_by', 'signups', 'invited_by'),
+    ('idx_invitations_invited_by', 'invitations', 'invited_by'),
+    # CTA recipients (region rules) and role lookups
+    ('idx_users_region', 'users', 'region'),
+    ('idx_users_role', 'users', 'role'),
+    # DataManager.cleanup_inactive_users
+    ('idx_users_activity', 'users', 'is_active, last_active'),
+    # Per-user CTA history, and dispatch resume (pending rows of a campaign)
+    ('idx_email_log_recipient', 'email_log', 'recipient_id'),
+    ('idx_email_log_sender', 'email_log', 'sender_id'),
+    ('idx_email_log_campaign', 'email_log', 'campaign_id, delivery_status'),
+    # Audit epoch sealing and inclusion proofs
+    ('idx_audit_log_epoch', 'audit_log', 'epoch_id, leaf_index'),
+    # SyncReceiver looks peers up by key
+    ('idx_peers_public_key', 'peers', 'public_key'),
+]
+
+
+def _create_indexes(conn):
+    for name, table_name, columns in INDEX_PLAN:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table_name} ({columns})")
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "base tables", _create_tables),
+    Migration(2, "audit epoch and CTA campaign columns", _add_columns),
+    Migration(3, "sync change tracking", ensure_sync_schema),
+    Migration(4, "index plan", _create_indexes),
+    Migration(5, "invitation tree closure", ensure_closure_schema),
+    Migration(6, "attendance and CC score leaderboards", ensure_engagement_schema),
+    Migration(7, "anti-entropy range hashes", ensure_bucket_schema),
+    Migration(8, "field-level versions", ensure_field_versions_schema),
+    Migration(9, "replicated CC score shares", _add_score_shares),
+]
+
+
+def schema_version(conn) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate() -> int:
+    """Applies pending migrations and returns the resulting schema version."""
+    with connection() as conn:
+        current = schema_version(conn)
+    for migration in MIGRATIONS:
+        if migration.version <= current:
+            continue
+        with transaction() as conn:
+            # Another process may have migrated since we looked
+            if schema_version(conn) >= migration.version:
+                continue
+            print(f"Applying migration {migration.version}: {migration.description}...")
+            migration.apply(conn)
+            conn.execute(f"PRAGMA user_version = {migration.version}")
+        current = migration.version
+    return current
+
+
+def _plan_checks() -> List[Tuple[str, str, tuple, str]]:
+    """(description, query, params, text the plan must contain) for the hot queries."""
+    def acl(role, table_name, alias=None):
+        return get_acl_filter_clause(User(id=1, role=role, region='nyc'), table_name, alias)
+
+    checks = []
+    for role, index in (('municipal', 'idx_meetings_city'), ('statal', 'idx_meetings_state'),
+                        ('facilitator', 'idx_meetings_host')):
+        clause, params = acl(role, 'meetings')
+        checks.append((f"find_records meetings ({role})",
+                       f"SELECT * FROM meetings WHERE ({clause}) ORDER BY id LIMIT ?", (*params, 500), index))
+        clause, params = acl(role, 'meetings', 'm')
+        checks.append((
+            f"DataManager meetings ({role})",
+            "SELECT m.*, u.email AS host_email FROM meetings m LEFT JOIN users u ON m.host_id = u.id "
+            f"WHERE ({clause}) ORDER BY m.scheduled_at DESC",
+            params, index
+        ))
+    for table_name, index in (('signups', 'idx_signups_invited_by'), ('invitations', 'idx_invitations_invited_by')):
+        clause, params = acl('facilitator', table_name)
+        checks.append((f"find_records {table_name} (facilitator)",
+                       f"SELECT * FROM {table_name} WHERE ({clause}) ORDER BY id LIMIT ?", (*params, 500), index))
+    clause, params = acl('facilitator', 'users')
+    checks.append(("find_records users (facilitator downline)",
+                   f"SELECT * FROM users WHERE ({clause}) ORDER BY id LIMIT ?", (*params, 500), 'USING PRIMARY KEY'))
+    checks.append(("invite tree ancestors",
+                   "SELECT ancestor, depth FROM invite_closure WHERE descendant = ? AND depth > 0 ORDER BY depth",
+                   (1,), 'idx_invite_closure_descendant'))
+    checks.append(("user to signup match", "SELECT invited_by FROM signups WHERE lower(email) = ?", ('a@b.c',),
+                   'idx_signups_email_lower'))
+    checks.append(("leaderboard refresh",
+                   "SELECT id, cc_score FROM users WHERE region = ? ORDER BY cc_score DESC, id LIMIT ?",
+                   ('nyc', 100), 'idx_users_region_score'))
+    clause, params = acl('municipal', 'users')
+    checks.append(("send_cta recipients (municipal)",
+                   f"SELECT id, email FROM users WHERE ({clause}) AND id > ? ORDER BY id LIMIT ?",
+                   (*params, 0, 1000), 'idx_users_region'))
+    checks.append(("send_cta resume", "SELECT id FROM email_log WHERE campaign_id = ? AND delivery_status = 'pending'",
+                   (1,), 'idx_email_log_campaign'))
+    checks.append(("CTA history", "SELECT * FROM email_log WHERE recipient_id = ?", (1,), 'idx_email_log_recipient'))
+    checks.append(("merge_records lookup", "SELECT last_modified FROM meetings WHERE id = ?", (1,),
+                   'INTEGER PRIMARY KEY'))
+    checks.append(("field version lookup",
+                   "SELECT row_id, column_name, modified FROM field_versions WHERE table_name = ? AND row_id IN (?, ?)",
+                   ('meetings', 1, 2), 'PRIMARY KEY'))
+    checks.append(("gather_changed_records",
+                   "SELECT * FROM meetings WHERE last_modified >= datetime(?, 'unixepoch') "
+                   "ORDER BY last_modified, id LIMIT ?", (0, 500), 'idx_meetings_last_modified'))
+    checks.append(("cleanup_inactive_users",
+                   "SELECT id FROM users WHERE last_active < ? AND is_active = 1 AND role != 'dev'",
+                   ('2000-01-01',), 'idx_users_activity'))
+    return checks
+
+
+def check_query_plans() -> List[str]:
+    """
+    Runs EXPLAIN QUERY PLAN for each hot query and returns a description of
+    every query whose plan does not use its expected index (empty if all do).
+    """
+    failures = []
+    with connection() as conn:
+        for description, sql, params, expected in _plan_checks():
+            plan = " | ".join(row['detail'] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params))
+            if expected not in plan:
+                failures.append(f"{description}: expected {expected}, got: {plan}")
+    return failures
+
+
+def assert_query_plans():
+    """Raises AssertionError unless every hot query uses its index."""
+    failures = check_query_plans()
+    assert not failures, "Query plans missing indexes:\n" + "\n".join(failures)
+
+
+if __name__ == "__main__":
+    print(f"Schema version: {migrate()}")
+    assert_query_plans()
+    print(f"All {len(_plan_checks())} query plans use their indexes.")
@@ -0,0 +1,173 @@
+"""
+Registry of the tables that are replicated between peers.
+
+Every synced table carries a `last_modified` column that is kept current by
+triggers, plus a `(last_modified, id)` index so changes since a peer's
+watermark can be read by keyset pagination instead of a full scan.
+"""
+
+from dataclasses import dataclass
+from typing import Tuple
+
+
+@dataclass(frozen=True)
+class SyncTable:
+    """Describes one replicated table."""
+    name: str
+    columns: Tuple[str, ...]  # Every column sent over the wire, including 'id' and 'last_modified'
+    unique: Tuple[str, ...] = ()  # Columns with a UNIQUE constraint besides 'id'
+    # Per-node counters the caller merges by union after the row merge (see core.engagement);
+    # a differing value there is never a conflict
+    counters: Tuple[str, ...] = ()
+
+
+SYNC_TABLES = {
+    table.name: table for table in (
+        # cc_score is derived from cc_shares on every node, so only the shares travel
+        SyncTable('users', ('id', 'email', 'public_key', 'role', 'region', 'cc_shares',
+                            'last_active', 'is_active', 'last_modified'),
+                  unique=('email',), counters=('cc_shares',)),
+        SyncTable('meetings', ('id', 'host_id', 'city', 'state', 'scheduled_at', 'title',
+                               'notes', 'last_modified')),
+        SyncTable('invitations', ('id', 'email', 'invited_by', 'used', 'token', 'created_at',
+                                  'last_modified'), unique=('token',)),
+        SyncTable('signups', ('id', 'name', 'email', 'invited_by', 'city', 'state', 'zip',
+                              'neighborhood', 'occupation', 'token', 'created_at', 'last_modified'),
+                  unique=('email', 'token')),
+    )
+}
+
+
+def ensure_sync_schema(conn):
+    """
+    Adds the change-tracking column, triggers and keyset index to every synced
+    table. Safe to run on every start-up.
+    """
+    for table in SYNC_TABLES.values():
+        existing = {row['name'] for row in conn.execute(f"PRAGMA table_info({table.name})")}
+        if 'last_modified' not in existing:
+            # ALTER TABLE can't add a column with a non-constant default, so
+            # backfill existing rows and let the insert trigger stamp new ones.
+            conn.execute(f"ALTER TABLE {table.name} ADD COLUMN last_modified TIMESTAMP")
+            conn.execute(f"UPDATE {table.name} SET last_modified = CURRENT_TIMESTAMP")
+
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table.name}_stamp_insert
+            AFTER INSERT ON {table.name} WHEN NEW.last_modified IS NULL
+            BEGIN
+                UPDATE {table.name} SET last_modified = CURRENT_TIMESTAMP WHERE id = NEW.id;
+            END
+        """)
+        # Local edits that don't set last_modified themselves get stamped;
+        # merges carry the remote timestamp and are left alone.
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table.name}_stamp_update
+            AFTER UPDATE ON {table.name} WHEN NEW.last_modified IS OLD.last_modified
+            BEGIN
+                UPDATE {table.name} SET last_modified = CURRENT_TIMESTAMP WHERE id = NEW.id;
+            END
+        """)
+        conn.execute(
+            f"CREATE INDEX IF NOT EXISTS idx_{table.name}_last_modified ON {table.name} (last_modified, id)"
+        )
+
+
+def bulk_merge(conn, table: SyncTable, records: list) -> dict:
+    """
+    Merges incoming records into `table` with set-based statements on `conn`
+    (the caller owns the transaction):
+
+    1. Stage the records into a temp table, keeping the newest copy per id.
+       Rows that would take a value of a secondary UNIQUE column held by
+       another row (live, or earlier in the batch) are dropped and counted
+       as skipped conflicts, so one colliding row can't fail the merge.
+    2. Count inserts/updates/skips against the live table. A skipped row
+       whose values differ from the live row is also counted as a conflict:
+       an edit that lost to an equally new or newer local one.
+    3. Apply everything with one INSERT ... ON CONFLICT DO UPDATE that only
+       overwrites rows whose incoming last_modified is newer.
+    """
+    summary = {'inserted': 0, 'updated': 0, 'skipped': 0, 'conflicts': 0}
+    rows = [
+        tuple(record.get(column) for column in table.columns)
+        for record in records if record.get('id')
+    ]
+    if not rows:
+        return summary
+
+    stage = f"merge_stage_{table.name}"
+    columns = ", ".join(table.columns)
+    placeholders = ", ".join("?" for _ in table.columns)
+    assignments = ", ".join(
+        f"{column} = excluded.{column}" for column in table.columns if column != 'id'
+    )
+
+    conn.execute(
+        f"CREATE TEMP TABLE IF NOT EXISTS {stage} AS SELECT {columns} FROM {table.name} WHERE 0"
+    )
+    conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS temp.{stage}_id ON {stage} (id)")
+    conn.execute(f"DELETE FROM {stage}")
+    conn.executemany(
+        f"INSERT INTO {stage} ({columns}) VALUES ({placeholders}) "
+        f"ON CONFLICT (id) DO UPDATE SET {assignments} "
+        f"WHERE excluded.last_modified > {stage}.last_modified",
+        rows
+    )
+    summary['conflicts'] = _drop_unique_collisions(conn, table, stage)
+
+    summary['inserted'] = conn.execute(
+        f"SELECT count(*) FROM {stage} s WHERE NOT EXISTS (SELECT 1 FROM {table.name} t WHERE t.id = s.id)"
+    ).fetchone()[0]
+    summary['updated'] = conn.execute(
+        f"SELECT count(*) FROM {stage} s JOIN {table.name} t ON t.id = s.id "
+        f"WHERE s.last_modified > t.last_modified"
+    ).fetchone()[0]
+    # Duplicate ids within the batch count as skipped, like older copies of a row
+    summary['skipped'] = len(rows) - summary['inserted'] - summary['updated']
+    differs = " OR ".join(
+        f"s.{column} IS NOT t.{column}" for column in table.columns
+        if column not in ('id', 'last_modified') and column not in table.counters
+    )
+    summary['conflicts'] += conn.execute(
+        f"SELECT count(*) FROM {stage} s JOIN {table.name} t ON t.id = s.id "
+        f"WHERE s.last_modified <= t.last_modified AND ({differs})"
+    ).fetchone()[0]
+
+    # "WHERE true" resolves the parsing ambiguity between a SELECT's join
+    # syntax and the upsert's ON CONFLICT clause.
+    conn.execute(
+        f"INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {stage} WHERE true "
+        f"ON CONFLICT (id) DO UPDATE SET {assignments} "
+        f"WHERE excluded.last_modified > {table.name}.last_modified"
+    )
+    conn.execute(f"DELETE FROM {stage}")
+    return summary
+
+
+def _drop_unique_collisions(conn, table: SyncTable, stage: str) -> int:
+    """
+    Deletes the staged rows that would be written but collide on one of the
+    table's secondary UNIQUE columns: with a live row of another id, or with a
+    staged row of a lower id. Returns how many were deleted.
+    """
+    # Only rows that are new, or newer than the live copy, are written
+    applied = (
+        "NOT EXISTS (SELECT 1 FROM {table} l WHERE l.id = {alias}.id AND NOT ({alias}.last_modified > l.last_modified))"
+    )
+    dropped = 0
+    for column in table.unique:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS temp.{stage}_{column} ON {stage} ({column})")
+        dropped += conn.execute(
+            f"DELETE FROM {stage} WHERE id IN ("
+            f"SELECT s.id FROM {stage} s JOIN {table.name} t ON t.{column} = s.{column} AND t.id != s.id "
+            f"WHERE {applied.format(table=table.name, alias='s')})"
+        ).rowcount
+        dropped += conn.execute(
+            f"DELETE FROM {stage} WHERE id IN ("
+            f"SELECT s.id FROM {stage} s JOIN {stage} o ON o.{column} = s.{column} AND o.id < s.id "
+            f"WHERE {applied.format(table=table.name, alias='s')} AND {applied.format(table=table.name, alias='o')})"
+        ).rowcount
+    if dropped:
+        print(f"Merging '{table.name}': skipped {dropped} records whose {', '.join(table.unique)} "
+              "belongs to another row.")
+    return dropped
@@ -0,0 +1,68 @@
+"""
+CC score shares (core.engagement): concurrent score changes on two replicas
+must both survive a merge.
+
+Each replica is an in-memory database with just the users table and what
+the score functions need, so they run on their own connection.
+"""
+
+import sqlite3
+
+from core.engagement import apply_deltas, ensure_engagement_schema, ensure_score_shares, merge_shares, read_shares
+from models.field_versions import CREATE_MERGE_FLAG_TABLE
+
+
+def _replica() -> sqlite3.Connection:
+    conn = sqlite3.connect(':memory:', isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, region TEXT, cc_score INTEGER DEFAULT 0, cc_shares TEXT)")
+    conn.execute(CREATE_MERGE_FLAG_TABLE)
+    conn.execute("INSERT INTO sync_merge_flag (active) VALUES (0)")
+    conn.execute("INSERT INTO users (id, region, cc_score) VALUES (1, 'TX', 10)")
+    ensure_engagement_schema(conn)
+    ensure_score_shares(conn)
+    return conn
+
+
+def _record(conn) -> dict:
+    row = conn.execute("SELECT id, region, cc_shares FROM users WHERE id = 1").fetchone()
+    return dict(row)
+
+
+def _merge(conn, record: dict, overwrite: bool):
+    """Merges `record` the way merge_records does; `overwrite` is whether the row merge took its shares."""
+    before = read_shares(conn, [1])
+    if overwrite:
+        conn.execute("UPDATE users SET cc_shares = ? WHERE id = 1", (record['cc_shares'],))
+    merge_shares(conn, [record], before)
+
+
+def _state(conn):
+    return tuple(conn.execute("SELECT cc_score, cc_shares FROM users WHERE id = 1").fetchone())
+
+
+def test_concurrent_changes_both_count():
+    a, b = _replica(), _replica()
+    apply_deltas(a, {1: 3})
+    apply_deltas(b, {1: 5})
+    apply_deltas(b, {1: -1})
+    from_a, from_b = _record(a), _record(b)
+
+    _merge(a, from_b, overwrite=True)
+    _merge(b, from_a, overwrite=False)
+
+    assert _state(a) == _state(b)
+    assert _state(a)[0] == 10 + 3 + 5 - 1
+
+
+def test_merging_again_changes_nothing():
+    a, b = _replica(), _replica()
+    apply_deltas(a, {1: 3})
+    _merge(b, _record(a), overwrite=True)
+    merged = _state(b)
+
+    _merge(b, _record(a), overwrite=False)
+    _merge(a, _record(b), overwrite=True)
+
+    assert _state(b) == merged == _state(a)
+    assert merged[0] == 13
@@ -0,0 +1,131 @@
+"""
+Column-level merges between two replicas (models.field_versions).
+
+Each replica is an in-memory database holding just the synced tables, so the
+merge runs on its own connection instead of the process-wide pool.
+"""
+
+import sqlite3
+
+import pytest
+
+from models.field_versions import ensure_field_versions_schema, merge_versioned
+from models.sync import SYNC_TABLES, ensure_sync_schema
+
+MEETINGS = SYNC_TABLES['meetings']
+CREATED_AT = '2030-01-01 00:00:00'
+EDITED_AT = '2030-01-02 12:00:00'
+
+
+def _replica() -> sqlite3.Connection:
+    conn = sqlite3.connect(':memory:', isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    for table in SYNC_TABLES.values():
+        columns = ", ".join(f"{column} {'UNIQUE' if column in table.unique else ''}"
+                            for column in table.columns if column not in ('id', 'last_modified'))
+        conn.execute(f"CREATE TABLE {table.name} (id INTEGER PRIMARY KEY, {columns}, last_modified TIMESTAMP)")
+    ensure_sync_schema(conn)
+    ensure_field_versions_schema(conn)
+    conn.execute(
+        "INSERT INTO meetings (id, host_id, city, state, title, notes, last_modified) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (1, 7, 'Austin', 'TX', 'Kickoff', None, CREATED_AT)
+    )
+    return conn
+
+
+def _edit(conn, **values):
+    """A local edit of meeting 1, stamped EDITED_AT as the triggers would within that second."""
+    assignments = ", ".join(f"{column} = ?" for column in values)
+    conn.execute(f"UPDATE meetings SET {assignments}, last_modified = ? WHERE id = 1", (*values.values(), EDITED_AT))
+
+
+def _delta(conn) -> dict:
+    """Meeting 1 as a sync delta of the columns edited at EDITED_AT."""
+    row = dict(conn.execute("SELECT * FROM meetings WHERE id = 1").fetchone())
+    versions = {
+        column: modified for column, modified in conn.execute(
+            "SELECT column_name, modified FROM field_versions "
+            "WHERE table_name = 'meetings' AND row_id = 1 AND modified = ?", (EDITED_AT,)
+        )
+    }
+    return {'id': 1, 'last_modified': row['last_modified'], **{column: row[column] for column in versions},
+            '_v': versions, '_full': 0}
+
+
+def _merge(conn, records) -> dict:
+    conn.execute("BEGIN")
+    summary = merge_versioned(conn, MEETINGS, records)
+    conn.execute("COMMIT")
+    return summary
+
+
+def _state(conn):
+    row = tuple(conn.execute("SELECT * FROM meetings WHERE id = 1").fetchone())
+    versions = conn.execute(
+        "SELECT column_name, modified FROM field_versions WHERE table_name = 'meetings' ORDER BY column_name"
+    ).fetchall()
+    return row, [tuple(version) for version in versions]
+
+
+@pytest.mark.parametrize('a_first', [True, False])
+@pytest.mark.parametrize('value_a, value_b', [
+    ('Alpha', 'Bravo'),
+    ('Same-second edit', None),
+    (42, 'forty-two'),
+])
+def test_equal_versions_converge(a_first, value_a, value_b):
+    a, b = _replica(), _replica()
+    _edit(a, title=value_a)
+    _edit(b, title=value_b)
+    from_a, from_b = _delta(a), _delta(b)
+
+    if a_first:
+        summary_b, summary_a = _merge(b, [from_a]), _merge(a, [from_b])
+    else:
+        summary_a, summary_b = _merge(a, [from_b]), _merge(b, [from_a])
+
+    assert _state(a) == _state(b)
+    # Exactly one side gave up its own value
+    assert summary_a['conflicts'] + summary_b['conflicts'] == 1
+
+
+def test_different_columns_both_survive():
+    a, b = _replica(), _replica()
+    _edit(a, title='New title')
+    _edit(b, notes='Bring flyers')
+    _merge(b, [_delta(a)])
+    _merge(a, [_delta(b)])
+
+    assert _state(a) == _state(b)
+    row = a.execute("SELECT title, notes FROM meetings WHERE id = 1").fetchone()
+    assert (row['title'], row['notes']) == ('New title', 'Bring flyers')
+
+
+def test_unversioned_columns_tie_on_last_modified():
+    a, b = _replica(), _replica()
+    full = {column: None for column in MEETINGS.columns}
+    row_a = {**full, 'id': 2, 'host_id': 1, 'title': 'From A', 'last_modified': CREATED_AT, '_v': {}, '_full': 1}
+    row_b = {**row_a, 'title': 'From B'}
+    for conn, own in ((a, row_a), (b, row_b)):
+        conn.execute(
+            f"INSERT INTO meetings ({', '.join(MEETINGS.columns)}) VALUES ({', '.join('?' for _ in MEETINGS.columns)})",
+            [own[column] for column in MEETINGS.columns]
+        )
+        # Rows from before field versions existed have no column versions
+        conn.execute("DELETE FROM field_versions WHERE row_id = 2 AND column_name != '*'")
+
+    _merge(a, [row_b])
+    _merge(b, [row_a])
+
+    assert a.execute("SELECT * FROM meetings WHERE id = 2").fetchone()[:] == \
+        b.execute("SELECT * FROM meetings WHERE id = 2").fetchone()[:]
+
+
+def test_delta_without_last_modified_keeps_the_row_watermark():
+    a, b = _replica(), _replica()
+    _edit(a, title='New title')
+    delta = {**_delta(a), 'last_modified': None}
+    _merge(b, [delta])
+
+    row = b.execute("SELECT title, last_modified FROM meetings WHERE id = 1").fetchone()
+    assert (row['title'], row['last_modified']) == ('New title', CREATED_AT)
@@ -0,0 +1,201 @@
+"""
+Compression stage of the sync pipeline (encode -> compress -> sign -> encrypt).
+
+Chunks are compressed before they are signed, so a receiver authenticates the
+bytes before it inflates them, and every chunk is inflated under a size cap.
+The methods, named by a spec string:
+
+- "zlib": one raw deflate stream across the whole sync, flushed (Z_SYNC_FLUSH)
+  after every chunk, so later chunks reuse the context of earlier ones.
+- "zlib+dict": the same, primed with a preset dictionary trained from
+  representative chunks (`train_dictionary`). Both peers must hold the same
+  dictionary file; it is identified by a hash.
+- "lzma": each chunk compressed on its own (lzma has no sync flush).
+- "none": no compression.
+
+The sender names the method in its hello frame. A receiver advertises what it
+accepts with `accepted_header()` (the X-Sync-Compression response header),
+and the sender picks from that with `negotiate` on its next sync. Until a
+peer's header has been seen, streams to it go out uncompressed.
+"""
+
+import hashlib
+import lzma
+import threading
+import zlib
+from collections import Counter
+from typing import Iterable, Optional, Set
+
+from config import SYNC_COMPRESSION, SYNC_COMPRESSION_LEVEL, SYNC_DICTIONARY_PATH
+
+METHODS = ('zlib+dict', 'zlib', 'lzma', 'none')
+
+# Largest dictionary deflate can use (its window size)
+MAX_DICTIONARY_BYTES = 32 * 1024
+
+_LZMA_FILTERS = [{"id": lzma.FILTER_LZMA2, "preset": 6}]
+
+
+class CompressionError(ValueError):
+    """Data could not be decompressed, or would inflate beyond the size cap."""
+
+
+def dictionary_id(dictionary: bytes) -> str:
+    return hashlib.sha256(dictionary).hexdigest()[:16]
+
+
+_dictionary = None
+_dictionary_loaded = False
+_dictionary_lock = threading.Lock()
+
+
+def load_dictionary() -> Optional[bytes]:
+    """This node's preset dictionary from SYNC_DICTIONARY_PATH, or None if there is none."""
+    global _dictionary, _dictionary_loaded
+    if not _dictionary_loaded:
+        with _dictionary_lock:
+            if not _dictionary_loaded:
+                if SYNC_DICTIONARY_PATH.exists():
+                    _dictionary = SYNC_DICTIONARY_PATH.read_bytes()[-MAX_DICTIONARY_BYTES:] or None
+                _dictionary_loaded = True
+    return _dictionary
+
+
+def require_dictionary() -> bytes:
+    """This node's preset dictionary; raises ValueError if it has none."""
+    dictionary = load_dictionary()
+    if dictionary is None:
+        raise ValueError(f"No compression dictionary at {SYNC_DICTIONARY_PATH}")
+    return dictionary
+
+
+def _tokens() -> list:
+    dictionary = load_dictionary()
+    methods = [method for method in METHODS if method != 'zlib+dict']
+    if dictionary is not None:
+        methods.insert(0, f"zlib+dict={dictionary_id(dictionary)}")
+    return methods
+
+
+def accepted_header() -> str:
+    """The X-Sync-Compression value advertising what this node can decompress."""
+    return ", ".join(_tokens())
+
+
+def parse_accepted(header: Optional[str]) -> Set[str]:
+    """Parses a peer's X-Sync-Compression header; a peer without it only takes "none"."""
+    if not header:
+        return {'none'}
+    return {token.strip() for token in header.split(",") if token.strip()}
+
+
+def negotiate(accepted: Optional[Set[str]], preferences: Iterable[str] = SYNC_COMPRESSION) -> str:
+    """
+    The first of `preferences` that both this node and the peer support.
+    `accepted` is the peer's parsed header, or None if it is not known yet, in
+    which case only "none" is safe: the peer may not decompress anything.
+    """
+    if accepted is None:
+        return 'none'
+    ours = _tokens()
+    for method in preferences:
+        token = next((t for t in ours if t.split("=")[0] == method), None)
+        if token is not None and token in accepted:
+            return method
+    return 'none'
+
+
+class Compressor:
+    """Compresses the messages of one sync stream, in order."""
+
+    def __init__(self, method: str, level: int = SYNC_COMPRESSION_LEVEL):
+        if method not in METHODS:
+            raise ValueError(f"Unknown compression method: {method}")
+        self.method = method
+        self.dictionary = require_dictionary() if method == 'zlib+dict' else None
+        self._deflate = None
+        if method.startswith('zlib'):
+            options = {'zdict': self.dictionary} if self.dictionary else {}
+            self._deflate = zlib.compressobj(level, zlib.DEFLATED, -15, **options)
+
+    def compress(self, data: bytes) -> bytes:
+        if self._deflate is not None:
+            return self._deflate.compress(data) + self._deflate.flush(zlib.Z_SYNC_FLUSH)
+        if self.method == 'lzma':
+            return lzma.compress(data, format=lzma.FORMAT_RAW, filters=_LZMA_FILTERS)
+        return data
+
+
+class Decompressor:
+    """
+    Inflates the messages of one sync stream, in order, refusing any message
+    that would exceed `max_bytes`. `dictionary` is the id the sender named.
+    """
+
+    def __init__(self, method: str, max_bytes: int, dictionary: Optional[str] = None):
+        if method not in METHODS:
+            raise CompressionError(f"Unsupported compression method: {method}")
+        self.method = method
+        self.max_bytes = max_bytes
+        self._inflate = None
+        if method.startswith('zlib'):
+            options = {}
+            if method == 'zlib+dict':
+                ours = load_dictionary()
+                if ours is None or dictionary != dictionary_id(ours):
+                    raise CompressionError(f"Unknown compression dictionary: {dictionary}")
+                options['zdict'] = ours
+            self._inflate = zlib.decompressobj(-15, **options)
+
+    def decompress(self, data: bytes) -> bytes:
+        try:
+            if self._inflate is not None:
+                out = self._inflate.decompress(data, self.max_bytes + 1)
+                overflow = len(out) > self.max_bytes or bool(self._inflate.unconsumed_tail)
+            elif self.method == 'lzma':
+                inflate = lzma.LZMADecompressor(format=lzma.FORMAT_RAW, filters=_LZMA_FILTERS)
+                out = inflate.decompress(data, self.max_bytes + 1)
+                if not inflate.eof and inflate.needs_input:
+                    raise CompressionError("Compressed data is truncated")
+                overflow = len(out) > self.max_bytes or not inflate.eof
+            else:
+                return data
+        except (zlib.error, lzma.LZMAError) as e:
+            raise CompressionError(f"Corrupt compressed data: {e}")
+        if overflow:
+            raise CompressionError(f"Message inflates beyond the {self.max_bytes} byte limit")
+        return out
+
+
+def train_dictionary(samples: Iterable[bytes], size: int = MAX_DICTIONARY_BYTES, segment: int = 32) -> bytes:
+    """
+    Builds a preset dictionary from sample messages: the fixed-size segments
+    that recur most often across the samples, with the most frequent last
+    (deflate reaches the end of a dictionary most cheaply).
+    """
+    counts = Counter()
+    for sample in samples:
+        counts.update({sample[start:start + segment] for start in range(0, len(sample) - segment + 1, segment // 2)})
+    common = [piece for piece, count in counts.most_common(size // segment) if count > 1]
+    return b"".join(reversed(common))[-size:]
+
+
+def train_from_database(chunks_per_table: int = 10) -> bytes:
+    """Trains a dictionary from this node's syncable rows, encoded as they are sent."""
+    from core.p2p import gather_changed_records
+    from core.sync_protocol import MAX_CHUNK_RECORDS, iter_chunks
+    from utils.codec import encode_message
+
+    samples, per_table = [], Counter()
+    for seq, (table_name, chunk) in enumerate(iter_chunks(gather_changed_records(0), MAX_CHUNK_RECORDS)):
+        if per_table[table_name] < chunks_per_table:
+            per_table[table_name] += 1
+            samples.append(encode_message({"seq": seq, "table": table_name, "records": chunk, "timestamp": 0}))
+    return train_dictionary(samples)
+
+
+if __name__ == "__main__":
+    # Writes this node's dictionary; copy the same file to every peer that should use "zlib+dict".
+    trained = train_from_database()
+    SYNC_DICTIONARY_PATH.write_bytes(trained)
+    print(f"Wrote a {len(trained)} byte dictionary ({dictionary_id(trained)}) to {SYNC_DICTIONARY_PATH}")
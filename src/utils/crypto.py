@@ -1,5 +1,11 @@
 import os
-from nacl.signing import SigningKey
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from nacl.public import Box
+from nacl.signing import SigningKey, VerifyKey
 from nacl.exceptions import CryptoError
 # Import paths from our central config file
 from config import PRIVATE_KEY_PATH, PUBLIC_KEY_PATH, KEYS_DIR
@@ -26,3 +32,105 @@ def generate_and_store_keys():
         os.chmod(PUBLIC_KEY_PATH, 0o600)
 
     print(f"Private and public keys saved to: {KEYS_DIR}")
+
+
+# How often (seconds) the KeyRing checks whether the key file changed
+KEY_RELOAD_CHECK_INTERVAL = 1.0
+
+# Per-peer Boxes kept by the KeyRing; each holds a precomputed shared key
+MAX_CACHED_BOXES = 1024
+
+
+class KeyRing:
+    """
+    Process-wide cache of our key material.
+
+    The signing key is read from disk once, and re-read only when the key
+    file's modification time changes. The derived Curve25519 private key and
+    one Box per peer public key are cached too: building a Box performs the
+    Diffie-Hellman exchange, so caching it means the shared key is computed
+    once per peer rather than once per message.
+    """
+
+    def __init__(self, private_key_path: Path = PRIVATE_KEY_PATH,
+                 check_interval: float = KEY_RELOAD_CHECK_INTERVAL):
+        self.private_key_path = private_key_path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._next_check = 0.0
+        self._signing_key = None
+        self._curve_private_key = None
+        self._boxes = OrderedDict()
+        self._verify_keys = {}
+
+    def _refresh(self):
+        """Loads the key on first use and reloads it if the file changed."""
+        now = time.monotonic()
+        if self._signing_key is not None and now < self._next_check:
+            return
+        with self._lock:
+            if self._signing_key is not None and now < self._next_check:
+                return
+            mtime = os.stat(self.private_key_path).st_mtime_ns
+            if mtime != self._mtime or self._signing_key is None:
+                with open(self.private_key_path, "rb") as f:
+                    signing_key = SigningKey(f.read())
+                self._signing_key = signing_key
+                self._curve_private_key = signing_key.to_curve25519_private_key()
+                # Boxes were derived from the old key
+                self._boxes.clear()
+                self._mtime = mtime
+            self._next_check = now + self.check_interval
+
+    @property
+    def signing_key(self) -> SigningKey:
+        """Our Ed25519 signing key. Raises IOError/CryptoError if it can't be loaded."""
+        self._refresh()
+        return self._signing_key
+
+    @property
+    def public_key_hex(self) -> str:
+        """Our Ed25519 public key, hex-encoded as peers store it."""
+        return self.signing_key.verify_key.encode().hex()
+
+    def verify_key_for(self, public_key_hex: str) -> VerifyKey:
+        """Returns a (cached) VerifyKey for a peer's hex-encoded public key."""
+        verify_key = self._verify_keys.get(public_key_hex)
+        if verify_key is None:
+            verify_key = VerifyKey(bytes.fromhex(public_key_hex))
+            with self._lock:
+                if len(self._verify_keys) >= MAX_CACHED_BOXES:
+                    self._verify_keys.clear()
+                self._verify_keys[public_key_hex] = verify_key
+        return verify_key
+
+    def box_for(self, public_key_hex: str) -> Box:
+        """Returns the (cached) Box between us and the peer with this Ed25519 public key."""
+        self._refresh()
+        with self._lock:
+            box = self._boxes.get(public_key_hex)
+            if box is not None:
+                self._boxes.move_to_end(public_key_hex)
+                return box
+        peer_key = self.verify_key_for(public_key_hex).to_curve25519_public_key()
+        box = Box(self._curve_private_key, peer_key)
+        with self._lock:
+            self._boxes[public_key_hex] = box
+            if len(self._boxes) > MAX_CACHED_BOXES:
+                self._boxes.popitem(last=False)
+        return box
+
+
+_keyring = None
+_keyring_lock = threading.Lock()
+
+
+def get_keyring() -> KeyRing:
+    """Returns the process-wide KeyRing."""
+    global _keyring
+    if _keyring is None:
+        with _keyring_lock:
+            if _keyring is None:
+                _keyring = KeyRing()
+    return _keyring
@@ -0,0 +1,75 @@
+"""
+Merkle tree helpers (RFC 6962 / RFC 9162 hashing).
+
+Leaves and interior nodes are hashed with distinct prefixes so a leaf can
+never be passed off as a node. Trees need not be balanced: a tree of n
+leaves splits at the largest power of two smaller than n.
+"""
+
+import hashlib
+from typing import List
+
+
+def leaf_hash(data: bytes) -> bytes:
+    return hashlib.sha256(b"\x00" + data).digest()
+
+
+def node_hash(left: bytes, right: bytes) -> bytes:
+    return hashlib.sha256(b"\x01" + left + right).digest()
+
+
+def _split(n: int) -> int:
+    """Largest power of two strictly smaller than n (n > 1)."""
+    k = 1
+    while k * 2 < n:
+        k *= 2
+    return k
+
+
+def merkle_root(leaves: List[bytes]) -> bytes:
+    """Root hash over already-hashed leaves."""
+    if not leaves:
+        return hashlib.sha256(b"").digest()
+    # Bottom-up pairing yields the same root as the recursive RFC 6962
+    # definition: an odd node at the end of a level is carried up unchanged.
+    level = list(leaves)
+    while len(level) > 1:
+        paired = [node_hash(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            paired.append(level[-1])
+        level = paired
+    return level[0]
+
+
+def inclusion_proof(leaves: List[bytes], index: int) -> List[bytes]:
+    """Audit path (sibling hashes, leaf to root) for leaves[index]."""
+    if not 0 <= index < len(leaves):
+        raise IndexError("leaf index out of range")
+    if len(leaves) == 1:
+        return []
+    k = _split(len(leaves))
+    if index < k:
+        return inclusion_proof(leaves[:k], index) + [merkle_root(leaves[k:])]
+    return inclusion_proof(leaves[k:], index - k) + [merkle_root(leaves[:k])]
+
+
+def verify_inclusion(leaf: bytes, index: int, size: int, path: List[bytes], root: bytes) -> bool:
+    """Checks an audit path from `inclusion_proof` against a root (RFC 9162, 2.1.3.2)."""
+    if not 0 <= index < size:
+        return False
+    fn, sn = index, size - 1
+    r = leaf
+    for p in path:
+        if sn == 0:
+            return False
+        if fn & 1 or fn == sn:
+            r = node_hash(p, r)
+            if not fn & 1:
+                while fn and not fn & 1:
+                    fn >>= 1
+                    sn >>= 1
+        else:
+            r = node_hash(r, p)
+        fn >>= 1
+        sn >>= 1
+    return sn == 0 and r == root
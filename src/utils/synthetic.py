@@ -0,0 +1,328 @@
+"""
+Seeded synthetic data at production scale, for benchmarks and load tests.
+
+`populate(rows, seed)` fills an empty database with about `rows` rows
+(10k to 10M are practical), spread over the tables the way a live
+deployment grows:
+
+- users form invitation trees: each new user is invited by an existing one,
+  picked with probability proportional to how many people they have already
+  invited (preferential attachment), so a few organizers have large downlines
+  and most users none. Every invited user has the signup that links them to
+  their inviter, and usually lives in the inviter's city.
+- roles follow a realistic pyramid (one national organizer per tree, a few
+  statal and municipal organizers, facilitators, shadowers, connectors), and
+  regions are the cities and states the ACL rules compare against.
+- meetings are hosted by facilitators in their city and attended by users of
+  that city; email_log holds completed CTA campaigns with a share of clicked
+  links; audit_log holds entries signed the way core.audit signs them.
+- last_modified is spread over the past year, so incremental syncs see a
+  realistic fraction of the rows. CC scores are tallied from the generated
+  events as they are written, so no later UPDATE restamps the users.
+
+The same seed always produces the same rows, except for values that embed
+the current time (signed tokens and audit signatures).
+"""
+
+import argparse
+import random
+import time
+from collections import Counter
+from typing import Dict, Iterator, List, NamedTuple, Optional
+
+from config import AUDIT_SIGNING, CTA_TOKEN_TTL, ENGAGEMENT_WEIGHTS, TOKEN_FORMAT
+from core.audit import canonical_encoding, get_audit_sink
+from core.engagement import base_shares, encode_shares, rebuild_leaderboards
+from models.connection import connection, transaction
+from models.invite_tree import rebuild
+from utils.crypto import get_keyring
+from utils.tokens import KIND_CTA, issue_token
+
+CITIES = (
+    ('nyc', 'ny'), ('albany', 'ny'), ('buffalo', 'ny'), ('sf', 'ca'), ('la', 'ca'), ('oakland', 'ca'),
+    ('sacramento', 'ca'), ('austin', 'tx'), ('houston', 'tx'), ('dallas', 'tx'), ('chicago', 'il'),
+    ('seattle', 'wa'), ('portland', 'or'), ('denver', 'co'), ('atlanta', 'ga'), ('boston', 'ma'),
+)
+DOMAINS = ('gmail.com', 'gmail.com', 'gmail.com', 'yahoo.com', 'outlook.com', 'proton.me', 'icloud.com', 'riseup.net')
+OCCUPATIONS = ('teacher', 'nurse', 'student', 'engineer', 'driver', 'organizer', 'retired', 'cook', 'artist', None)
+MEETING_TITLES = ('Kickoff', 'Canvass planning', 'Teach-in', 'Weekly check-in', 'Rally prep', 'Onboarding')
+AUDIT_ACTIONS = (('create', 'meetings'), ('record_attendance', 'attendance'), ('create_user', 'users'),
+                 ('redeem_invite', 'invitations'), ('send_cta', 'cta_campaigns'))
+
+# Share of the generated rows that goes to each table; users get one signup each
+TABLE_SHARES = {
+    'users': 0.09, 'signups': 0.09, 'invitations': 0.10, 'meetings': 0.02,
+    'attendance': 0.25, 'email_log': 0.35, 'audit_log': 0.10,
+}
+
+# Role of a non-root user, with its cumulative probability
+ROLES = (('municipal', 0.003), ('facilitator', 0.05), ('shadower', 0.35), ('connector', 1.0))
+
+USERS_PER_TREE = 5000  # One invitation tree (rooted at a national organizer) per this many users
+RECIPIENTS_PER_CAMPAIGN = 2000
+CTA_RESPONSE_RATE = 0.08
+SAME_CITY_RATE = 0.85  # Chance that an invited user lives in the inviter's city
+
+INSERT_BATCH = 10000  # Rows per executemany
+
+DAY = 24 * 60 * 60
+YEAR = 365 * DAY
+
+
+class Scale(NamedTuple):
+    users: int
+    invitations: int
+    meetings: int
+    attendance: int
+    email_log: int
+    audit_log: int
+
+    @classmethod
+    def for_rows(cls, rows: int) -> 'Scale':
+        """Table sizes for about `rows` rows in total."""
+        count = {table: max(int(rows * share), 1) for table, share in TABLE_SHARES.items()}
+        return cls(max(count['users'], 10), count['invitations'], count['meetings'],
+                   count['attendance'], count['email_log'], count['audit_log'])
+
+
+def _stamp(unix_time: float) -> str:
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(unix_time))
+
+
+def _batched(rows: Iterator[tuple], size: int = INSERT_BATCH) -> Iterator[List[tuple]]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _insert(conn, table: str, columns: tuple, rows: Iterator[tuple], verb: str = "INSERT") -> int:
+    statement = f"{verb} INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})"
+    count = 0
+    for batch in _batched(rows):
+        conn.executemany(statement, batch)
+        count += len(batch)
+    return count
+
+
+class SyntheticData:
+    """Generates one seeded data set; `populate` is the usual entry point."""
+
+    def __init__(self, scale: Scale, seed: int = 0, now: Optional[float] = None):
+        self.scale = scale
+        self.rng = random.Random(seed)
+        self.now = int(time.time() if now is None else now)
+        self.parents: List[Optional[int]] = [None]  # Index = user id; ids start at 1
+        self.cities: List[int] = [0]  # Index into CITIES per user
+        self.roles: List[str] = [None]
+        self.by_city: Dict[int, List[int]] = {}
+        self.facilitators: List[int] = []
+        self.meeting_hosts: List[int] = []
+        self.campaign_senders: List[int] = []
+        self.scores = Counter()  # user id -> CC score earned by the generated events
+
+    def _past(self, span: int = YEAR) -> str:
+        return _stamp(self.now - self.rng.randrange(span))
+
+    def _hex(self, bits: int = 128) -> str:
+        return f"{self.rng.getrandbits(bits):0{bits // 4}x}"
+
+    def build_tree(self):
+        """Chooses every user's inviter, city and role, and who hosts meetings and sends CTAs."""
+        rng = self.rng
+        trees = max(self.scale.users // USERS_PER_TREE, 1)
+        # Each user appears once, plus once per person they invited
+        targets: List[int] = []
+        for user_id in range(1, self.scale.users + 1):
+            if user_id <= trees:
+                parent, city = None, rng.randrange(len(CITIES))
+                role = 'national' if user_id == 1 else 'statal'
+            else:
+                parent = rng.choice(targets)
+                targets.append(parent)
+                city = self.cities[parent] if rng.random() < SAME_CITY_RATE else rng.randrange(len(CITIES))
+                draw = rng.random()
+                role = next(name for name, cumulative in ROLES if draw < cumulative)
+            targets.append(user_id)
+            self.parents.append(parent)
+            self.cities.append(city)
+            self.roles.append(role)
+            self.by_city.setdefault(city, []).append(user_id)
+            if role == 'facilitator':
+                self.facilitators.append(user_id)
+        if not self.facilitators:
+            self.facilitators = list(range(1, self.scale.users + 1))
+        self.meeting_hosts = [rng.choice(self.facilitators) for _ in range(self.scale.meetings)]
+        campaigns = -(-self.scale.email_log // RECIPIENTS_PER_CAMPAIGN)
+        self.campaign_senders = [rng.choice(self.facilitators) for _ in range(campaigns)]
+
+    def email(self, user_id: int) -> str:
+        return f"user{user_id}@{DOMAINS[user_id % len(DOMAINS)]}"
+
+    def users(self) -> Iterator[tuple]:
+        rng = self.rng
+        for user_id in range(1, self.scale.users + 1):
+            city, state = CITIES[self.cities[user_id]]
+            role = self.roles[user_id]
+            yield (user_id, self.email(user_id), self._hex(256), role, state if role == 'statal' else city,
+                   self.scores[user_id], encode_shares(base_shares(self.scores[user_id])),
+                   self._past(180 * DAY), int(rng.random() < 0.95), self._past())
+
+    def signups(self) -> Iterator[tuple]:
+        rng = self.rng
+        for user_id in range(1, self.scale.users + 1):
+            parent = self.parents[user_id]
+            if parent is None:
+                continue
+            city, state = CITIES[self.cities[user_id]]
+            created = self._past()
+            self.scores[parent] += ENGAGEMENT_WEIGHTS['invite_redeemed']
+            yield (user_id, f"Member {user_id}", self.email(user_id), parent, city, state,
+                   f"{rng.randrange(10000, 99999)}", f"district {rng.randrange(1, 12)}",
+                   rng.choice(OCCUPATIONS), self._hex(), created, created)
+
+    def invitations(self) -> Iterator[tuple]:
+        rng = self.rng
+        for invitation_id in range(1, self.scale.invitations + 1):
+            inviter = rng.randrange(1, self.scale.users + 1)
+            created = self._past()
+            yield (invitation_id, f"invitee{invitation_id}@{rng.choice(DOMAINS)}", inviter,
+                   int(rng.random() < 0.6), self._hex(), created, created)
+
+    def meetings(self) -> Iterator[tuple]:
+        rng = self.rng
+        for meeting_id, host in enumerate(self.meeting_hosts, 1):
+            city, state = CITIES[self.cities[host]]
+            scheduled = _stamp(self.now + rng.randrange(-180 * DAY, 60 * DAY))
+            yield (meeting_id, host, city, state, scheduled, f"{rng.choice(MEETING_TITLES)} #{meeting_id}",
+                   f"Bring {rng.randrange(2, 40)} flyers", self._past())
+
+    def attendance(self) -> Iterator[tuple]:
+        rng = self.rng
+        meetings = self.scale.meetings
+        for meeting_id, host in enumerate(self.meeting_hosts, 1):
+            # Distinct attendees from the host's city
+            neighbours = self.by_city[self.cities[host]]
+            size = self.scale.attendance // meetings + (meeting_id <= self.scale.attendance % meetings)
+            for node_id in rng.sample(neighbours, min(size, len(neighbours))):
+                attended = int(rng.random() < 0.9)
+                self.scores[node_id] += ENGAGEMENT_WEIGHTS['attendance'] * attended
+                yield (meeting_id, node_id, attended, self._past())
+
+    def campaigns(self) -> Iterator[tuple]:
+        for campaign_id, sender in enumerate(self.campaign_senders, 1):
+            sent = min(RECIPIENTS_PER_CAMPAIGN, self.scale.email_log - (campaign_id - 1) * RECIPIENTS_PER_CAMPAIGN)
+            created = self._past()
+            yield (campaign_id, sender, f"Call to action #{campaign_id}", "We need volunteers this weekend.",
+                   "https://example.com/volunteer", 'completed', self.scale.users, sent, sent, 0, created, created)
+
+    def email_log(self) -> Iterator[tuple]:
+        rng = self.rng
+        for log_id in range(1, self.scale.email_log + 1):
+            campaign_id = (log_id - 1) // RECIPIENTS_PER_CAMPAIGN + 1
+            sent_at = self.now - rng.randrange(YEAR)
+            token = issue_token(KIND_CTA, log_id, CTA_TOKEN_TTL) if TOKEN_FORMAT == "signed" else self._hex()
+            recipient = rng.randrange(1, self.scale.users + 1)
+            responded = None
+            if rng.random() < CTA_RESPONSE_RATE:
+                responded = _stamp(sent_at + rng.randrange(3 * DAY))
+                self.scores[recipient] += ENGAGEMENT_WEIGHTS['cta_response']
+            yield (log_id, self.campaign_senders[campaign_id - 1], recipient,
+                   f"Call to action #{campaign_id}", "https://example.com/volunteer", token, _stamp(sent_at),
+                   responded, campaign_id, 'sent')
+
+    def audit_log(self) -> Iterator[tuple]:
+        rng = self.rng
+        signing_key = get_keyring().signing_key if AUDIT_SIGNING == "entry" else None
+        for _ in range(self.scale.audit_log):
+            action, entity = rng.choice(AUDIT_ACTIONS)
+            entry = {
+                "action": action,
+                "performed_by": rng.randrange(1, self.scale.users + 1),
+                "entity": entity,
+                "record_id": rng.randrange(1, max(self.scale.meetings, self.scale.users) + 1),
+                "timestamp": self.now - rng.randrange(YEAR),
+            }
+            payload = canonical_encoding(entry)
+            # In epoch mode the entries are sealed afterwards, as the audit writer would
+            signature_hex = signing_key.sign(payload).signature.hex() if signing_key else None
+            yield (entry["action"], entry["performed_by"], entry["entity"], entry["record_id"],
+                   entry["timestamp"], signature_hex, payload.decode('utf-8'))
+
+    def write(self) -> Dict[str, int]:
+        """Builds the trees and inserts every table; returns the rows written per table."""
+        self.build_tree()
+        counts = {}
+        with transaction() as conn:
+            counts['signups'] = _insert(conn, 'signups', (
+                'id', 'name', 'email', 'invited_by', 'city', 'state', 'zip', 'neighborhood', 'occupation',
+                'token', 'created_at', 'last_modified'
+            ), self.signups())
+            counts['invitations'] = _insert(conn, 'invitations', (
+                'id', 'email', 'invited_by', 'used', 'token', 'created_at', 'last_modified'
+            ), self.invitations())
+        with transaction() as conn:
+            counts['meetings'] = _insert(conn, 'meetings', (
+                'id', 'host_id', 'city', 'state', 'scheduled_at', 'title', 'notes', 'last_modified'
+            ), self.meetings())
+            counts['attendance'] = _insert(conn, 'attendance', ('meeting_id', 'node_id', 'attended', 'recorded_at'),
+                                           self.attendance())
+        with transaction() as conn:
+            counts['cta_campaigns'] = _insert(conn, 'cta_campaigns', (
+                'id', 'sender_id', 'subject', 'body', 'cta_link', 'status', 'last_recipient_id',
+                'queued', 'sent', 'failed', 'created_at', 'completed_at'
+            ), self.campaigns())
+            counts['email_log'] = _insert(conn, 'email_log', (
+                'id', 'sender_id', 'recipient_id', 'subject', 'cta_link', 'token', 'sent_at',
+                'responded_at', 'campaign_id', 'delivery_status'
+            ), self.email_log())
+        with transaction() as conn:
+            counts['audit_log'] = _insert(conn, 'audit_log', (
+                'action', 'performed_by', 'entity', 'record_id', 'timestamp', 'signature', 'payload'
+            ), self.audit_log())
+        with transaction() as conn:
+            # Last, so that every event has been tallied into the scores
+            counts['users'] = _insert(conn, 'users', (
+                'id', 'email', 'public_key', 'role', 'region', 'cc_score', 'cc_shares', 'last_active', 'is_active',
+                'last_modified'
+            ), self.users())
+            rebuild(conn)
+            rebuild_leaderboards(conn)
+        if AUDIT_SIGNING == "epoch":
+            while get_audit_sink().seal_epoch() is not None:
+                pass
+        return counts
+
+
+def populate(rows: int, seed: int = 0, now: Optional[float] = None) -> Dict[str, int]:
+    """
+    Fills the database with about `rows` synthetic rows; returns the rows
+    written per table. Refuses (returns {}) if there are users already.
+    """
+    with connection() as conn:
+        if conn.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+            print("Synthetic data: the database already has users; populate an empty one.")
+            return {}
+    started = time.perf_counter()
+    counts = SyntheticData(Scale.for_rows(rows), seed, now).write()
+    print(f"Synthetic data: {sum(counts.values())} rows (seed {seed}) in {time.perf_counter() - started:.1f}s: "
+          + ", ".join(f"{table} {count}" for table, count in counts.items()))
+    return counts
+
+
+if __name__ == "__main__":
+    from models.database import initialize_database
+    from utils.crypto import generate_and_store_keys
+
+    parser = argparse.ArgumentParser(description="Fill an empty database with seeded synthetic data.")
+    parser.add_argument("--rows", type=int, default=100000, help="approximate total rows (default 100000)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--now", type=float, help="Unix time the data is generated around (default: now)")
+    args = parser.parse_args()
+    generate_and_store_keys()
+    initialize_database()
+    populate(args.rows, args.seed, args.now)
@@ -0,0 +1,96 @@
+"""
+Stateless, HMAC-authenticated tokens for CTA links and invitations.
+
+A signed token looks like "t1.<base64url>" and carries, in 29 bytes:
+
+    kind (1) | record id (8) | expiry, Unix seconds (4) | truncated HMAC-SHA256 tag (16)
+
+The tag covers the kind, id and expiry under a secret key kept in
+TOKEN_KEY_PATH, so a forged, altered, expired or malformed token is rejected
+by `verify_token` without a database lookup, and a valid one names the row
+it belongs to by primary key. Random legacy tokens from `secrets.token_urlsafe`
+never contain a '.', so both kinds can be told apart with `is_signed_token`.
+"""
+
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import struct
+import threading
+import time
+from typing import Optional
+
+from config import TOKEN_KEY_PATH
+
+_PREFIX = "t1."
+
+# Token kinds; a token issued for one purpose is never accepted for another
+KIND_CTA = 1
+KIND_INVITE = 2
+
+_BODY = struct.Struct(">BQI")  # kind, record id, expiry
+_TAG_BYTES = 16
+_ENCODED_LENGTH = len(_PREFIX) + len(base64.urlsafe_b64encode(b"\0" * (_BODY.size + _TAG_BYTES)).rstrip(b"="))
+
+
+class InvalidTokenError(ValueError):
+    """The token is malformed, forged, expired or of the wrong kind."""
+
+
+_key = None
+_key_lock = threading.Lock()
+
+
+def _token_key() -> bytes:
+    """Loads the HMAC key, creating it on first use."""
+    global _key
+    if _key is None:
+        with _key_lock:
+            if _key is None:
+                if not TOKEN_KEY_PATH.exists():
+                    with open(TOKEN_KEY_PATH, "wb") as f:
+                        f.write(secrets.token_bytes(32))
+                    if os.name != 'nt':
+                        os.chmod(TOKEN_KEY_PATH, 0o600)
+                with open(TOKEN_KEY_PATH, "rb") as f:
+                    _key = f.read()
+    return _key
+
+
+def _tag(body: bytes) -> bytes:
+    return hmac.new(_token_key(), body, hashlib.sha256).digest()[:_TAG_BYTES]
+
+
+def is_signed_token(token: str) -> bool:
+    return token.startswith(_PREFIX)
+
+
+def issue_token(kind: int, record_id: int, ttl: int) -> str:
+    """Returns a token for row `record_id` that is valid for `ttl` seconds."""
+    body = _BODY.pack(kind, record_id, int(time.time()) + ttl)
+    raw = body + _tag(body)
+    return _PREFIX + base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+
+def verify_token(token: str, kind: int, now: Optional[float] = None) -> int:
+    """
+    Returns the record id embedded in a token that is valid at `now` (default:
+    the current time); raises InvalidTokenError otherwise.
+    """
+    if len(token) != _ENCODED_LENGTH or not is_signed_token(token):
+        raise InvalidTokenError("Malformed token")
+    try:
+        raw = base64.urlsafe_b64decode(token[len(_PREFIX):] + "==")
+    except ValueError:
+        raise InvalidTokenError("Malformed token")
+    body, tag = raw[:_BODY.size], raw[_BODY.size:]
+    if not hmac.compare_digest(tag, _tag(body)):
+        raise InvalidTokenError("Token signature is invalid")
+    token_kind, record_id, expires_at = _BODY.unpack(body)
+    if token_kind != kind:
+        raise InvalidTokenError("Token was issued for a different purpose")
+    if expires_at < (time.time() if now is None else now):
+        raise InvalidTokenError("Token has expired")
+    return record_id